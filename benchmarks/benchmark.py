@@ -0,0 +1,261 @@
+"""Times and memory-profiles every planner phase on generated economies.
+
+Each planner and size runs in its own process, so that a slow or huge run can be cut
+off by the timeout and the resident memory high-water mark belongs to that run only.
+Results are appended as JSON lines together with the generator parameters, the git
+commit and the library versions, so that runs can be compared over time:
+
+    python benchmark.py run --sizes 10,100,1000 --results results.jsonl
+    python benchmark.py compare baseline.jsonl results.jsonl
+"""
+
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from statistics import median
+
+import click
+
+from generate import economy_dir
+from planning_common.instrumentation import Instrumentation, max_rss_bytes
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLANNERS = ['planning', 'planning_loop', 'harmonizer', 'ortools', 'pulp']
+
+
+class Phases(Instrumentation):
+    """the phase timings of planning_common.instrumentation, whose phases can be nested,
+    that also writes the finished phases to progress_file, so a run that is cut off
+    still shows where it spent its time. The experiment3 planners record their own
+    phases into it"""
+
+    def __init__(self, progress_file=None, trace_memory=False):
+        super().__init__(trace_memory)
+        self.progress_file = progress_file
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        try:
+            with super().phase(name):
+                yield
+        finally:
+            if self.progress_file:
+                with open(self.progress_file, 'w') as progress:
+                    json.dump(self.phases, progress)
+
+
+def run_planning(data_dir, out_dir, phases, vectorized=True, backend='glop'):
+    sys.path.insert(0, os.path.join(REPO_DIR, 'experiment3'))
+    from planning.planning import Planning
+
+    # import, setup with its setup_variables and setup_constraints, solve and export
+    planning = Planning(data_dir, out_dir, instrumentation=phases, backend=backend)
+    planning.import_example_data()
+    # the loop model builds every capital pair, the sparse one scales to large economies
+    planning.setup_solver(vectorized=vectorized, names=False, sparse=vectorized)
+    planning.solve()
+    planning.export_results()
+    return {
+        'status': planning.result_status,
+        'variables': planning.solver.NumVariables(),
+        'constraints': planning.solver.NumConstraints(),
+        'iterations': planning.solver.iterations(),
+    }
+
+
+def run_planning_loop(data_dir, out_dir, phases, backend='glop'):
+    return run_planning(data_dir, out_dir, phases, vectorized=False, backend=backend)
+
+
+def run_harmonizer(data_dir, out_dir, phases):
+    sys.path.insert(0, os.path.join(REPO_DIR, 'experiment3'))
+    from planning_alg3.planning import Planning
+
+    planning = Planning(data_dir, out_dir, instrumentation=phases)
+    planning.import_data()
+    with phases.phase('setup'):
+        initial_weights = planning.leontief_weights()
+    planning.harmonize(initial_weights=initial_weights)
+    planning.export_results()
+    return {'converged': planning.converged, 'iterations': len(planning.history)}
+
+
+def run_linear_programming(module, data_dir, phases, backend='glop'):
+    sys.path.insert(0, os.path.join(REPO_DIR, 'linear_programming'))
+    planner_class = __import__(module).Planner
+
+    with phases.phase('import'):
+        planner = planner_class(data_dir, False, backend=backend)
+    if module == 'pulp_plan':
+        import pulp
+        planner.model = pulp.LpProblem("Planning")
+    with phases.phase('setup_variables'):
+        planner.add_variables()
+    with phases.phase('setup_constraints'):
+        planner.add_constraints()
+    with phases.phase('solve'):
+        planner.add_objective(planner.set_min_labor_objective)
+        planner.solve()
+    # the second objective re-solves the same model
+    with phases.phase('resolve'):
+        planner.add_objective(planner.set_max_production_objective)
+        planner.solve()
+    with phases.phase('export'):
+        planner.output_solution(debug=False)
+    if module == 'pulp_plan':
+        return {'status': planner.model.status}
+    return {
+        'status': planner.result_status,
+        'variables': planner.solver.NumVariables(),
+        'constraints': planner.solver.NumConstraints(),
+        'iterations': planner.solver.iterations(),
+    }
+
+
+def run_single(planner, data_dir, progress_file=None, backend='glop', trace_memory=False):
+    """backend is the solver of every planner but the harmonizer, trace_memory adds the
+    peak traced memory of every phase at the cost of slower allocations"""
+    phases = Phases(progress_file, trace_memory)
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as out_dir, contextlib.redirect_stdout(sys.stderr):
+        if planner == 'planning':
+            result = run_planning(data_dir, out_dir, phases, backend=backend)
+        elif planner == 'planning_loop':
+            result = run_planning_loop(data_dir, out_dir, phases, backend=backend)
+        elif planner == 'harmonizer':
+            result = run_harmonizer(data_dir, out_dir, phases)
+        elif planner == 'ortools':
+            result = run_linear_programming('ortools_plan', data_dir, phases, backend=backend)
+        else:
+            result = run_linear_programming('pulp_plan', data_dir, phases, backend=backend)
+    return {**result, 'wall_time': time.perf_counter() - start, 'max_rss_bytes': max_rss_bytes(),
+            'phases': phases.phases}
+
+
+def environment():
+    commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+                            capture_output=True, text=True).stdout.strip()
+    versions = {}
+    for module in ['numpy', 'pandas', 'scipy', 'ortools', 'pulp']:
+        try:
+            versions[module] = __import__(module).__version__
+        except ImportError:
+            versions[module] = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+        'versions': versions,
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+    }
+
+
+@click.group()
+def benchmark():
+    pass
+
+
+@benchmark.command()
+@click.option('--sizes', default='10,50,100,500', show_default=True, help='comma separated numbers of sectors')
+@click.option('--planners', default=','.join(PLANNERS), show_default=True)
+@click.option('--inputs-per-sector', default=5, show_default=True)
+@click.option('--years', default=5, show_default=True)
+@click.option('--seed', default=0, show_default=True)
+@click.option('--repeat', default=1, show_default=True)
+@click.option('--timeout', default=600, show_default=True, help='seconds per run')
+@click.option('--data-dir', default='data', show_default=True, help='generated economies are kept here')
+@click.option('--results', default='results.jsonl', show_default=True)
+@click.option('--backend', default='glop', show_default=True, help='solver of every planner but the harmonizer')
+@click.option('--trace-memory', is_flag=True, help='record the peak traced memory per phase, slows allocations down')
+def run(sizes, planners, inputs_per_sector, years, seed, repeat, timeout, data_dir, results, backend, trace_memory):
+    env = environment()
+    for sectors in [int(size) for size in sizes.split(',')]:
+        economy = economy_dir(data_dir, sectors, inputs_per_sector, years, seed)
+        for planner in planners.split(','):
+            for run_index in range(repeat):
+                record = {
+                    **env,
+                    'planner': planner,
+                    'backend': backend,
+                    'trace_memory': trace_memory,
+                    'sectors': sectors,
+                    'inputs_per_sector': inputs_per_sector,
+                    'years': years,
+                    'seed': seed,
+                    'run': run_index,
+                }
+                with tempfile.NamedTemporaryFile('r', suffix='.json') as progress:
+                    try:
+                        child = subprocess.run(
+                            [sys.executable, os.path.abspath(__file__), 'single', planner, economy,
+                             '--progress-file', progress.name, '--backend', backend]
+                            + (['--trace-memory'] if trace_memory else []),
+                            capture_output=True, text=True, timeout=timeout)
+                        if child.returncode == 0:
+                            record.update(outcome='ok', **json.loads(child.stdout.splitlines()[-1]))
+                        else:
+                            record.update(outcome='error', error=child.stderr.strip().splitlines()[-1:])
+                    except subprocess.TimeoutExpired:
+                        record.update(outcome='timeout')
+                    if 'phases' not in record:
+                        # the phases that finished before the run failed or was cut off
+                        progress.seek(0)
+                        record['phases'] = json.loads(progress.read() or '{}')
+                with open(results, 'a') as results_file:
+                    results_file.write(json.dumps(record) + '\n')
+                print(f"{planner:14} {backend:8} {sectors:6} sectors: {record['outcome']:8} "
+                      f"{record.get('wall_time', float('nan')):9.3f}s")
+
+
+@benchmark.command()
+@click.argument('planner', type=click.Choice(PLANNERS))
+@click.argument('data_dir')
+@click.option('--progress-file', default=None)
+@click.option('--backend', default='glop', show_default=True)
+@click.option('--trace-memory', is_flag=True)
+def single(planner, data_dir, progress_file, backend, trace_memory):
+    print(json.dumps(run_single(planner, data_dir, progress_file, backend, trace_memory)))
+
+
+@benchmark.command()
+@click.argument('baseline')
+@click.argument('results')
+@click.option('--threshold', default=1.25, show_default=True, help='slowdown ratio reported as regression')
+def compare(baseline, results, threshold):
+    """compares the median wall time per planner, size and phase; exits with 1 if any
+    phase got slower than the threshold"""
+    def load(path):
+        times = defaultdict(list)
+        with open(path) as results_file:
+            for line in results_file:
+                record = json.loads(line)
+                for phase, measured in record.get('phases', {}).items():
+                    # traced runs are slower, records from before the option were all traced
+                    key = (record['planner'], record.get('backend', 'glop'), record.get('trace_memory', True),
+                           record['sectors'], record['inputs_per_sector'], record['years'], record['seed'], phase)
+                    times[key].append(measured['wall_time'])
+        return {key: median(values) for key, values in times.items()}
+
+    before, after = load(baseline), load(results)
+    regressions = 0
+    for key in sorted(before.keys() & after.keys()):
+        ratio = after[key] / before[key] if before[key] > 0 else float('inf')
+        marker = ''
+        if ratio > threshold:
+            marker = '  REGRESSION'
+            regressions += 1
+        planner, backend, _, sectors, _, _, _, phase = key
+        print(f"{planner:14} {backend:8} {sectors:6} {phase:18} {before[key]:9.4f}s -> {after[key]:9.4f}s  x{ratio:5.2f}{marker}")
+    sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,122 @@
+"""Generates synthetic input-output economies for benchmarking.
+
+Every sector takes about `inputs_per_sector` other products as inputs, so the number
+of nonzero cells grows linearly with the number of sectors. The input coefficients
+of each sector sum to less than one, which keeps the economy productive, i.e. every
+target can be reached with enough labor. The same economy is written in the format
+of experiment3 (flows, targets, capital_stock, depreciation_rates) and in the format
+of linear_programming (input_output, constraints, units)."""
+
+import os
+from dataclasses import dataclass
+
+import click
+import numpy as np
+import pandas as pd
+
+EXPERIMENT3_FILES = ['flows.csv', 'targets.csv', 'capital_stock.csv', 'depreciation_rates.csv']
+LINEAR_PROGRAMMING_FILES = ['input_output.csv', 'constraints.csv', 'units.csv']
+
+
+@dataclass
+class Economy:
+    products: list[str]
+    technology: np.ndarray  # [input, output] per unit of output
+    output: np.ndarray  # units produced by one unit of each sector's recipe
+    labor: np.ndarray  # per unit of output
+    capital: np.ndarray  # [input, output] capital stock
+    depreciation: np.ndarray  # [input, output]
+    targets: np.ndarray  # [year, product] final consumption
+    labor_supply: np.ndarray  # per year
+    envimpact: np.ndarray
+    prio: np.ndarray
+
+
+def generate_economy(sectors, inputs_per_sector=5, years=5, seed=0):
+    rng = np.random.default_rng(seed)
+    products = [f"sector_{i}" for i in range(sectors)]
+    inputs = min(inputs_per_sector, sectors)
+
+    technology = np.zeros((sectors, sectors))
+    for j in range(sectors):
+        rows = rng.choice(sectors, size=inputs, replace=False)
+        weights = rng.random(inputs)
+        technology[rows, j] = weights / weights.sum() * rng.uniform(0.3, 0.7)
+    output = rng.uniform(1, 100, sectors)
+    labor = rng.uniform(0.1, 1, sectors)
+
+    # every sector keeps a stock of about half of its inputs as capital
+    capital = np.where(technology > 0, technology * output * rng.uniform(1, 3, technology.shape), 0)
+    capital = np.where(rng.random(technology.shape) < 0.5, capital, 0)
+    depreciation = np.where(capital > 0, rng.uniform(0.02, 0.1, technology.shape), 0)
+
+    consumption = rng.uniform(0.5, 2, sectors)
+    growth = 1 + 0.01 * np.arange(years)
+    targets = np.outer(growth, consumption)
+    gross_output = np.linalg.solve(np.eye(sectors) - technology, consumption)
+    # room for accumulation on top of the labor the targets need directly
+    labor_supply = 1.5 * growth * (labor @ gross_output)
+    # the linear_programming environmental allowance is 100, the minimums need half of it
+    envimpact = rng.uniform(0.1, 1, sectors)
+    envimpact *= 50 / (envimpact @ gross_output)
+    prio = rng.integers(1, 11, sectors).astype(float)
+    return Economy(products, technology, output, labor, capital, depreciation,
+                   targets, labor_supply, envimpact, prio)
+
+
+def write_experiment3(economy, data_dir):
+    products = economy.products
+    headings = products + ['labor', 'output']
+    flows = np.vstack([economy.technology * economy.output, economy.labor * economy.output, economy.output])
+    _write_table(f"{data_dir}/flows.csv", headings, products, flows)
+    years = [f"year{y + 1}" for y in range(len(economy.labor_supply))]
+    targets = np.column_stack([economy.targets, economy.labor_supply])
+    _write_table(f"{data_dir}/targets.csv", years, products + ['labor'], targets)
+    _write_table(f"{data_dir}/capital_stock.csv", products, products, economy.capital)
+    _write_table(f"{data_dir}/depreciation_rates.csv", products, products, economy.depreciation)
+
+
+def write_linear_programming(economy, data_dir):
+    products = economy.products
+    headings = products + ['labor', 'output']
+    input_output = np.vstack([economy.technology * economy.output, economy.labor * economy.output, economy.output])
+    _write_table(f"{data_dir}/input_output.csv", headings, products, input_output)
+    constraints = np.vstack([economy.targets[0], economy.prio, economy.envimpact])
+    _write_table(f"{data_dir}/constraints.csv", ['minimum', 'prio', 'envimpact'], products, constraints)
+    pd.DataFrame([['unit'] + ['u'] * len(products)], columns=['headings'] + products).to_csv(
+        f"{data_dir}/units.csv", index=False)
+
+
+def _write_table(path, row_headings, columns, values):
+    df = pd.DataFrame(values, columns=columns)
+    df.insert(0, 'headings', row_headings)
+    df.to_csv(path, index=False, float_format='%.10g')
+
+
+def economy_dir(root, sectors, inputs_per_sector, years, seed):
+    """generates the economy into root unless it is already there, the generator is
+    deterministic, so the files only depend on the parameters"""
+    data_dir = os.path.join(root, f"sectors{sectors}_inputs{inputs_per_sector}_years{years}_seed{seed}")
+    files = EXPERIMENT3_FILES + LINEAR_PROGRAMMING_FILES
+    if not all(os.path.exists(os.path.join(data_dir, f)) for f in files):
+        os.makedirs(data_dir, exist_ok=True)
+        economy = generate_economy(sectors, inputs_per_sector, years, seed)
+        write_experiment3(economy, data_dir)
+        write_linear_programming(economy, data_dir)
+    return data_dir
+
+
+@click.command()
+@click.argument('sectors', type=int)
+@click.argument('output_dir')
+@click.option('--inputs-per-sector', default=5, show_default=True)
+@click.option('--years', default=5, show_default=True)
+@click.option('--seed', default=0, show_default=True)
+def generate(sectors, output_dir, inputs_per_sector, years, seed):
+    os.makedirs(output_dir, exist_ok=True)
+    economy = generate_economy(sectors, inputs_per_sector, years, seed)
+    write_experiment3(economy, output_dir)
+    write_linear_programming(economy, output_dir)
+
+if __name__ == '__main__':
+    generate()
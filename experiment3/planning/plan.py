@@ -2,20 +2,66 @@
 algorithm from https://github.com/wc22m/5yearplan """
 
 import sys
-import more_itertools as mit
-from planning import Planning
+import click
+from ortools.linear_solver import pywraplp
+from planning_common.model_cache import ModelCache
+from planning_common.solver_backends import BACKENDS, PdlpOptions
+from planning.planning import Planning
 
+INPUT_FILES = ['flows.csv', 'targets.csv', 'capital_stock.csv', 'depreciation_rates.csv']
 
-def main():
-    input_dir = mit.nth(sys.argv, 1, 'test_data')
-    output_dir = mit.nth(sys.argv, 2, 'out/test_data')
-    planning = Planning(input_dir, output_dir)
-    planning.import_example_data()
-    planning.setup_solver()
+
+@click.command()
+@click.argument('input_dir', default='test_data')
+@click.argument('output_dir', default='out/test_data')
+@click.option('--cache-dir', default='out/cache', show_default=True,
+              help='reuse built models and solutions for unchanged input')
+@click.option('--metrics-file', default=None,
+              help='write phase timings and model size as json to this file')
+@click.option('--model-file', default=None,
+              help='write the model, LP or MPS by extension, .gz compresses, e.g. plan.mps.gz')
+@click.option('--results-format', default='csv', show_default=True,
+              type=click.Choice(['csv', 'parquet', 'npz']),
+              help='parquet and npz write a single file with every variable family')
+@click.option('--backend', default='glop', show_default=True, type=click.Choice(BACKENDS),
+              help='solver, see solver_backends, the model and solution are cached per backend')
+@click.option('--pdlp-options', default='', metavar='OPTIONS',
+              help='the large model mode, e.g. threads=8,time_limit=600,polish=glop')
+def main(input_dir, output_dir, cache_dir, metrics_file, model_file, results_format, backend,
+         pdlp_options):
+    cache = ModelCache(cache_dir)
+    pdlp_options = PdlpOptions.from_string(pdlp_options)
+    cache_key = ModelCache.input_key(input_dir, INPUT_FILES, backend, pdlp_options)
+    cached = cache.load(cache_key)
+
+    planning = Planning(input_dir, output_dir, backend=backend, pdlp_options=pdlp_options)
+    problems = []
+    if 'model' in cached:
+        planning.load_model(cached['model'], cached['metadata'], cached.get('solution'))
+    else:
+        planning.import_example_data()
+        # why the plan meets few of its targets, or why the solver finds no plan
+        problems = planning.check_feasibility()['problems']
+        for problem in problems:
+            print(f"warning, the targets are out of reach: {problem}")
+        # products no target needs get no variables, the results have zeros for them
+        planning.presolve()
+        planning.setup_solver(vectorized=True)
+        cache.store(cache_key, model=planning.model_proto(), metadata=planning.model_metadata())
     planning.print_solver()
-    planning.solve()
+    if model_file:
+        planning.write_model(model_file)
+    if 'solution' not in cached:
+        planning.solve()
+        if planning.result_status == pywraplp.Solver.INFEASIBLE:
+            sys.exit("\n".join(["the solver found the plan infeasible"] + problems))
+        if planning.result_status == pywraplp.Solver.OPTIMAL:
+            cache.store(cache_key, solution=planning.solution_proto())
     planning.output_result()
-    planning.export_results()
+    planning.export_results(results_format)
+    if metrics_file:
+        planning.instrumentation.write_json(metrics_file)
 
 if __name__ == '__main__':
-    main()
+    # click fills in the arguments
+    main()  # pylint: disable=no-value-for-parameter
@@ -1,43 +1,241 @@
 from collections import defaultdict
+import numpy as np
 import pandas as pd
+from scipy.sparse import csr_matrix
+from ortools.linear_solver import linear_solver_pb2
 from ortools.linear_solver import pywraplp
-
-class Planning:
-    def __init__(self, input_dir, output_dir):
+from planning_common.instrumentation import Instrumentation
+from planning_common import model_export
+from planning_common.leontief import leontief_inverse, productivity_blocks, required_products
+from planning_common.solver_backends import (
+    ConstraintMatrix, LinearProgram, create_solver, has_duals, solution_accuracy,
+    solve_with_backend)
+from planning.replanning import ReplanningMixin
+from planning.results import ResultsMixin
+from planning.rolling_horizon import RollingHorizonMixin
+from planning.stored_model import StoredModelMixin
+
+
+class Planning(ReplanningMixin, RollingHorizonMixin, StoredModelMixin, ResultsMixin):
+    """the linear program of a five year plan, built from the input tables by
+    setup_solver. Replanning, the rolling horizon solve, the model cache and the
+    result export are in the mixin modules"""
+    VARIABLE_FAMILIES = (
+        'accumulation_for_of',
+        'accumulation_of',
+        'capital_stock_for_of',
+        'depreciation_in_production_of',
+        'final_consumption_of',
+        'flow_for_of',
+        'labor_in_year',
+        'labor_for',
+        'output_of',
+        'productive_consumption_of',
+        'target_fulfillment_in_year',
+    )
+
+    def __init__(self, input_dir, output_dir, instrumentation=None, backend='glop',
+                 pdlp_options=None):
+        """backend is one of solver_backends.BACKENDS, pdlp_options the
+        solver_backends.PdlpOptions of the pdlp backend, the large model mode"""
         self.input_dir = input_dir
         self.output_dir = output_dir
+        self.instrumentation = instrumentation or Instrumentation()
+        self.backend = backend
+        self.pdlp_options = pdlp_options
+        self.accuracy = None
+        # the assembled solution of solve_rolling, which has no model of the whole horizon
+        self.rolling_solution = None
+        self.solver = None
+        self.result_status = None
+        self.vectorized = False
+        self.names = True
+        self.num_nonzeros = 0
+        # [family] arrays of solver variable indices, -1 for pairs without a variable
+        self.variable_index = {}
+        self.num_variables = 0
+        # the variable families, the solver variables from setup_solver on and their
+        # solution values after format_results
+        self.accumulation_for_of = {}
+        self.accumulation_of = {}
+        self.capital_stock_for_of = {}
+        self.depreciation_in_production_of = {}
+        self.final_consumption_of = {}
+        self.flow_for_of = {}
+        self.labor_in_year = {}
+        self.labor_for = {}
+        self.output_of = {}
+        self.productive_consumption_of = {}
+        self.target_fulfillment_in_year = {}
+        # the solver variables, which format_results does not replace
+        self.model_variables = {}
+        # the rows that carry input data, read by dual_arrays and touched by replanning,
+        # keyed by (year, p), year and (p, q), None while they are not known
+        self.leontief_constraints = None
+        self.labor_supply_constraints = None
+        self.initial_capital_stock_constraints = None
 
     def import_example_data(self):
-        self.flows = pd.read_csv(f"{self.input_dir}/flows.csv")
-        self.products = list(self.flows)[1:]
-        rows = list(self.flows['headings'])
-        self.row_map = {name: index for index, name in enumerate(rows)}
-
-        self.targets = pd.read_csv(f"{self.input_dir}/targets.csv")
-        self.years = self.targets.shape[0]
-
-        self.cap = pd.read_csv(f"{self.input_dir}/capital_stock.csv")
-        self.dep = pd.read_csv(f"{self.input_dir}/depreciation_rates.csv")
+        with self.instrumentation.phase('import'):
+            self.flows = pd.read_csv(f"{self.input_dir}/flows.csv")
+            self.products = list(self.flows)[1:]
+            # presolve can drop products from the model, the exports cover all of them
+            self.input_products = self.products
+            self.kept_products = np.arange(len(self.products))
+            rows = list(self.flows['headings'])
+            self.row_map = {name: index for index, name in enumerate(rows)}
+
+            self.targets = pd.read_csv(f"{self.input_dir}/targets.csv")
+            self.years = self.targets.shape[0]
+
+            self.cap = pd.read_csv(f"{self.input_dir}/capital_stock.csv")
+            self.dep = pd.read_csv(f"{self.input_dir}/depreciation_rates.csv")
+            self.__setup_coefficients()
+
+    def __setup_coefficients(self):
+        """float64 coefficient arrays indexed by integer product ids, [input q, output p]
+        for the product matrices, so that building the model needs no pandas lookups.
+        The output ratios are zero where the divisor is zero, i.e. where the model has
+        no constraint for that cell"""
+        product_rows = [self.row_map[p] for p in self.products]
+        flows = self.flows[self.products].to_numpy(dtype=float)
+        self.io_matrix = flows[product_rows]
+        self.output_row = flows[self.row_map['output']]
+        self.labor_row = flows[self.row_map['labor']]
+        self.cap_matrix = self.cap[self.products].to_numpy(dtype=float)[product_rows]
+        self.dep_matrix = self.dep[self.products].to_numpy(dtype=float)[product_rows]
+        self.product_targets = self.targets[self.products].to_numpy(dtype=float, copy=True)
+        self.labor_supply = self.targets['labor'].to_numpy(dtype=float, copy=True)
+        self.initial_capital_stocks = self.cap_matrix.copy()
+
+        self.output_per_labor = self.__output_ratio(self.labor_row)
+        self.output_per_io = self.__output_ratio(self.io_matrix)
+        self.output_per_cap = self.__output_ratio(self.cap_matrix)
+
+    def scale_parameters(self, targets_scale=1.0, labor_scale=1.0, depreciation_scale=1.0):
+        """scenario overrides applied before setup_solver. depreciation_scale is a single
+        multiplier or one per output product in the order of self.products"""
+        self.product_targets = self.product_targets * targets_scale
+        self.labor_supply = self.labor_supply * labor_scale
+        self.dep_matrix = self.dep_matrix * np.asarray(depreciation_scale, dtype=float)
+
+    def presolve(self):
+        """drops the products that no target needs, neither directly nor through the
+        flows or capital stocks of other products, before the model is built. Only target
+        fulfillment is maximized, so the model over the rest has the same optimum, and
+        the exports put zeros back for the dropped products. self.products and every
+        coefficient array cover the kept products from then on, so later targets for a
+        dropped product cannot be planned. Returns the names of the dropped products"""
+        with self.instrumentation.phase('presolve'):
+            required = required_products((self.io_matrix != 0) | (self.cap_matrix != 0),
+                                         (self.product_targets > 0).any(axis=0))
+            kept = np.flatnonzero(required)
+            dropped = [self.products[i] for i in np.flatnonzero(~required)]
+            self.kept_products = self.kept_products[kept]
+            self.products = [self.products[i] for i in kept]
+            for name in ['io_matrix', 'cap_matrix', 'dep_matrix', 'initial_capital_stocks',
+                         'output_per_io', 'output_per_cap']:
+                setattr(self, name, getattr(self, name)[np.ix_(kept, kept)])
+            for name in ['output_row', 'labor_row', 'output_per_labor']:
+                setattr(self, name, getattr(self, name)[kept])
+            self.product_targets = self.product_targets[:, kept]
+        self.instrumentation.record(dropped_products=len(dropped))
+        return dropped
+
+    def technology_matrix(self):
+        """A[input q, output p], the flows per unit of output, zero for products without output"""
+        return csr_matrix(self.__input_ratio(self.io_matrix))
+
+    def check_feasibility(self, max_products=3):
+        """diagnoses in milliseconds, before the model is built, what keeps the targets out
+        of reach: products with targets but no output in the flows table, blocks of
+        products that are not productive (spectral radius of A at least 1) and years whose
+        targets need more labor than the supply, at least the labor values of the targets
+        as every target needs its gross output (I - A)^-1 targets. The model meets what it
+        can of the targets, so none of these make it infeasible, they explain a low target
+        fulfillment or an infeasible solve. Returns the spectral radius, this minimum labor
+        per year and the problems found, which are also recorded, capital stocks are left
+        to the solver as they grow with accumulation"""
+        with self.instrumentation.phase('feasibility_check'):
+            problems, report = self.__feasibility_problems(max_products)
+        report['problems'] = problems
+        self.instrumentation.record(**report)
+        return report
+
+    def __feasibility_problems(self, max_products):
+        problems = []
+        targeted = (self.product_targets > 0).any(axis=0)
+        unproduced = targeted & (self.output_row == 0)
+        if unproduced.any():
+            problems.append("no output in the flows table: "
+                            f"{self.__product_list(np.flatnonzero(unproduced))}")
+
+        technology_matrix = self.technology_matrix()
+        blocks = productivity_blocks(technology_matrix)
+        radius = max((block_radius for _, block_radius in blocks), default=0.0)
+        report = {'spectral_radius': radius}
+        for indices, block_radius in blocks:
+            if block_radius >= 1:
+                problems.append(f"not productive, {block_radius:.4g} times their output used up as "
+                                f"inputs among themselves: {self.__product_list(indices)}")
+        if problems:
+            return problems, report
+
+        labor_values = leontief_inverse(technology_matrix).labor_values(
+            self.__input_ratio(self.labor_row))
+        labor = self.product_targets * labor_values
+        minimum_labor = labor.sum(axis=1)
+        report['minimum_labor'] = minimum_labor.tolist()
+        for y in np.flatnonzero(minimum_labor > self.labor_supply):
+            largest = np.argsort(labor[y])[::-1][:max_products]
+            problems.append(f"year {y}: the targets need at least {minimum_labor[y]:.6g} labor, "
+                            f"the supply is {self.labor_supply[y]:.6g}, most for "
+                            f"{self.__product_list(largest)}")
+        return problems, report
+
+    def __product_list(self, indices):
+        return ', '.join(self.products[i].strip() for i in indices)
+
+    def __input_ratio(self, inputs):
+        output = np.broadcast_to(self.output_row, inputs.shape)
+        return np.divide(inputs, output, out=np.zeros_like(inputs), where=output != 0)
+
+    def __output_ratio(self, divisor):
+        output = np.broadcast_to(self.output_row, divisor.shape)
+        return np.divide(output, divisor, out=np.zeros_like(divisor), where=divisor != 0)
+
+    def _set_variable_families(self, families=None):
+        """sets the variable family attributes to families, {family: nested dict}, or to
+        empty ones"""
+        if families is None:
+            families = {family: defaultdict(lambda: defaultdict(dict))
+                        for family in self.VARIABLE_FAMILIES}
+        self.accumulation_for_of = families['accumulation_for_of']
+        self.accumulation_of = families['accumulation_of']
+        self.capital_stock_for_of = families['capital_stock_for_of']
+        self.depreciation_in_production_of = families['depreciation_in_production_of']
+        self.final_consumption_of = families['final_consumption_of']
+        self.flow_for_of = families['flow_for_of']
+        self.labor_in_year = families['labor_in_year']
+        self.labor_for = families['labor_for']
+        self.output_of = families['output_of']
+        self.productive_consumption_of = families['productive_consumption_of']
+        self.target_fulfillment_in_year = families['target_fulfillment_in_year']
+
+    def _variable_families(self):
+        return {family: getattr(self, family) for family in self.VARIABLE_FAMILIES}
 
     def setup_variables(self):
-        self.accumulation_for_of = defaultdict(lambda: defaultdict(dict))
-        self.accumulation_of = defaultdict(lambda: defaultdict(dict))
-        self.capital_stock_for_of = defaultdict(lambda: defaultdict(dict))
-        self.depreciation_in_production_of = defaultdict(lambda: defaultdict(dict))
-        self.final_consumption_of = defaultdict(lambda: defaultdict(dict))
-        self.flow_for_of = defaultdict(lambda: defaultdict(dict))
-        self.labor_in_year = defaultdict(lambda: defaultdict(dict))
-        self.labor_for = defaultdict(lambda: defaultdict(dict))
-        self.output_of = defaultdict(lambda: defaultdict(dict))
-        self.productive_consumption_of = defaultdict(lambda: defaultdict(dict))
-        self.target_fulfillment_in_year = defaultdict(lambda: defaultdict(dict))
-
+        """the variables of every year, product and (product, input) pair as one
+        solver call each, see setup_solver for the bulk build"""
+        self._set_variable_families()
         for y in range(self.years):
             self.target_fulfillment_in_year[y] = self.solver.NumVar(
                 0.0, self.solver.infinity(), f"target_fulfillment_in_year_{y}")
-            self.labor_in_year[y] = self.solver.NumVar(0.0, self.solver.infinity(), f"labor_in_year_{y}")
+            self.labor_in_year[y] = self.solver.NumVar(
+                0.0, self.solver.infinity(), f"labor_in_year_{y}")
 
-            for p in self.products:
+            for i, p in enumerate(self.products):
                 self.accumulation_of[y][p] = self.solver.NumVar(
                     0.0, self.solver.infinity(), f"accumulation_of_{p}_year_{y}")
                 self.final_consumption_of[y][p] = self.solver.NumVar(
@@ -49,23 +247,28 @@ class Planning:
                 self.productive_consumption_of[y][p] = self.solver.NumVar(
                     0.0, self.solver.infinity(), f"productive_comsumption_of_{p}_year_{y}")
 
-                for q in self.products:
-                    self.accumulation_for_of[y][p][q] = self.solver.NumVar(
-                        0.0, self.solver.infinity(), f"accumulation_for_{p}_of_{q}_year_{y}")
-                    self.capital_stock_for_of[y][p][q] = self.solver.NumVar(
-                        0.0, self.solver.infinity(), f"capital_stock_for_{p}_of_{q}_year_{y}")
-                    self.depreciation_in_production_of[y][p][q] = self.solver.NumVar(
-                        0.0, self.solver.infinity(), f"depreciation_in_{p}_production_of_{q}_year_{y}")
-                    self.flow_for_of[y][p][q] = self.solver.NumVar(
-                        0.0, self.solver.infinity(), f"flow_for_{p}_of_{q}_year_{y}")
+                for j, q in enumerate(self.products):
+                    if self.capital_pairs[i, j]:
+                        self.accumulation_for_of[y][p][q] = self.solver.NumVar(
+                            0.0, self.solver.infinity(), f"accumulation_for_{p}_of_{q}_year_{y}")
+                        self.capital_stock_for_of[y][p][q] = self.solver.NumVar(
+                            0.0, self.solver.infinity(), f"capital_stock_for_{p}_of_{q}_year_{y}")
+                        self.depreciation_in_production_of[y][p][q] = self.solver.NumVar(
+                            0.0, self.solver.infinity(),
+                            f"depreciation_in_{p}_production_of_{q}_year_{y}")
+                    if self.flow_pairs[i, j]:
+                        self.flow_for_of[y][p][q] = self.solver.NumVar(
+                            0.0, self.solver.infinity(), f"flow_for_{p}_of_{q}_year_{y}")
 
     def __setup_year_based_constraints(self, y):
         # 1. targets given by leontief demand for year
-        for p in self.products:
-            if self.__target(p, y) > 0:
+        for i, p in enumerate(self.products):
+            if self.product_targets[y, i] > 0:
                 leontief_constraint = self.solver.Constraint(0, self.solver.infinity(), 'leontief')
-                leontief_constraint.SetCoefficient(self.final_consumption_of[y][p], 1/self.__target(p, y))
+                leontief_constraint.SetCoefficient(
+                    self.final_consumption_of[y][p], 1/self.product_targets[y, i])
                 leontief_constraint.SetCoefficient(self.target_fulfillment_in_year[y], -1)
+                self.leontief_constraints[(y, i)] = leontief_constraint
         # 2. labor total
         labor_total_constraint = self.solver.Constraint(0, self.solver.infinity(), 'labor_total')
         labor_total_constraint.SetCoefficient(self.labor_in_year[y], 1)
@@ -73,30 +276,34 @@ class Planning:
             labor_total_constraint.SetCoefficient(self.labor_for[y][p], -1)
         # 3. labor supply
         labor_supply_contraint = self.solver.Constraint(
-            -self.solver.infinity(), self.__target('labor', y), 'labor_supply')
+            -self.solver.infinity(), self.labor_supply[y], 'labor_supply')
         labor_supply_contraint.SetCoefficient(self.labor_in_year[y], 1)
+        self.labor_supply_constraints[y] = labor_supply_contraint
 
-        for p in self.products:
-            self.__setup_year_p_based_constraints(y, p)
+        for i in range(len(self.products)):
+            self.__setup_year_p_based_constraints(y, i)
 
-    def __setup_year_p_based_constraints(self, y, p):
+    def __setup_year_p_based_constraints(self, y, i):
+        p = self.products[i]
         # 4. labor constraint
-        if self.__io('labor', p) != 0:
+        if self.labor_row[i] != 0:
             labor_constraint = self.solver.Constraint(0, self.solver.infinity(), 'labor')
             labor_constraint.SetCoefficient(self.output_of[y][p], -1)
-            labor_constraint.SetCoefficient(self.labor_for[y][p], self.__io('output', p)/self.__io('labor', p))
+            labor_constraint.SetCoefficient(self.labor_for[y][p], self.output_per_labor[i])
         # 5. accumulation total
         accumulation_total_constraint = self.solver.Constraint(
             0, self.solver.infinity(), 'accumulation_total')
         accumulation_total_constraint.SetCoefficient(self.accumulation_of[y][p], 1)
-        for q in self.products:
-            accumulation_total_constraint.SetCoefficient(self.accumulation_for_of[y][q][p], -1)
+        for j, q in enumerate(self.products):
+            if self.capital_pairs[j, i]:
+                accumulation_total_constraint.SetCoefficient(self.accumulation_for_of[y][q][p], -1)
         # 6. productive consumption
         productive_consumption_constraint = self.solver.Constraint(
             0, self.solver.infinity(), 'productive_consumption')
         productive_consumption_constraint.SetCoefficient(self.productive_consumption_of[y][p], 1)
-        for q in self.products:
-            productive_consumption_constraint.SetCoefficient(self.flow_for_of[y][q][p], -1)
+        for j, q in enumerate(self.products):
+            if self.flow_pairs[j, i]:
+                productive_consumption_constraint.SetCoefficient(self.flow_for_of[y][q][p], -1)
         # 7. consumption
         consumption_constraint = self.solver.Constraint(0, self.solver.infinity(), 'consumption')
         consumption_constraint.SetCoefficient(self.output_of[y][p], 1)
@@ -104,26 +311,29 @@ class Planning:
         consumption_constraint.SetCoefficient(self.final_consumption_of[y][p], -1)
         consumption_constraint.SetCoefficient(self.productive_consumption_of[y][p], -1)
 
-        for q in self.products:
-            self.__setup_year_p_q_based_constraints(y, p, q)
+        for j in range(len(self.products)):
+            self.__setup_year_p_q_based_constraints(y, i, j)
 
-    def __setup_year_p_q_based_constraints(self, y, p, q):
+    def __setup_year_p_q_based_constraints(self, y, i, j):
+        p, q = self.products[i], self.products[j]
         # 8. output equation
-        if self.__capital_stock(q, p) != 0:
+        if self.cap_matrix[j, i] != 0:
             output_constraint = self.solver.Constraint(0, self.solver.infinity(), 'output')
             output_constraint.SetCoefficient(
-                self.capital_stock_for_of[y][p][q], self.__io('output', p)/self.__capital_stock(q, p))
+                self.capital_stock_for_of[y][p][q], self.output_per_cap[j, i])
             output_constraint.SetCoefficient(self.output_of[y][p], -1)
         # 9. flow constraint
-        if self.__io(q, p) != 0:
+        if self.io_matrix[j, i] != 0:
             flow_constraint = self.solver.Constraint(0, self.solver.infinity(), 'flow')
-            flow_constraint.SetCoefficient(self.flow_for_of[y][p][q], self.__io('output', p)/self.__io(q, p))
+            flow_constraint.SetCoefficient(self.flow_for_of[y][p][q], self.output_per_io[j, i])
             flow_constraint.SetCoefficient(self.output_of[y][p], -1)
+        if not self.capital_pairs[i, j]:
+            return
         # 10. depreciation
         depreciation_constraint = self.solver.Constraint(0, 0, 'depreciation')
         depreciation_constraint.SetCoefficient(self.depreciation_in_production_of[y][p][q], 1)
         depreciation_constraint.SetCoefficient(
-            self.capital_stock_for_of[y][p][q], -self.__depreciation_rates(q, p))
+            self.capital_stock_for_of[y][p][q], -self.dep_matrix[j, i])
         if y > 0:
             # 11. accumulation constraint
             accumulation_constraint = self.solver.Constraint(
@@ -139,8 +349,10 @@ class Planning:
         else:
             # 12. initial capital stocks
             inital_capital_stock_constraint = self.solver.Constraint(
-                -self.solver.infinity(), float(self.__capital_stock(q, p)), 'initial_capital_stocks')
+                -self.solver.infinity(), self.initial_capital_stocks[j, i],
+                'initial_capital_stocks')
             inital_capital_stock_constraint.SetCoefficient(self.capital_stock_for_of[y][p][q], 1)
+            self.initial_capital_stock_constraints[(i, j)] = inital_capital_stock_constraint
 
     def setup_constraints(self):
         for y in range(self.years):
@@ -152,98 +364,387 @@ class Planning:
             objective.SetCoefficient(self.target_fulfillment_in_year[y], 1)
         objective.SetMaximization()
 
-    def setup_solver(self):
-        self.solver = pywraplp.Solver('Planning', pywraplp.Solver.GLOP_LINEAR_PROGRAMMING)
-
-        self.setup_variables()
-        self.setup_constraints()
-        self.setup_objective()
+    def __variable_shapes(self):
+        """array shape of each variable family, [year], [year, p] or [year, output p, input q]"""
+        years, num_products = self.years, len(self.products)
+        return {
+            'target_fulfillment_in_year': (years,),
+            'labor_in_year': (years,),
+            'accumulation_of': (years, num_products),
+            'final_consumption_of': (years, num_products),
+            'labor_for': (years, num_products),
+            'output_of': (years, num_products),
+            'productive_consumption_of': (years, num_products),
+            'accumulation_for_of': (years, num_products, num_products),
+            'capital_stock_for_of': (years, num_products, num_products),
+            'depreciation_in_production_of': (years, num_products, num_products),
+            'flow_for_of': (years, num_products, num_products),
+        }
+
+    def _setup_variable_indices(self):
+        pair_masks = {
+            'accumulation_for_of': self.capital_pairs,
+            'capital_stock_for_of': self.capital_pairs,
+            'depreciation_in_production_of': self.capital_pairs,
+            'flow_for_of': self.flow_pairs,
+        }
+        self.variable_index = {}
+        self.num_variables = 0
+        for family, shape in self.__variable_shapes().items():
+            # -1 marks pairs without a variable
+            created = np.broadcast_to(pair_masks.get(family, True), shape)
+            indices = np.full(shape, -1)
+            indices[created] = np.arange(
+                self.num_variables, self.num_variables + np.count_nonzero(created))
+            self.variable_index[family] = indices
+            self.num_variables += np.count_nonzero(created)
+
+    def __index_variables(self):
+        """variable_index of a model built by setup_variables, read from the variables"""
+        self.variable_index = {}
+        families = self._variable_families()
+        for family, shape in self.__variable_shapes().items():
+            variables = families[family]
+            indices = np.full(shape, -1)
+            for y in range(self.years):
+                if len(shape) == 1:
+                    indices[y] = variables[y].index()
+                    continue
+                for i, p in enumerate(self.products):
+                    if len(shape) == 2:
+                        indices[y, i] = variables[y][p].index()
+                        continue
+                    for j, q in enumerate(self.products):
+                        if q in variables[y][p]:
+                            indices[y, i, j] = variables[y][p][q].index()
+            self.variable_index[family] = indices
+        self.num_variables = self.solver.NumVariables()
+
+    def __variable_names(self):
+        names = [''] * self.num_variables
+        index = self.variable_index
+        for y in range(self.years):
+            names[index['target_fulfillment_in_year'][y]] = f"target_fulfillment_in_year_{y}"
+            names[index['labor_in_year'][y]] = f"labor_in_year_{y}"
+            for i, p in enumerate(self.products):
+                names[index['accumulation_of'][y, i]] = f"accumulation_of_{p}_year_{y}"
+                names[index['final_consumption_of'][y, i]] = f"final_consumption_of_{p}_year_{y}"
+                names[index['labor_for'][y, i]] = f"labor_for_{p}_year_{y}"
+                names[index['output_of'][y, i]] = f"output_of_{p}_year_{y}"
+                names[index['productive_consumption_of'][y, i]] = \
+                    f"productive_comsumption_of_{p}_year_{y}"
+                for j, q in enumerate(self.products):
+                    if self.capital_pairs[i, j]:
+                        names[index['accumulation_for_of'][y, i, j]] = \
+                            f"accumulation_for_{p}_of_{q}_year_{y}"
+                        names[index['capital_stock_for_of'][y, i, j]] = \
+                            f"capital_stock_for_{p}_of_{q}_year_{y}"
+                        names[index['depreciation_in_production_of'][y, i, j]] = \
+                            f"depreciation_in_{p}_production_of_{q}_year_{y}"
+                    if self.flow_pairs[i, j]:
+                        names[index['flow_for_of'][y, i, j]] = f"flow_for_{p}_of_{q}_year_{y}"
+        return names
+
+    def __setup_constraint_matrix(self):
+        """same constraints as setup_constraints, built per constraint family on
+        arrays indexed [year, p, q] (io, cap and dep are indexed [q, p]). Returns the
+        matrix and the rows of the constraint families that carry input data,
+        {family: {key: row}}"""
+        index = self.variable_index
+        io, cap, dep = self.io_matrix, self.cap_matrix, self.dep_matrix
+        targets = self.product_targets
+        inf = self.solver.infinity()
+        num_products = len(self.products)
+
+        output_of = index['output_of']
+        labor_for = index['labor_for']
+        accumulation_of = index['accumulation_of']
+        capital_stock_for_of = index['capital_stock_for_of']
+        accumulation_for_of = index['accumulation_for_of']
+        depreciation_in_production_of = index['depreciation_in_production_of']
+        # output_of broadcast over the input product q
+        output_of_pq = np.broadcast_to(output_of[:, :, None], capital_stock_for_of.shape)
+
+        matrix = ConstraintMatrix()
+        # 1. targets given by leontief demand for year
+        y, p = np.nonzero(targets > 0)
+        rows = matrix.add_rows('leontief', 0, inf,
+                               (index['final_consumption_of'][y, p], 1 / targets[y, p]),
+                               (index['target_fulfillment_in_year'][y], -1))
+        constraint_rows = {'leontief': dict(zip(zip(y.tolist(), p.tolist()), rows.tolist()))}
+        # 2. labor total
+        matrix.add_rows('labor_total', 0, inf,
+                        (index['labor_in_year'], 1),
+                        (labor_for, -1))
+        # 3. labor supply
+        rows = matrix.add_rows('labor_supply', -inf, self.labor_supply,
+                               (index['labor_in_year'], 1))
+        constraint_rows['labor_supply'] = dict(enumerate(rows.tolist()))
+        # 4. labor constraint
+        y, p = np.nonzero(np.broadcast_to(self.labor_row != 0, output_of.shape))
+        matrix.add_rows('labor', 0, inf,
+                        (output_of[y, p], -1),
+                        (labor_for[y, p], self.output_per_labor[p]))
+        # 5. accumulation total
+        matrix.add_rows('accumulation_total', 0, inf,
+                        (accumulation_of.ravel(), 1),
+                        (accumulation_for_of.transpose(0, 2, 1).reshape(-1, num_products), -1))
+        # 6. productive consumption
+        matrix.add_rows('productive_consumption', 0, inf,
+                        (index['productive_consumption_of'].ravel(), 1),
+                        (index['flow_for_of'].transpose(0, 2, 1).reshape(-1, num_products), -1))
+        # 7. consumption
+        matrix.add_rows('consumption', 0, inf,
+                        (output_of.ravel(), 1),
+                        (accumulation_of.ravel(), -1),
+                        (index['final_consumption_of'].ravel(), -1),
+                        (index['productive_consumption_of'].ravel(), -1))
+        # 8. output equation
+        y, p, q = np.nonzero(np.broadcast_to(cap.T != 0, capital_stock_for_of.shape))
+        matrix.add_rows('output', 0, inf,
+                        (capital_stock_for_of[y, p, q], self.output_per_cap[q, p]),
+                        (output_of_pq[y, p, q], -1))
+        # 9. flow constraint
+        y, p, q = np.nonzero(np.broadcast_to(io.T != 0, capital_stock_for_of.shape))
+        matrix.add_rows('flow', 0, inf,
+                        (index['flow_for_of'][y, p, q], self.output_per_io[q, p]),
+                        (output_of_pq[y, p, q], -1))
+        # 10. depreciation
+        p, q = np.nonzero(self.capital_pairs)
+        matrix.add_rows('depreciation', 0, 0,
+                        (depreciation_in_production_of[:, p, q].ravel(), 1),
+                        (capital_stock_for_of[:, p, q].ravel(), -np.tile(dep[q, p], self.years)))
+        # 11. accumulation constraint
+        matrix.add_rows('accumulation', 0, inf,
+                        (capital_stock_for_of[:-1, p, q].ravel(), 1),
+                        (accumulation_for_of[:-1, p, q].ravel(), 1),
+                        (depreciation_in_production_of[:-1, p, q].ravel(), -1),
+                        (capital_stock_for_of[1:, p, q].ravel(), -1))
+        # 12. initial capital stocks
+        rows = matrix.add_rows('initial_capital_stocks', -inf, self.initial_capital_stocks[q, p],
+                               (capital_stock_for_of[0, p, q], 1))
+        constraint_rows['initial_capital_stock'] = dict(
+            zip(zip(p.tolist(), q.tolist()), rows.tolist()))
+        return matrix, constraint_rows
+
+    def __setup_model_from_matrix(self, names=True):
+        """builds the same model as setup_variables, setup_constraints and setup_objective
+        but assembles the constraint matrix with numpy and loads it into the solver in bulk.
+        Naming all variables and constraints roughly doubles the build time, so large
+        models that are not printed can skip it"""
+        with self.instrumentation.phase('setup_variables'):
+            self._setup_variable_indices()
+        with self.instrumentation.phase('setup_constraints'):
+            matrix, constraint_rows = self.__setup_constraint_matrix()
+            constraint_matrix = matrix.to_csr(self.num_variables)
+        self.num_nonzeros = constraint_matrix.count_nonzero()
+
+        objective = np.zeros(self.num_variables)
+        objective[self.variable_index['target_fulfillment_in_year']] = 1
+        program = LinearProgram(
+            variable_lower=np.zeros(self.num_variables),
+            variable_upper=np.full(self.num_variables, np.inf),
+            objective=objective,
+            constraint_lower=np.concatenate(matrix.lower_bounds),
+            constraint_upper=np.concatenate(matrix.upper_bounds),
+            constraint_matrix=constraint_matrix,
+            maximize=True,
+            variable_names=self.__variable_names() if names else None,
+            constraint_names=matrix.names if names else None)
+        if names:
+            error = self.solver.LoadModelFromProtoKeepNames(program.to_proto())
+        else:
+            error = self.solver.LoadModelFromProto(program.to_proto())
+        if error:
+            raise ValueError(error)
+        self._bind_variables()
+        self._bind_constraints(constraint_rows)
+
+    def _bind_constraints(self, constraint_rows):
+        """sets the constraints touched by replanning and read by dual_arrays, e.g.
+        self.leontief_constraints, to the solver rows of constraint_rows, which maps
+        'leontief', 'labor_supply' and 'initial_capital_stock' to {key: row}"""
+        constraints = {family: {key: self.solver.constraint(row) for key, row in rows.items()}
+                       for family, rows in constraint_rows.items()}
+        self.leontief_constraints = constraints['leontief']
+        self.labor_supply_constraints = constraints['labor_supply']
+        self.initial_capital_stock_constraints = constraints['initial_capital_stock']
+
+    def _constraint_families(self):
+        return {
+            'leontief': self.leontief_constraints,
+            'labor_supply': self.labor_supply_constraints,
+            'initial_capital_stock': self.initial_capital_stock_constraints,
+        }
+
+    def _bind_variables(self):
+        """fills the per variable family dicts used by format_results and output_result
+        with the solver variables at the positions of self.variable_index"""
+        variables = self.solver.variables()
+        self._set_variable_families()
+        families = self._variable_families()
+        for family, indices in self.variable_index.items():
+            container = families[family]
+            if indices.ndim == 1:
+                for y, i in enumerate(indices):
+                    container[y] = variables[i]
+                continue
+            for y in range(self.years):
+                for pi, p in enumerate(self.products):
+                    if indices.ndim == 2:
+                        container[y][p] = variables[indices[y, pi]]
+                    else:
+                        container[y][p] = {q: variables[i]
+                                           for q, i in zip(self.products, indices[y, pi])
+                                           if i >= 0}
+
+    def _setup_pair_masks(self, sparse=False):
+        """[p, q] masks of the (output p, input q) pairs that get capital stock and flow
+        variables. In sparse mode only pairs with a nonzero capital stock or io coefficient
+        get them. This keeps the optimum since variables of the other pairs are not bound
+        by any output or flow constraint and can stay zero"""
+        if sparse:
+            self.capital_pairs = self.cap_matrix.T != 0
+            self.flow_pairs = self.io_matrix.T != 0
+        else:
+            self.capital_pairs = np.ones_like(self.cap_matrix, dtype=bool)
+            self.flow_pairs = np.ones_like(self.io_matrix, dtype=bool)
+
+    def setup_solver(self, vectorized=False, names=True, sparse=False):
+        """builds the model, vectorized assembles it with numpy and loads it in bulk,
+        sparse leaves out the capital stock and flow variables of unused pairs"""
+        with self.instrumentation.phase('setup'):
+            self.solver = create_solver(self.backend)
+            self.rolling_solution = None
+            self._setup_pair_masks(sparse)
+            self.vectorized = vectorized
+            self.names = names
+            # constraints touched by replanning, keyed by year, (year, p) and (p, q)
+            self.leontief_constraints = {}
+            self.labor_supply_constraints = {}
+            self.initial_capital_stock_constraints = {}
+
+            if vectorized:
+                self.__setup_model_from_matrix(names)
+            else:
+                with self.instrumentation.phase('setup_variables'):
+                    self.setup_variables()
+                with self.instrumentation.phase('setup_constraints'):
+                    self.setup_constraints()
+                    self.setup_objective()
+                model = linear_solver_pb2.MPModelProto()
+                self.solver.ExportModelToProto(model)
+                self.num_nonzeros = self._count_nonzeros(model)
+                self.__index_variables()
+            # format_results replaces the family attributes with solution values
+            self.model_variables = self._variable_families()
+        self._record_model_size()
+
+    def _record_model_size(self):
+        self.instrumentation.record(
+            variables=self.solver.NumVariables(),
+            constraints=self.solver.NumConstraints(),
+            nonzeros=self.num_nonzeros)
+
+    def _count_nonzeros(self, model):
+        return sum(len(constraint.var_index) for constraint in model.constraint)
 
     def print_solver(self):
-        print(self.solver.ExportModelAsLpFormat(obfuscated=False))
         print(f"number of variables: {self.solver.NumVariables()}")
         print(f"number of constraints: {self.solver.NumConstraints()}")
+        print(f"number of nonzeros: {self.num_nonzeros}")
 
-    def solve(self):
-        self.result_status = self.solver.Solve()
+    def write_model(self, path):
+        """the full model in LP or MPS format by the extension of path, .gz compresses,
+        written row by row as it is far too large to print for real economies"""
+        model = linear_solver_pb2.MPModelProto()
+        self.solver.ExportModelToProto(model)
+        model_export.write_model(model, path)
 
-    def format_results(self):
-        self.target_fulfillment_in_year = {
-            y: v.solution_value() for y, v in self.target_fulfillment_in_year.items()}
-        self.labor_in_year = {y: v.solution_value() for y, v in self.labor_in_year.items()}
-        for y in range(self.years):
-            self.accumulation_of[y] = {p: v.solution_value() for p, v in self.accumulation_of[y].items()}
-            self.final_consumption_of[y] = {
-                p: v.solution_value() for p, v in self.final_consumption_of[y].items()}
-            self.labor_for[y] = {p: v.solution_value() for p, v in self.labor_for[y].items()}
-            self.output_of[y] = {p: v.solution_value() for p, v in self.output_of[y].items()}
-            self.productive_consumption_of[y] = {
-                p: v.solution_value() for p, v in self.productive_consumption_of[y].items()}
-
-            for p in self.products:
-                self.accumulation_for_of[y][p] = {
-                    q: v.solution_value() for q, v in self.accumulation_for_of[y][p].items()}
-                self.capital_stock_for_of[y][p] = {
-                    q: v.solution_value() for q, v in self.capital_stock_for_of[y][p].items()}
-                self.depreciation_in_production_of[y][p] = {
-                    q: v.solution_value() for q, v in self.depreciation_in_production_of[y][p].items()}
-                self.flow_for_of[y][p] = {
-                    q: v.solution_value() for q, v in self.flow_for_of[y][p].items()}
-
-    def export_results(self):
-        if self.result_status != pywraplp.Solver.OPTIMAL:
-            print("no optimal solution")
-            return
-
-        self.format_results()
-        df = pd.DataFrame.from_dict(self.target_fulfillment_in_year, orient='index')
-        df.to_csv(f"{self.output_dir}/target_fulfillment_in_year.csv")
-
-        df = pd.DataFrame.from_dict(self.labor_in_year, orient='index')
-        df.to_csv(f"{self.output_dir}/labor_in_year.csv")
-
-        df = pd.DataFrame.from_dict(self.accumulation_of, orient='index')
-        df.to_csv(f"{self.output_dir}/accumulation_of.csv", columns=self.products)
-        df = pd.DataFrame.from_dict(self.final_consumption_of, orient='index')
-        df.to_csv(f"{self.output_dir}/final_consumption_of.csv", columns=self.products)
-        df = pd.DataFrame.from_dict(self.labor_for, orient='index')
-        df.to_csv(f"{self.output_dir}/labor_for.csv", columns=self.products)
-        df = pd.DataFrame.from_dict(self.productive_consumption_of, orient='index')
-        df.to_csv(f"{self.output_dir}/productive_consumption_of.csv", columns=self.products)
-        df = pd.DataFrame.from_dict(self.output_of, orient='index')
-        df.to_csv(f"{self.output_dir}/output_of.csv", columns=self.products)
-
-    def output_result(self):
-        print(f"Found optimal solution? {self.result_status == pywraplp.Solver.OPTIMAL}")
-        print('\nSolution:')
-
-        if self.result_status == pywraplp.Solver.OPTIMAL:
-            for y in range(self.years):
-                print(f"target_fulfillment_in_year_{y}: {self.target_fulfillment_in_year[y]}")
-                print(f"labor_in_year_{y}: {self.labor_in_year[y]}")
-
-                for p in self.products:
-                    print(f"accumulation_of_{p}_year_{y}: {self.accumulation_of[y][p]}")
-                    print(f"final_consumption_of_{p}_year_{y}: {self.final_consumption_of[y][p]}")
-                    print(f"labor_for_{p}_year_{y}: {self.labor_for[y][p]}")
-                    print(f"output_of_{p}_year_{y}: {self.output_of[y][p]}")
-                    print(f"productive_comsumption_of_{p}_year_{y}: {self.productive_consumption_of[y][p]}")
-
-                    for q in self.products:
-                        print(f"accumulation_for_{p}_of_{q}_year_{y}: {self.accumulation_for_of[y][p][q]}")
-                        print(f"capital_stock_for_{p}_of_{q}_year_{y}: {self.capital_stock_for_of[y][p][q]}")
-                        print(f"depreciation_in_{p}_production_of_{q}_year_{y}: "
-                              "{self.depreciation_in_production_of[y][p][q]}")
-                        print(f"flow_for_{q}_of_{q}_year_{y}: {self.flow_for_of[y][p][q]}")
-
-    def __target(self, key, year):
-        return float(self.targets[key][year])
-
-    def __io(self, input_product, output_product):
-        return self.flows[output_product][self.row_map[input_product]]
-
-    def __capital_stock(self, input_product, output_product):
-        return self.cap[output_product][self.row_map[input_product]]
-
-    def __depreciation_rates(self, input_product, output_product):
-        return self.dep[output_product][self.row_map[input_product]]
+    def solve(self):
+        with self.instrumentation.phase('solve'):
+            self.result_status = solve_with_backend(
+                self.solver, self.backend, self.pdlp_options, self.instrumentation)
+        self.instrumentation.record(backend=self.backend, status=self.result_status,
+                                    iterations=self.solver.iterations())
+        # PDLP solves to a tolerance, or only to feasible at a time limit, so how close
+        # it got is reported with the results
+        self.accuracy = None
+        if self.backend == 'pdlp' and self.has_solution():
+            self.accuracy = self.solution_accuracy()
+            self.instrumentation.record(accuracy=self.accuracy)
+
+    def has_solution(self):
+        """optimal, or feasible after a solver limit"""
+        return self.result_status in (pywraplp.Solver.OPTIMAL, pywraplp.Solver.FEASIBLE)
+
+    def solution_accuracy(self):
+        """primal and dual residuals and relative objective gap of the loaded solution,
+        see solver_backends.solution_accuracy"""
+        model = linear_solver_pb2.MPModelProto()
+        self.solver.ExportModelToProto(model)
+        solution = self.solution_response()
+        return solution_accuracy(LinearProgram.from_proto(model), solution.variable_value,
+                                 solution.dual_value if has_duals(self.backend) else None)
+
+    def solution_response(self):
+        """primal values, duals and reduced costs of the last solve, read in one call"""
+        if self.rolling_solution is not None:
+            return self.rolling_solution
+        solution = linear_solver_pb2.MPSolutionResponse()
+        self.solver.FillSolutionResponseProto(solution)
+        return solution
+
+    def solution_values(self):
+        """the values of all variables in solver order"""
+        return np.array(self.solution_response().variable_value)
+
+    def __family_arrays(self, values):
+        # pairs without a variable (sparse mode) are zero
+        return {family: np.where(indices >= 0, values[indices], 0.0)
+                for family, indices in self.variable_index.items()}
+
+    def solution_arrays(self):
+        """the solution of every variable family as an array in the layout of its
+        variable_index, [year], [year, p] or [year, output p, input q]"""
+        return self.__family_arrays(self.solution_values())
+
+    def reduced_cost_arrays(self):
+        """reduced costs in the layout of solution_arrays, the change of the objective
+        per unit that a variable at zero is forced up"""
+        self.__check_duals()
+        return self.__family_arrays(np.array(self.solution_response().reduced_cost))
+
+    def _has_duals(self):
+        # the rows of models cached before their rows were stored are not mapped back
+        # to their input data
+        return (has_duals(self.backend) and self.rolling_solution is None
+                and self.labor_supply_constraints is not None)
+
+    def __check_duals(self):
+        if self.rolling_solution is not None:
+            raise ValueError("a rolling solve has no dual values of the whole horizon")
+        if not has_duals(self.backend):
+            raise ValueError(f"the {self.backend} backend reports no dual values")
+
+    def dual_arrays(self):
+        """dual values of the rows that carry input data, i.e. the objective gained per
+        unit of right hand side: 'leontief' [year, product] for the targets,
+        'labor_supply' [year] and 'initial_capital_stock' [output p, input q].
+        They are zero where the model has no row, e.g. for products without target"""
+        self.__check_duals()
+        if self.labor_supply_constraints is None:
+            raise ValueError("dual values need a model built by setup_solver")
+        duals = np.array(self.solution_response().dual_value)
+        num_products = len(self.products)
+        shapes = {
+            'leontief': (self.years, num_products),
+            'labor_supply': (self.years,),
+            'initial_capital_stock': (num_products, num_products),
+        }
+        arrays = {}
+        for family, shape in shapes.items():
+            arrays[family] = np.zeros(shape)
+            for key, constraint in self._constraint_families()[family].items():
+                arrays[family][key] = duals[constraint.index()]
+        return arrays
@@ -0,0 +1,72 @@
+"""Replanning of a built model: the update methods only touch the bounds and
+coefficients that change, so the next solve() lets GLOP start from the previous basis
+instead of from scratch."""
+
+import numpy as np
+from ortools.linear_solver import pywraplp
+
+
+class ReplanningMixin:
+    """the replanning methods of Planning, which need a model built by setup_solver"""
+
+    def update_targets(self, y, targets):
+        """targets has one value per product in the order of self.products"""
+        variables = self.model_variables
+        for i, target in enumerate(np.asarray(targets, dtype=float)):
+            if target == self.product_targets[y, i]:
+                continue
+            self.product_targets[y, i] = target
+            constraint = self.leontief_constraints.get((y, i))
+            if constraint is None:
+                if target <= 0:
+                    continue
+                constraint = self.solver.Constraint(0, self.solver.infinity(), 'leontief')
+                self.leontief_constraints[(y, i)] = constraint
+            # a target of zero leaves an empty row behind, which can be reused later
+            fulfillment_coefficient = -1 if target > 0 else 0
+            constraint.SetCoefficient(
+                variables['final_consumption_of'][y][self.products[i]],
+                1/target if target > 0 else 0)
+            constraint.SetCoefficient(
+                variables['target_fulfillment_in_year'][y], fulfillment_coefficient)
+
+    def update_labor_supply(self, y, labor):
+        """the labor supply of year y"""
+        self.labor_supply[y] = labor
+        self.labor_supply_constraints[y].SetUb(labor)
+
+    def update_initial_capital_stocks(self, capital_stocks):
+        """capital_stocks is indexed [input q, output p] like self.cap_matrix"""
+        capital_stocks = np.asarray(capital_stocks, dtype=float)
+        for q, p in zip(*np.nonzero(capital_stocks != self.initial_capital_stocks)):
+            constraint = self.initial_capital_stock_constraints.get((p, q))
+            if constraint is None:
+                raise ValueError(f"no capital stock variables for {self.products[p]} of "
+                                 f"{self.products[q]} in the sparse model, setup_solver has to "
+                                 "be called again")
+            constraint.SetUb(capital_stocks[q, p])
+        self.initial_capital_stocks = capital_stocks.copy()
+
+    def shift_horizon(self, targets, labor):
+        """rolls the plan forward by one year: the planned capital stocks of year 1 become the
+        initial capital stocks, the remaining years move up and the given targets and labor
+        supply form the new last year"""
+        if self.result_status != pywraplp.Solver.OPTIMAL:
+            raise ValueError("the horizon can only be shifted after an optimal solve")
+        capital_stocks = self._solution_matrix(
+            self.model_variables['capital_stock_for_of'][min(1, self.years - 1)])
+        product_targets = np.vstack([self.product_targets[1:], np.asarray(targets, dtype=float)])
+        labor_supply = np.append(self.labor_supply[1:], labor)
+        for y in range(self.years):
+            self.update_targets(y, product_targets[y])
+            self.update_labor_supply(y, labor_supply[y])
+        self.update_initial_capital_stocks(capital_stocks)
+
+    def _solution_matrix(self, variables):
+        # [input q, output p] matrix of the solution values of a [p][q] variable family year
+        values = np.zeros((len(self.products), len(self.products)))
+        for i, p in enumerate(self.products):
+            for j, q in enumerate(self.products):
+                if q in variables[p]:
+                    values[j, i] = variables[p][q].solution_value()
+        return values
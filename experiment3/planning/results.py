@@ -0,0 +1,169 @@
+"""The solution of a Planning as nested dicts, printed, as one long table or
+exported to csv, parquet or npz files."""
+
+import numpy as np
+import pandas as pd
+from ortools.linear_solver import pywraplp
+
+
+class ResultsMixin:
+    """the result formatting and export methods of Planning"""
+
+    def format_results(self):
+        """replaces the variable family attributes by nested dicts of solution values,
+        {y: value}, {y: {p: value}} and {y: {p: {q: value}}}"""
+        families = {}
+        for family, values in self.solution_arrays().items():
+            values = values.tolist()
+            if np.ndim(values) == 1:
+                families[family] = dict(enumerate(values))
+            elif np.ndim(values) == 2:
+                families[family] = {y: dict(zip(self.products, row))
+                                    for y, row in enumerate(values)}
+            else:
+                families[family] = {
+                    y: {p: dict(zip(self.products, row)) for p, row in zip(self.products, year)}
+                    for y, year in enumerate(values)}
+        self._set_variable_families(families)
+
+    def results_table(self):
+        """all variable families as one long table with a row per variable and its
+        reduced cost, followed by the dual_arrays as families dual_<row family>.
+        Product and input are empty for families without them, products dropped by
+        presolve have no rows but stay categories"""
+        solution, reduced_costs, duals = self._solution_with_duals()
+        tables = []
+        for family, values in solution.items():
+            coordinates = np.nonzero(self.variable_index[family] >= 0)
+            tables.append(self._long_table(family, coordinates, values, reduced_costs.get(family)))
+        for family, values in duals.items():
+            coordinates = np.nonzero(np.ones_like(values, dtype=bool))
+            if family == 'initial_capital_stock':
+                # the initial stocks bind the capital stocks of the first year
+                coordinates = (np.zeros_like(coordinates[0]),) + coordinates
+            tables.append(self._long_table(f"dual_{family}", coordinates, values))
+        table = pd.concat(tables, ignore_index=True)
+        table['family'] = pd.Categorical(table['family'],
+                                         categories=list(dict.fromkeys(table['family'])))
+        for column in ['product', 'input']:
+            table[column] = pd.Categorical(table[column], categories=self.input_products)
+        return table
+
+    def _solution_with_duals(self):
+        # backends without duals and rolling solves export the primal solution only
+        if not self._has_duals():
+            return self.solution_arrays(), {}, {}
+        return self.solution_arrays(), self.reduced_cost_arrays(), self.dual_arrays()
+
+    def _expanded_results(self):
+        """__solution_with_duals over the input_products, zero for the ones presolve dropped"""
+        solution, reduced_costs, duals = self._solution_with_duals()
+        product_axes = {'labor_supply': (), 'leontief': (1,), 'initial_capital_stock': (0, 1)}
+        return ({family: self._expand(values, range(1, values.ndim))
+                 for family, values in solution.items()},
+                {family: self._expand(values, range(1, values.ndim))
+                 for family, values in reduced_costs.items()},
+                {family: self._expand(values, product_axes[family])
+                 for family, values in duals.items()})
+
+    def _expand(self, values, product_axes):
+        if len(self.kept_products) == len(self.input_products):
+            return values
+        shape = [len(self.input_products) if axis in product_axes else size
+                 for axis, size in enumerate(values.shape)]
+        expanded = np.zeros(shape, dtype=values.dtype)
+        expanded[np.ix_(*[self.kept_products if axis in product_axes else np.arange(size)
+                          for axis, size in enumerate(values.shape)])] = values
+        return expanded
+
+    def _long_table(self, family, coordinates, values, reduced_costs=None):
+        products = np.array(self.products, dtype=object)
+        return pd.DataFrame({
+            'family': family,
+            'year': coordinates[0],
+            'product': products[coordinates[1]] if len(coordinates) > 1 else None,
+            'input': products[coordinates[2]] if len(coordinates) > 2 else None,
+            'value': values[coordinates[-values.ndim:]],
+            'reduced_cost': reduced_costs[coordinates] if reduced_costs is not None else np.nan,
+        })
+
+    def export_results(self, file_format='csv'):
+        """csv writes one file per year or [year, product] family and its reduced costs,
+        and one per dual_arrays family. parquet writes every family, including the
+        [year, p, q] ones, to results.parquet (see results_table), npz writes the
+        solution_arrays, reduced_cost_<family> and dual_<family> arrays to results.npz.
+        The accuracy of a pdlp solve goes to accuracy.csv for every format"""
+        if not self.has_solution():
+            print("no optimal solution")
+            return
+
+        with self.instrumentation.phase('export'):
+            self._export_results(file_format)
+            if self.accuracy:
+                pd.Series(self.accuracy, name='value').to_csv(
+                    f"{self.output_dir}/accuracy.csv", index_label='measure')
+
+    def _export_results(self, file_format):
+        if file_format == 'parquet':
+            self.results_table().to_parquet(f"{self.output_dir}/results.parquet", index=False)
+            return
+        solution, reduced_costs, duals = self._expanded_results()
+        if file_format == 'npz':
+            np.savez_compressed(
+                f"{self.output_dir}/results.npz", products=np.array(self.input_products),
+                **solution,
+                **{f"reduced_cost_{family}": values for family, values in reduced_costs.items()},
+                **{f"dual_{family}": values for family, values in duals.items()})
+            return
+        if file_format != 'csv':
+            raise ValueError(f"unknown result format {file_format}")
+        for family in ['target_fulfillment_in_year', 'labor_in_year']:
+            pd.DataFrame(solution[family]).to_csv(f"{self.output_dir}/{family}.csv")
+        for family in ['accumulation_of', 'final_consumption_of', 'labor_for',
+                       'productive_consumption_of', 'output_of']:
+            pd.DataFrame(solution[family], columns=self.input_products).to_csv(
+                f"{self.output_dir}/{family}.csv")
+        if not duals:
+            return
+        for family in ['target_fulfillment_in_year', 'labor_in_year']:
+            pd.DataFrame(reduced_costs[family]).to_csv(
+                f"{self.output_dir}/reduced_cost_of_{family}.csv")
+        for family in ['accumulation_of', 'final_consumption_of', 'labor_for',
+                       'productive_consumption_of', 'output_of']:
+            pd.DataFrame(reduced_costs[family], columns=self.input_products).to_csv(
+                f"{self.output_dir}/reduced_cost_of_{family}.csv")
+        pd.DataFrame(duals['labor_supply']).to_csv(f"{self.output_dir}/dual_of_labor_supply.csv")
+        pd.DataFrame(duals['leontief'], columns=self.input_products).to_csv(
+            f"{self.output_dir}/dual_of_leontief.csv")
+        # rows are the output products, columns the capital goods they hold
+        pd.DataFrame(duals['initial_capital_stock'], index=self.input_products,
+                     columns=self.input_products).to_csv(
+            f"{self.output_dir}/dual_of_initial_capital_stock.csv")
+
+    def output_result(self):
+        print(f"Found optimal solution? {self.result_status == pywraplp.Solver.OPTIMAL}")
+        if self.accuracy:
+            print(", ".join(f"{measure}: {value:.3g}" for measure, value in self.accuracy.items()))
+        print('\nSolution:')
+
+        if self.has_solution():
+            for y in range(self.years):
+                print(f"target_fulfillment_in_year_{y}: {self.target_fulfillment_in_year[y]}")
+                print(f"labor_in_year_{y}: {self.labor_in_year[y]}")
+
+                for p in self.products:
+                    print(f"accumulation_of_{p}_year_{y}: {self.accumulation_of[y][p]}")
+                    print(f"final_consumption_of_{p}_year_{y}: {self.final_consumption_of[y][p]}")
+                    print(f"labor_for_{p}_year_{y}: {self.labor_for[y][p]}")
+                    print(f"output_of_{p}_year_{y}: {self.output_of[y][p]}")
+                    print(f"productive_comsumption_of_{p}_year_{y}: "
+                          f"{self.productive_consumption_of[y][p]}")
+
+                    for q in self.products:
+                        print(f"accumulation_for_{p}_of_{q}_year_{y}: "
+                              f"{self.accumulation_for_of[y][p].get(q, 0.0)}")
+                        print(f"capital_stock_for_{p}_of_{q}_year_{y}: "
+                              f"{self.capital_stock_for_of[y][p].get(q, 0.0)}")
+                        print(f"depreciation_in_{p}_production_of_{q}_year_{y}: "
+                              "{self.depreciation_in_production_of[y][p].get(q, 0.0)}")
+                        print(f"flow_for_{q}_of_{q}_year_{y}: {self.flow_for_of[y][p].get(q, 0.0)}")
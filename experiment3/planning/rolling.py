@@ -0,0 +1,64 @@
+"""Solves the plan of one input folder in overlapping windows of years, see
+Planning.solve_rolling, and reports the objective gap against the monolithic solve:
+    python -m planning.rolling uk_data out/rolling 3 1
+writes the rolling plan to the output folder like plan.py and a table with objective,
+status, wall time, model size and resident memory of both solves, together with the
+relative gap, to rolling_gap.csv. The rolling plan is solved first, so the resident
+memory high-water mark it reports is its own. With a fifth argument no-compare only
+the rolling plan is solved, e.g. for horizons too long for one model."""
+
+import os
+import sys
+import time
+import more_itertools as mit
+import pandas as pd
+from planning_common.instrumentation import Instrumentation, max_rss_bytes
+from planning.planning import Planning
+
+
+def solve(input_dir, output_dir, window=None, overlap=1):
+    """the solved Planning and its report row, the monolithic model without window"""
+    instrumentation = Instrumentation()
+    planning = Planning(input_dir, output_dir, instrumentation)
+    planning.import_example_data()
+    start = time.perf_counter()
+    if window:
+        planning.solve_rolling(window, overlap)
+    else:
+        planning.setup_solver(vectorized=True, names=False, sparse=True)
+        planning.solve()
+    row = {
+        'solve': f"rolling {window}/{overlap}" if window else 'monolithic',
+        'status': planning.result_status,
+        'objective': (planning.solution_response().objective_value
+                      if planning.has_solution() else None),
+        'wall_time': time.perf_counter() - start,
+        'variables': instrumentation.values['variables'],
+        'nonzeros': instrumentation.values['nonzeros'],
+        'max_rss_bytes': max_rss_bytes(),
+    }
+    return planning, row
+
+
+def main():
+    input_dir = mit.nth(sys.argv, 1, 'test_data')
+    output_dir = mit.nth(sys.argv, 2, 'out/rolling')
+    window = int(mit.nth(sys.argv, 3, 3))
+    overlap = int(mit.nth(sys.argv, 4, 1))
+    compare = mit.nth(sys.argv, 5, 'compare') != 'no-compare'
+    os.makedirs(output_dir, exist_ok=True)
+
+    planning, row = solve(input_dir, output_dir, window, overlap)
+    planning.export_results()
+    rows = [row]
+    if compare:
+        rows.append(solve(input_dir, output_dir)[1])
+    report = pd.DataFrame(rows).set_index('solve')
+    if compare and report['objective'].notna().all():
+        optimum = report.loc['monolithic', 'objective']
+        report['gap'] = (optimum - report['objective']) / abs(optimum)
+    report.to_csv(f"{output_dir}/rolling_gap.csv")
+    print(report.to_string())
+
+if __name__ == '__main__':
+    main()
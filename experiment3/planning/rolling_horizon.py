@@ -0,0 +1,91 @@
+"""Solving a long planning horizon as a sequence of short windows, see
+RollingHorizonMixin.solve_rolling and rolling.py."""
+
+import copy
+import numpy as np
+from ortools.linear_solver import linear_solver_pb2
+from ortools.linear_solver import pywraplp
+
+
+class RollingHorizonMixin:
+    """the rolling horizon solve of Planning"""
+
+    def solve_rolling(self, window, overlap=1, sparse=True, steady_state=True):
+        """solves a long horizon as a sequence of windows of window years instead of one
+        model: each window starts from the capital stocks its previous years leave and
+        keeps its first window - overlap years, the last window ends at the horizon. Only
+        one window model is built and re-solved with the replanning updates, so memory
+        and solve time grow with window instead of self.years. The overlap years and,
+        with steady_state, accumulation of at least the depreciation in the last year
+        of every window but the final one keep a window from running down the capital
+        its successor needs. The kept years form a feasible plan of the whole horizon,
+        so result_status is FEASIBLE and the objective is at most the optimum, see
+        rolling.py for the gap. Like a loaded model, the result has no dual values and
+        cannot be replanned"""
+        if not 0 < overlap < window:
+            raise ValueError("the overlap has to be at least one year and shorter than the window")
+        window = min(window, self.years)
+        self._setup_pair_masks(sparse)
+        self._setup_variable_indices()
+        values = np.zeros(self.num_variables)
+
+        # the window shares the coefficients, backend and instrumentation
+        plan = copy.copy(self)
+        plan.years = window
+        plan.product_targets = self.product_targets[:window].copy()
+        plan.labor_supply = self.labor_supply[:window].copy()
+        plan.setup_solver(vectorized=True, names=False, sparse=sparse)
+        steady_state_rows = self._add_steady_state_rows(plan, window - 1) if steady_state else []
+        starts = list(range(0, self.years - window, window - overlap)) + [self.years - window]
+        for start, end in zip(starts, starts[1:] + [self.years]):
+            if start > 0:
+                for y in range(window):
+                    plan.update_targets(y, self.product_targets[start + y])
+                    plan.update_labor_supply(y, self.labor_supply[start + y])
+                plan.update_initial_capital_stocks(self._carried_capital_stocks(values, start - 1))
+            if end == self.years:
+                # the final window ends with the horizon, like the monolithic model
+                for row in steady_state_rows:
+                    row.SetLb(-plan.solver.infinity())
+            plan.solve()
+            if not plan.has_solution():
+                self.result_status = plan.result_status
+                return
+            # the years up to the next window's start are kept
+            window_values = plan.solution_values()
+            for family, indices in self.variable_index.items():
+                kept, planned = indices[start:end], plan.variable_index[family][:end - start]
+                values[kept[kept >= 0]] = window_values[planned[planned >= 0]]
+
+        self.result_status = pywraplp.Solver.FEASIBLE
+        self.rolling_solution = linear_solver_pb2.MPSolutionResponse(
+            status=linear_solver_pb2.MPSOLVER_FEASIBLE,
+            objective_value=values[self.variable_index['target_fulfillment_in_year']].sum())
+        self.rolling_solution.variable_value.extend(values)
+        self.instrumentation.record(windows=len(starts), window=window, overlap=overlap,
+                                    objective=self.rolling_solution.objective_value)
+
+    @staticmethod
+    def _add_steady_state_rows(plan, y):
+        # accumulation_for_of >= depreciation_in_production_of in year y of the window
+        # model plan, one row per pair
+        variables = plan.solver.variables()
+        accumulation = plan.variable_index['accumulation_for_of'][y]
+        depreciation = plan.variable_index['depreciation_in_production_of'][y]
+        rows = []
+        for i, j in zip(*np.nonzero(plan.capital_pairs)):
+            row = plan.solver.Constraint(0, plan.solver.infinity(), 'steady_state')
+            row.SetCoefficient(variables[accumulation[i, j]], 1)
+            row.SetCoefficient(variables[depreciation[i, j]], -1)
+            rows.append(row)
+        return rows
+
+    def _carried_capital_stocks(self, values, y):
+        # what constraint 11 lets year y pass on, stock + accumulation - depreciation,
+        # [input q, output p] like self.cap_matrix
+        stock, accumulation, depreciation = (
+            np.where(indices >= 0, values[indices], 0.0) for indices in (
+                self.variable_index[family][y]
+                for family in ['capital_stock_for_of', 'accumulation_for_of',
+                               'depreciation_in_production_of']))
+        return np.maximum(stock + accumulation - depreciation, 0).T
@@ -0,0 +1,88 @@
+"""Saving a built model with its variable layout and loading it back without the
+input data, the serialized parts that planning_common.model_cache stores."""
+
+import json
+import numpy as np
+from ortools.linear_solver import linear_solver_pb2
+from ortools.linear_solver import pywraplp
+from planning_common.solver_backends import create_solver
+
+
+class StoredModelMixin:
+    """the model cache methods of Planning"""
+
+    def model_proto(self):
+        """the serialized MPModelProto of the model, for the model cache"""
+        model = linear_solver_pb2.MPModelProto()
+        self.solver.ExportModelToProto(model)
+        return model.SerializeToString()
+
+    def model_metadata(self):
+        """what load_model needs besides the proto to map the variables back to products"""
+        if not self.vectorized:
+            raise ValueError("only models built with vectorized=True have a stored variable layout")
+        return json.dumps({
+            'products': self.products,
+            'input_products': self.input_products,
+            'kept_products': self.kept_products.tolist(),
+            'years': self.years,
+            'names': self.names,
+            'capital_pairs': self.capital_pairs.tolist(),
+            'flow_pairs': self.flow_pairs.tolist(),
+            # the rows of the dual values, as [key..., row] lists since json has no tuple keys
+            'constraint_rows': {
+                family: [[*np.atleast_1d(key).tolist(), constraint.index()]
+                         for key, constraint in constraints.items()]
+                for family, constraints in self._constraint_families().items()},
+        }).encode()
+
+    def solution_proto(self):
+        """the serialized MPSolutionResponse of the last solve, for the model cache"""
+        solution = linear_solver_pb2.MPSolutionResponse()
+        self.solver.FillSolutionResponseProto(solution)
+        return solution.SerializeToString()
+
+    def load_model(self, model, metadata, solution=None):
+        """restores a model saved with model_proto and model_metadata (and optionally its
+        optimal solution from solution_proto) without reading the input data. The loaded
+        model can be solved and exported, with dual values, but not replanned"""
+        with self.instrumentation.phase('load_model'):
+            self._load_model(model, metadata, solution)
+        self._record_model_size()
+
+    def _load_model(self, model, metadata, solution):
+        metadata = json.loads(metadata)
+        self.products = metadata['products']
+        self.input_products = metadata.get('input_products', self.products)
+        self.kept_products = np.array(
+            metadata.get('kept_products', range(len(self.products))), dtype=int)
+        self.years = metadata['years']
+        self.names = metadata['names']
+        self.vectorized = True
+        self.capital_pairs = np.array(metadata['capital_pairs'], dtype=bool)
+        self.flow_pairs = np.array(metadata['flow_pairs'], dtype=bool)
+
+        self.solver = create_solver(self.backend)
+        model = linear_solver_pb2.MPModelProto.FromString(model)
+        self.num_nonzeros = self._count_nonzeros(model)
+        if self.names:
+            error = self.solver.LoadModelFromProtoKeepNames(model)
+        else:
+            error = self.solver.LoadModelFromProto(model)
+        if error:
+            raise ValueError(error)
+        self._setup_variable_indices()
+        self._bind_variables()
+        self.model_variables = self._variable_families()
+        self.leontief_constraints = None
+        self.labor_supply_constraints = None
+        self.initial_capital_stock_constraints = None
+        if 'constraint_rows' in metadata:
+            self._bind_constraints({
+                family: {(tuple(key) if len(key) > 1 else key[0]): row for *key, row in rows}
+                for family, rows in metadata['constraint_rows'].items()})
+
+        if solution is not None:
+            self.solver.LoadSolutionFromProto(
+                linear_solver_pb2.MPSolutionResponse.FromString(solution))
+            self.result_status = pywraplp.Solver.OPTIMAL
@@ -0,0 +1,50 @@
+"""Solves the five year plan of one input folder for every scenario of a sweep spec,
+see planning_common.sweep, and writes one row per scenario:
+    python -m planning.sweep test_data sweep.json out/sweep.csv [workers]
+A scenario overrides the arguments of Planning.scale_parameters, the targets and
+labor supply scales and the depreciation scale, one multiplier or one per product.
+Its row holds the overrides, the solver status and, for an optimal plan, the summed
+target fulfillment, the labor of all years and the target fulfillment of the worst
+year, together with the wall time of the scenario."""
+
+import json
+import sys
+import time
+import more_itertools as mit
+from ortools.linear_solver import pywraplp
+from planning_common.sweep import run_sweep, scenarios_from_spec
+from planning.planning import Planning
+
+
+def solve_scenario(input_dir, overrides):
+    """solves one scenario and returns its summary row"""
+    start = time.perf_counter()
+    planning = Planning(input_dir, None)
+    planning.import_example_data()
+    planning.scale_parameters(**overrides)
+    planning.setup_solver(vectorized=True, names=False)
+    planning.solve()
+    row = {**{key: json.dumps(value) for key, value in overrides.items()},
+           'status': planning.result_status}
+    if planning.result_status == pywraplp.Solver.OPTIMAL:
+        planning.format_results()
+        row['objective'] = planning.solver.Objective().Value()
+        row['total_labor'] = sum(planning.labor_in_year.values())
+        row['min_target_fulfillment'] = min(planning.target_fulfillment_in_year.values())
+    row['wall_time'] = time.perf_counter() - start
+    return row
+
+
+def main():
+    input_dir = mit.nth(sys.argv, 1, 'test_data')
+    spec_file = mit.nth(sys.argv, 2, 'sweep.json')
+    results_file = mit.nth(sys.argv, 3, 'out/sweep.csv')
+    max_workers = mit.nth(sys.argv, 4, None)
+    with open(spec_file, encoding='utf-8') as spec:
+        scenarios = scenarios_from_spec(json.load(spec))
+
+    run_sweep(solve_scenario, input_dir, scenarios, results_file,
+              None if max_workers is None else int(max_workers))
+
+if __name__ == '__main__':
+    main()
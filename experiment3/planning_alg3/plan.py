@@ -9,9 +9,24 @@ from planning import Planning
 def main():
     input_dir = mit.nth(sys.argv, 1, 'test_data')
     output_dir = mit.nth(sys.argv, 2, 'out/test_data')
-    planning = Planning(input_dir, output_dir)
+    # 'leontief', 'leontief_jacobi' or 'leontief_gmres' for the iterative solvers of large
+    # tables, 'random' or the output directory of a planning/plan.py run
+    initializer = mit.nth(sys.argv, 3, 'leontief')
+    seed = mit.nth(sys.argv, 4, None)
+    # any further arguments are targets files harmonized together as one batch of scenarios
+    scenario_files = sys.argv[5:]
+    leontief_method = initializer.removeprefix('leontief_') if initializer.startswith('leontief_') else 'lu'
+    planning = Planning(input_dir, output_dir, leontief_method=leontief_method)
     planning.import_data()
-    planning.harmonize()
+    if scenario_files:
+        planning.import_scenarios(scenario_files)
+    if initializer.startswith('leontief'):
+        initial_weights = planning.leontief_weights()
+    elif initializer == 'random':
+        initial_weights = planning.random_weights(None if seed is None else int(seed))
+    else:
+        initial_weights = planning.lp_weights(initializer)
+    planning.harmonize(initial_weights=initial_weights)
     planning.export_results()
 
 if __name__ == '__main__':
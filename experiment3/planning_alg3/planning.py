@@ -1,16 +1,29 @@
 from collections import defaultdict
 import pandas as pd
 import numpy as np
-import math
-import sys
+import os
+import time
 import pdb
+from planning_common.instrumentation import Instrumentation
+from planning_common.leontief import leontief_solver
 
 class Planning:
-    def __init__(self, input_dir, output_dir):
+    def __init__(self, input_dir, output_dir, instrumentation=None, leontief_method='lu', leontief_options=None):
+        """leontief_method is lu, jacobi or gmres, leontief_options the tolerance and
+        max_iterations of the iterative ones, see planning_common/leontief.py"""
         self.input_dir = input_dir
         self.output_dir = output_dir
+        self.instrumentation = instrumentation or Instrumentation()
+        self.leontief_method = leontief_method
+        self.leontief_options = leontief_options or {}
 
     def import_data(self):
+        with self.instrumentation.phase('import'):
+            self.__import_data()
+        self.instrumentation.record(products=self.num_products, years=self.years,
+                                    nonzeros=int(np.count_nonzero(self.flows)))
+
+    def __import_data(self):
         self.flows = pd.read_csv(f"{self.input_dir}/flows.csv")
         rows = list(self.flows['headings'])
         self.products = list(self.flows)[1:]
@@ -21,70 +34,279 @@ class Planning:
         self.years = self.targets.shape[0]
         # strip year and labor column
         self.product_targets = np.array(self.targets)[:,1:(self.num_products + 1)].astype(float)
+        self.labor_supply = np.array(self.targets['labor']).astype(float)
+        self.scenarios = None
+
+    def import_scenarios(self, target_files):
+        """switch to batched mode: every targets file (laid out like targets.csv) is one
+        scenario, product_targets becomes a scenario x year x product tensor and every
+        calc_* step evaluates all scenarios at once"""
+        targets = [pd.read_csv(target_file) for target_file in target_files]
+        self.scenarios = [os.path.splitext(os.path.basename(target_file))[0] for target_file in target_files]
+        self.product_targets = np.stack(
+                [np.array(t)[:,1:(self.num_products + 1)].astype(float) for t in targets])
+        self.labor_supply = np.stack([np.array(t['labor']).astype(float) for t in targets])
+        self.years = self.product_targets.shape[1]
 
-    def harmonize(self):
-        # random initial production weights
-        self.production_weights = 100 * np.random.rand(5, self.num_products)
+    # Armijo backtracking: a step is taken once it raises the mean harmony by at least
+    # this share of the increase the gradient predicts for it
+    ARMIJO_SHARE = 1e-4
+    MAX_BACKTRACKS = 50
 
-        for i in range(1, 10):
-          self.calc_outputs()
-          self.calc_harmony()
-          self.calc_labor()
-          self.calc_target_fulfillment()
-          self.adjust_production_weights()
+    def harmonize(self, step_size=1.0, tolerance=1e-9, max_iterations=1000, initial_weights=None):
+        """projected gradient ascent on the mean harmony: every iteration moves the production
+        weights along the harmony gradient divided by harmony_curvature and projects them
+        back on the labor supply. step_size is the first step, 1 is the diagonal Newton
+        step. A step is halved until it raises the mean harmony enough (Armijo) and
+        doubled after it is taken, so the mean harmony never falls and the weights end on
+        the best iterate seen. The mean harmony is concave in the weights, so this converges
+        to the best plan for the labor supply. Stops once the mean harmony changes by less
+        than tolerance, which includes no step raising it. self.history records mean
+        harmony, gradient norm, step and elapsed wall time per iteration. initial_weights
+        defaults to random_weights(), see also leontief_weights and lp_weights"""
+        with self.instrumentation.phase('solve'):
+            self.__harmonize(step_size, tolerance, max_iterations, initial_weights)
+        self.instrumentation.record(iterations=len(self.history), converged=self.converged,
+                                    mean_harmony=np.asarray(self.mean_harmony).tolist())
 
-    def adjust_production_weights(self):
-        self.equalise_harmony()
+    def __harmonize(self, step_size, tolerance, max_iterations, initial_weights):
+        if initial_weights is None:
+            initial_weights = self.random_weights()
+        # weights shared by all scenarios are copied into each of them
+        self.production_weights = np.broadcast_to(
+                np.asarray(initial_weights, dtype=float), self.product_targets.shape).copy()
         self.rescale_intensity()
+        self.__evaluate()
+        # one step per scenario in batched mode
+        step = np.full_like(self.mean_harmony, step_size)
+
+        self.history = []
+        self.converged = False
+        start = time.perf_counter()
+        for i in range(max_iterations):
+            self.history.append({
+                'iteration': i,
+                'mean_harmony': self.mean_harmony,
+                'gradient_norm': self.__norm(self.weight_gradient),
+                'step': step,
+                'wall_time': time.perf_counter() - start,
+            })
+            # in batched mode the mean harmony has one entry per scenario, all have to settle
+            if i > 0 and np.all(abs(self.mean_harmony - self.history[-2]['mean_harmony']) < tolerance):
+                self.converged = True
+                break
+            step = self.adjust_production_weights(step)
+
+    def __evaluate(self):
+        self.calc_outputs()
+        self.calc_harmony()
+        self.calc_labor()
+        self.calc_target_fulfillment()
+        self.calc_weight_gradient()
+
+    def __norm(self, values):
+        return np.sqrt(np.sum(values**2, axis=(-2, -1)))
+
+    def random_weights(self, seed=None):
+        return 100 * np.random.default_rng(seed).random(self.product_targets.shape)
+
+    def leontief_weights(self):
+        """weights whose final consumption is exactly the targets, i.e. the gross output
+        (I - A)^-1 targets in units of each product's recipe in the flows table"""
+        try:
+            weights = self.gross_output(self.product_targets) / self.__output_row()
+        except ValueError:
+            # final consumption = weights * output - weights @ flows.T = targets
+            leontief_matrix = np.diag(self.__output_row()) - self.__product_flow_matrix()
+            targets = self.product_targets.reshape(-1, self.num_products).T
+            weights = np.linalg.lstsq(leontief_matrix, targets, rcond=None)[0].T.reshape(self.product_targets.shape)
+        # a non-productive flow table can need negative production, which is not allowed
+        return np.maximum(weights, 0)
+
+    def technology_matrix(self):
+        """A[input q, output p], the amount of q used per unit of gross output of p"""
+        output = self.__output_row()
+        if (output == 0).any():
+            raise ValueError("products without output in the flows table have no technology coefficients")
+        return self.__product_flow_matrix() / output
+
+    def leontief_solver(self):
+        """the cached factorization of I - A or an iterative solver, by leontief_method"""
+        return leontief_solver(self.technology_matrix(), self.leontief_method, **self.leontief_options)
+
+    def gross_output(self, final_demand):
+        """the gross output that leaves final_demand for final consumption, for one demand
+        vector or a batch along the last axis such as product_targets, see planning_common/leontief.py"""
+        return self.__leontief_solve('gross_output', final_demand)
+
+    def labor_values(self):
+        """the direct and indirect labor per unit of final consumption of each product"""
+        return self.__leontief_solve('labor_values', self.__labor_row() / self.__output_row())
 
-    def equalise_harmony(self):
-        return 1
+    def __leontief_solve(self, quantity, values):
+        solver = self.leontief_solver()
+        result = getattr(solver, quantity)(values)
+        if getattr(solver, 'error', None):
+            # the residual and error bound of the iterative solvers
+            self.instrumentation.record(leontief_error=solver.error)
+        return result
+
+    def lp_weights(self, lp_output_dir):
+        """weights from the output_of.csv the linear programming planner in planning/ wrote"""
+        output_of = pd.read_csv(f"{lp_output_dir}/output_of.csv", index_col=0)
+        return np.divide(output_of[self.products].to_numpy(dtype=float), self.__output_row())
+
+    def adjust_production_weights(self, step):
+        """one Armijo step per scenario from the current weights, see harmonize. Scenarios
+        that no step of at least step / 2**MAX_BACKTRACKS improves keep their weights.
+        Returns the step for the next iteration"""
+        weights, gradient, harmony = self.production_weights, self.weight_gradient, self.mean_harmony
+        curvature = self.harmony_curvature()
+        step = np.asarray(step, dtype=float)
+        for _ in range(self.MAX_BACKTRACKS):
+            self.production_weights = weights
+            self.equalise_harmony(step[..., np.newaxis, np.newaxis], gradient, curvature)
+            self.calc_outputs()
+            self.calc_harmony()
+            # the gradient is the one of the summed harmony, the prediction is averaged
+            # over the years and products of a scenario like the mean harmony
+            predicted = (np.sum(gradient * (self.production_weights - weights), axis=(-2, -1))
+                         / np.prod(gradient.shape[-2:]))
+            accepted = self.mean_harmony >= harmony + self.ARMIJO_SHARE * predicted
+            if accepted.all():
+                break
+            step = np.where(accepted, step, step / 2)
+        self.production_weights = np.where(accepted[..., np.newaxis, np.newaxis], self.production_weights, weights)
+        self.__evaluate()
+        return np.where(accepted, 2 * step, step)
+
+    def equalise_harmony(self, step, gradient, curvature):
+        # move production towards the products whose extra output raises harmony the most,
+        # back on the weights that use exactly the labor supply
+        self.production_weights = self.project_to_labor_supply(
+                self.production_weights + step * gradient / curvature, curvature)
+
+    def harmony_curvature(self):
+        """how fast the harmony gradient of each weight changes at the current net output,
+        the diagonal of the negated Hessian of the summed harmony. Weights and gradients
+        differ by orders of magnitude between products, so the steps are divided by it"""
+        target, scale = self.__harmony_scale(self.product_targets, self.final_consumption_of)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            product_curvature = np.where(scale < 0, 1, 1 / (scale + 1)**2) / target**2
+        product_curvature = np.where(target == 0, 0.0, product_curvature)
+        weight_output = np.diag(self.__output_row()) - self.__product_flow_matrix()
+        curvature = product_curvature @ weight_output**2
+        # weights that no target depends on get the mean curvature of their year
+        fallback = np.broadcast_to(curvature.mean(axis=-1, keepdims=True), curvature.shape)
+        return np.where(curvature > 0, curvature, np.where(fallback > 0, fallback, 1))
+
+    def project_to_labor_supply(self, weights, metric=1):
+        """the non-negative weights whose labor is the labor supply of each year that are
+        closest to weights, in the distance sum(metric * difference**2). These are
+        max(weights - tau * labor / metric, 0) with the tau that meets the supply, with the
+        products sorted by weight * metric / labor the k highest are still produced"""
+        labor = self.__labor_row()
+        metric = np.broadcast_to(metric, weights.shape)
+        labor_supply = np.asarray(self.labor_supply, dtype=float)[..., np.newaxis]
+        # products without labor are not bound by the supply
+        with np.errstate(divide='ignore', invalid='ignore'):
+            breakpoints = np.where(labor > 0, weights * metric / labor, -np.inf)
+            order = np.argsort(-breakpoints, axis=-1)
+            sorted_labor = labor[order]
+            taus = ((np.cumsum(np.take_along_axis(weights, order, axis=-1) * sorted_labor, axis=-1) - labor_supply)
+                    / np.cumsum(sorted_labor**2 / np.take_along_axis(metric, order, axis=-1), axis=-1))
+            produced = np.sum(taus < np.take_along_axis(breakpoints, order, axis=-1), axis=-1, keepdims=True)
+            tau = np.take_along_axis(taus, np.maximum(produced - 1, 0), axis=-1)
+            return np.where(labor > 0, np.maximum(weights - tau * labor / metric, 0), np.maximum(weights, 0))
 
     # shrink or expand all industries in order to not exceed target level of use of limited resources
     def rescale_intensity(self):
-        # expand products needed by people
-        # shrink products that have input products needed by underfulfilled products
-        print("todo")
+        # harmony grows with output, so every year uses exactly its labor supply
+        labor_in_year = self.production_weights @ self.__labor_row()
+        scale = np.divide(self.labor_supply, labor_in_year,
+                          out=np.zeros_like(labor_in_year), where=labor_in_year > 0)
+        self.production_weights = self.production_weights * scale[..., np.newaxis]
+
+    def calc_weight_gradient(self):
+        """gradient of the summed harmony with respect to the production weights: a weight
+        adds its output to the final consumption of its product and takes its inputs from
+        the final consumption of the input products"""
+        self.weight_gradient = (
+                self.product_harmony_derivatives * self.__output_row()
+                - self.product_harmony_derivatives @ self.__product_flow_matrix())
 
     def export_results(self):
-        df = pd.DataFrame(self.target_fulfillment_in_year)
-        df.to_csv(f"{self.output_dir}/target_fulfillment_in_year.csv")
-        df = pd.DataFrame(self.labor_in_year)
-        df.to_csv(f"{self.output_dir}/labor_in_year.csv")
-        df = pd.DataFrame(self.final_consumption_of, columns=self.products)
-        df.to_csv(f"{self.output_dir}/final_consumption_of.csv", columns=self.products)
-        df = pd.DataFrame(self.labor_for, columns=self.products)
-        df.to_csv(f"{self.output_dir}/labor_for.csv", columns=self.products)
-        df = pd.DataFrame(self.productive_consumption_of, columns=self.products)
-        df.to_csv(f"{self.output_dir}/productive_consumption_of.csv", columns=self.products)
-        df = pd.DataFrame(self.output_of, columns=self.products)
-        df.to_csv(f"{self.output_dir}/output_of.csv", columns=self.products)
-
-    def harmony(self, target, netouput):
-        if target == 0.0: return 0
-        scale = (netouput - target) / target
-        return scale - 0.5 * pow(scale, 2) if scale < 0 else math.log(scale+1)
+        """in batched mode every scenario gets its own subdirectory of output_dir.
+        metrics.json holds the phase timings of the run"""
+        with self.instrumentation.phase('export'):
+            if self.scenarios is None:
+                self.__export_scenario(self.output_dir, ())
+            else:
+                for index, scenario in enumerate(self.scenarios):
+                    scenario_dir = f"{self.output_dir}/{scenario}"
+                    os.makedirs(scenario_dir, exist_ok=True)
+                    self.__export_scenario(scenario_dir, index)
+        self.instrumentation.write_json(f"{self.output_dir}/metrics.json")
+
+    def __export_scenario(self, output_dir, index):
+        df = pd.DataFrame(self.target_fulfillment_in_year[index])
+        df.to_csv(f"{output_dir}/target_fulfillment_in_year.csv")
+        df = pd.DataFrame(self.labor_in_year[index])
+        df.to_csv(f"{output_dir}/labor_in_year.csv")
+        df = pd.DataFrame(self.final_consumption_of[index], columns=self.products)
+        df.to_csv(f"{output_dir}/final_consumption_of.csv", columns=self.products)
+        df = pd.DataFrame(self.labor_for[index], columns=self.products)
+        df.to_csv(f"{output_dir}/labor_for.csv", columns=self.products)
+        df = pd.DataFrame(self.productive_consumption_of[index], columns=self.products)
+        df.to_csv(f"{output_dir}/productive_consumption_of.csv", columns=self.products)
+        df = pd.DataFrame(self.output_of[index], columns=self.products)
+        df.to_csv(f"{output_dir}/output_of.csv", columns=self.products)
+        df = pd.DataFrame([{
+            **entry,
+            'mean_harmony': entry['mean_harmony'][index],
+            'gradient_norm': entry['gradient_norm'][index],
+            'step': entry['step'][index],
+        } for entry in self.history])
+        df.to_csv(f"{output_dir}/harmonizer_history.csv", index=False)
+
+    # harmony and its gradient work elementwise on scalars as well as on whole
+    # (scenario x) year x product tensors; products without target have zero harmony
+    def harmony(self, target, netoutput):
+        target, scale = self.__harmony_scale(target, netoutput)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            harmony = np.where(scale < 0, scale - 0.5 * scale**2, np.log1p(scale))
+        return np.where(target == 0, 0.0, harmony)[()]
+
+    def harmony_gradient(self, target, netoutput):
+        """analytic derivative of harmony with respect to the net output"""
+        target, scale = self.__harmony_scale(target, netoutput)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gradient = np.where(scale < 0, 1 - scale, 1 / (scale + 1)) / target
+        return np.where(target == 0, 0.0, gradient)[()]
 
     def derivative_harmony(self, target, netoutput):
-        epsilon = 0.000001
-        base = self.harmony(target, netoutput)
-        base_plus_epsilon = self.harmony(target, epsilon + netoutput)
-        return (base_plus_epsilon - base) / epsilon
+        return self.harmony_gradient(target, netoutput)
+
+    def __harmony_scale(self, target, netoutput):
+        target = np.asarray(target, dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return target, (np.asarray(netoutput, dtype=float) - target) / target
 
     def calc_outputs(self):
         self.output_of = np.multiply(self.production_weights, self.__output_row())
-        # A shape year/products
+        # A shape (scenario/)year/products
         # B shape products/products
         # Aik*Bjk->ij
         self.productive_consumption_of = np.einsum(
-                'ik,jk->ij', self.production_weights, self.__product_flow_matrix())
+                '...ik,jk->...ij', self.production_weights, self.__product_flow_matrix())
         # self.productive_consumption_of = np.random.rand(5, self.num_products)
         self.final_consumption_of = self.output_of - self.productive_consumption_of
 
     def calc_harmony(self):
-        self.product_harmony = np.vectorize(self.harmony)(self.product_targets, self.final_consumption_of)
-        self.mean_harmony = self.product_harmony.mean()
-        self.product_harmony_derivatives = np.vectorize(self.derivative_harmony)(self.product_targets, self.final_consumption_of)
+        self.product_harmony = self.harmony(self.product_targets, self.final_consumption_of)
+        # one mean per scenario in batched mode
+        self.mean_harmony = self.product_harmony.mean(axis=(-2, -1))
+        self.product_harmony_derivatives = self.harmony_gradient(self.product_targets, self.final_consumption_of)
 
     def calc_target_fulfillment(self):
         self.target_fulfillment_of = np.divide(
@@ -93,11 +315,11 @@ class Planning:
                 out = np.ones_like(self.final_consumption_of),
                 where = self.product_targets != 0
         )
-        self.target_fulfillment_in_year = np.sum(self.target_fulfillment_of, axis = 1)
+        self.target_fulfillment_in_year = np.sum(self.target_fulfillment_of, axis = -1)
 
     def calc_labor(self):
         self.labor_for = np.multiply(self.production_weights, self.__labor_row())
-        self.labor_in_year = np.sum(self.labor_for, axis = 1)
+        self.labor_in_year = np.sum(self.labor_for, axis = -1)
 
     def __target(self, key, year):
         return float(self.targets[key][year])
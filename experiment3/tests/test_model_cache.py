@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+#
+import os
+import tempfile
+import unittest
+import pandas as pd
+from planning.planning import Planning
+from planning_common.model_cache import ModelCache
+
+INPUT_FILES = ['flows.csv', 'targets.csv', 'capital_stock.csv', 'depreciation_rates.csv']
+
+
+class TestModelCache(unittest.TestCase):
+
+    def setUp(self):
+        output_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(output_dir.cleanup)
+        self.output_dir = output_dir.name
+
+    def test_store_and_load(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ModelCache(cache_dir)
+            key = ModelCache.input_key('test_data', INPUT_FILES)
+            self.assertEqual(cache.load(key), {})
+            cache.store(key, model=b'model', metadata=b'{}')
+            self.assertEqual(cache.load(key), {'model': b'model', 'metadata': b'{}'})
+            self.assertNotEqual(key, ModelCache.input_key('test_data', INPUT_FILES, 'sparse'))
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ModelCache(cache_dir, max_bytes=15)
+            cache.store('old', model=b'0123456789')
+            os.utime(os.path.join(cache_dir, 'old'), (0, 0))
+            cache.store('new', model=b'0123456789')
+            self.assertEqual(cache.load('old'), {})
+            self.assertEqual(cache.load('new'), {'model': b'0123456789'})
+            # an entry larger than the cache stays until the next one is stored
+            cache.store('large', model=b'01234567890123456789')
+            self.assertEqual(cache.load('large'), {'model': b'01234567890123456789'})
+            self.assertEqual(cache.load('new'), {})
+
+    def test_cached_model_and_solution(self):
+        planning = Planning('test_data', self.output_dir)
+        planning.import_example_data()
+        planning.setup_solver(vectorized=True, sparse=True)
+        planning.solve()
+        planning.format_results()
+
+        cached = Planning('test_data', self.output_dir)
+        cached.load_model(planning.model_proto(), planning.model_metadata(), planning.solution_proto())
+        cached.format_results()
+        self.assertEqual(cached.solver.NumVariables(), 280)
+        self.assertEqual(cached.output_of, planning.output_of)
+        self.assertEqual(cached.flow_for_of, planning.flow_for_of)
+        with tempfile.TemporaryDirectory() as output_dir:
+            cached.output_dir = output_dir
+            cached.export_results()
+            self.assertTrue(os.path.exists(f"{output_dir}/output_of.csv"))
+
+        unsolved = Planning('test_data', self.output_dir)
+        unsolved.load_model(planning.model_proto(), planning.model_metadata())
+        unsolved.solve()
+        self.assertAlmostEqual(unsolved.solver.Objective().Value(), planning.solver.Objective().Value())
+
+    def test_cached_export_keeps_dual_values(self):
+        files = []
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ModelCache(cache_dir)
+            key = ModelCache.input_key('test_data', INPUT_FILES)
+            for run in ['fresh', 'cached']:
+                output_dir = os.path.join(self.output_dir, run)
+                os.makedirs(output_dir)
+                planning = Planning('test_data', output_dir)
+                cached = cache.load(key)
+                if cached:
+                    planning.load_model(cached['model'], cached['metadata'], cached['solution'])
+                else:
+                    planning.import_example_data()
+                    planning.setup_solver(vectorized=True)
+                    planning.solve()
+                    cache.store(key, model=planning.model_proto(), metadata=planning.model_metadata(),
+                                solution=planning.solution_proto())
+                planning.export_results()
+                files.append(sorted(os.listdir(output_dir)))
+                duals = pd.read_csv(os.path.join(output_dir, 'dual_of_labor_supply.csv'), index_col=0)
+                if run == 'fresh':
+                    fresh_duals = duals
+        self.assertEqual(files[0], files[1])
+        self.assertIn('reduced_cost_of_output_of.csv', files[1])
+        pd.testing.assert_frame_equal(duals, fresh_duals)
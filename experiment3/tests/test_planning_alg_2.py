@@ -1,25 +1,425 @@
 # -*- coding: utf-8 -*-
 #
+import copy
+import gzip
+import importlib.util
+import os
+import re
+import subprocess
+import tempfile
 import unittest
+import numpy as np
 import pandas as pd
+import pulp
+from ortools.linear_solver import linear_solver_pb2
+from ortools.linear_solver import pywraplp
+from ortools.linear_solver.python import model_builder_helper as mbh
 from planning.planning import Planning
+from planning import sweep
+from planning_common.sweep import run_sweep, scenarios_from_spec
+from planning_common.model_export import write_model
+from planning_common.solver_backends import LinearProgram, PdlpOptions, solution_accuracy
 import pdb
 
 class TestPlanningAlg1(unittest.TestCase):
 
+    def setUp(self):
+        output_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(output_dir.cleanup)
+        self.output_dir = output_dir.name
+
     def test_import_example_data(self):
-        planning = Planning('test_data', 'out/test_run')
+        planning = Planning('test_data', self.output_dir)
         planning.import_example_data()
         self.assertEqual(planning.flows.shape, (6,5))
+        self.assertEqual(planning.io_matrix.shape, (4, 4))
+        self.assertEqual(planning.product_targets.shape, (5, 4))
+        self.assertAlmostEqual(planning.output_per_io[1, 0], 5.0)  # iron output 10 per 2 coal
+        self.assertEqual(planning.output_per_io[2, 0], 0)  # no corn in iron
 
     def test_plan_result(self):
-        planning = Planning('test_data', 'out/test_run')
+        planning = Planning('test_data', self.output_dir)
         planning.import_example_data()
         planning.setup_solver()
         planning.solve()
         planning.export_results()
-        target_fulfillment = pd.read_csv('out/test_run/target_fulfillment_in_year.csv')
-        output = pd.read_csv('out/test_run/output_of.csv')
-        self.assertTrue(0.15922 < target_fulfillment.iloc[0][1] < 0.15923)
+        target_fulfillment = pd.read_csv(f"{self.output_dir}/target_fulfillment_in_year.csv")
+        output = pd.read_csv(f"{self.output_dir}/output_of.csv")
+        self.assertTrue(0.15922 < target_fulfillment.iloc[0, 1] < 0.15923)
         self.assertTrue(9.02671 < output.iloc[0]['iron'] < 9.02672)
         self.assertTrue(0.19788 < output.iloc[4]['iron'] < 0.19789)
+
+    def test_vectorized_model_matches_loop_model(self):
+        objectives = []
+        for vectorized in [False, True]:
+            planning = Planning('test_data', self.output_dir)
+            planning.import_example_data()
+            planning.setup_solver(vectorized=vectorized)
+            planning.solve()
+            objectives.append(planning.solver.Objective().Value())
+            self.assertEqual(planning.solver.NumVariables(), 430)
+            self.assertEqual(planning.solver.NumConstraints(), 345)
+        self.assertAlmostEqual(objectives[0], objectives[1], places=9)
+
+    def test_sparse_model_matches_dense_model(self):
+        for vectorized in [False, True]:
+            planning = Planning('test_data', self.output_dir)
+            planning.import_example_data()
+            planning.setup_solver(vectorized=vectorized, sparse=True)
+            planning.solve()
+            self.assertEqual(planning.solver.NumVariables(), 280)
+            self.assertAlmostEqual(planning.solver.Objective().Value(), 7.336453, places=6)
+            planning.format_results()
+            self.assertEqual(planning.flow_for_of[0]['iron']['corn'], 0.0)
+            self.assertEqual(len(planning.capital_stock_for_of[0]['bread']), 4)
+
+    def test_replanning_matches_fresh_plan(self):
+        planning = Planning('test_data', self.output_dir)
+        planning.import_example_data()
+        planning.setup_solver(vectorized=True)
+        planning.solve()
+        first_iterations = planning.solver.iterations()
+        planning.update_labor_supply(2, 3.1)
+        planning.update_targets(1, [0.1, 3, 0.5, 2.0])
+        planning.solve()
+        self.assertLess(planning.solver.iterations(), first_iterations)
+
+        fresh = Planning('test_data', self.output_dir)
+        fresh.import_example_data()
+        fresh.labor_supply[2] = 3.1
+        fresh.product_targets[1] = [0.1, 3, 0.5, 2.0]
+        fresh.setup_solver()
+        fresh.solve()
+        self.assertAlmostEqual(planning.solver.Objective().Value(), fresh.solver.Objective().Value(), places=9)
+
+    def test_shift_horizon(self):
+        planning = Planning('test_data', self.output_dir)
+        planning.import_example_data()
+        planning.setup_solver()
+        planning.solve()
+        planning.format_results()
+        capital_stock_year_1 = planning.capital_stock_for_of[1]['coal']['iron']
+        planning.shift_horizon([0.1, 3.2, 0, 2.2], 3.1)
+        self.assertAlmostEqual(planning.initial_capital_stocks[0, 1], capital_stock_year_1)
+        self.assertEqual(list(planning.product_targets[-1]), [0.1, 3.2, 0, 2.2])
+        planning.solve()
+        self.assertEqual(planning.result_status, 0)
+
+    def test_scale_parameters(self):
+        planning = Planning('test_data', self.output_dir)
+        planning.import_example_data()
+        planning.scale_parameters(targets_scale=2, labor_scale=0.5, depreciation_scale=[1, 2, 1, 1])
+        self.assertEqual(planning.product_targets[0, 1], 6)
+        self.assertEqual(planning.labor_supply[0], 1.5)
+        self.assertEqual(planning.dep_matrix[1, 1], 1.0)
+        self.assertEqual(planning.dep_matrix[1, 0], 0.5)
+        planning.setup_solver(vectorized=True)
+        planning.solve()
+        self.assertEqual(planning.result_status, 0)
+
+    def test_sweep(self):
+        scenarios = scenarios_from_spec({'grid': {'targets_scale': [1, 2], 'labor_scale': [1, 0.5]}})
+        self.assertEqual(scenarios[1], {'targets_scale': 1, 'labor_scale': 0.5})
+        results_file = f"{self.output_dir}/sweep/results.csv"
+        table = run_sweep(sweep.solve_scenario, 'test_data', scenarios, results_file, max_workers=2)
+        self.assertEqual(list(table['targets_scale']), ['1', '1', '2', '2'])
+        self.assertTrue((table['status'] == pywraplp.Solver.OPTIMAL).all())
+        # twice the targets are fulfilled half as much with the same labor
+        self.assertAlmostEqual(table['objective'][2], table['objective'][0] / 2)
+        written = pd.read_csv(results_file, index_col='scenario')
+        np.testing.assert_allclose(written['objective'], table['objective'])
+
+    def test_check_feasibility(self):
+        planning = Planning('test_data', self.output_dir)
+        planning.import_example_data()
+        report = planning.check_feasibility()
+        self.assertAlmostEqual(report['spectral_radius'], 0.2)
+        self.assertTrue((np.array(report['minimum_labor']) < planning.labor_supply).all())
+        self.assertEqual(planning.instrumentation.values['minimum_labor'], report['minimum_labor'])
+        self.assertEqual(report['problems'], [])
+
+        # half the labor supply is below the labor values of the targets, the plan
+        # still solves and meets less of them
+        short = copy.copy(planning)
+        short.scale_parameters(labor_scale=0.5)
+        problems = short.check_feasibility()['problems']
+        self.assertEqual(len(problems), planning.years)
+        self.assertRegex(problems[0], "year 0: the targets need at least")
+        short.setup_solver(vectorized=True)
+        short.solve()
+        self.assertEqual(short.result_status, pywraplp.Solver.OPTIMAL)
+
+        unproductive = copy.copy(planning)
+        unproductive.io_matrix = planning.io_matrix.copy()
+        unproductive.io_matrix[1, 1] = 1.2 * planning.output_row[1]
+        self.assertRegex(unproductive.check_feasibility()['problems'][0], "not productive.*: coal$")
+
+    def test_presolve(self):
+        with tempfile.TemporaryDirectory() as input_dir:
+            # cloth has no target and no other product uses it
+            for name, column in [('flows', [0, 0.5, 0, 0, 0, 1, 2]), ('capital_stock', [1, 0, 0, 0, 0]),
+                                 ('depreciation_rates', [0.1, 0, 0, 0, 0])]:
+                table = pd.read_csv(f"test_data/{name}.csv").dropna()
+                products = len(table.columns) - 1
+                table = pd.concat([table.iloc[:products],
+                                   pd.DataFrame({'headings': ['cloth']}), table.iloc[products:]], ignore_index=True)
+                table['cloth'] = column[:len(table)]
+                table.fillna(0).to_csv(f"{input_dir}/{name}.csv", index=False)
+            targets = pd.read_csv('test_data/targets.csv')
+            targets.insert(len(targets.columns) - 1, 'cloth', 0.0)
+            targets.to_csv(f"{input_dir}/targets.csv", index=False)
+
+            full = Planning(input_dir, input_dir)
+            full.import_example_data()
+            full.setup_solver(vectorized=True)
+            full.solve()
+            presolved = Planning(input_dir, input_dir)
+            presolved.import_example_data()
+            self.assertEqual(presolved.presolve(), ['cloth'])
+            self.assertEqual(presolved.products, ['iron', 'coal', 'corn', 'bread'])
+            presolved.setup_solver(vectorized=True)
+            presolved.solve()
+            self.assertLess(presolved.solver.NumVariables(), full.solver.NumVariables())
+            self.assertAlmostEqual(presolved.solution_response().objective_value,
+                                   full.solution_response().objective_value)
+
+            presolved.export_results()
+            output = pd.read_csv(f"{input_dir}/output_of.csv", index_col=0)
+            self.assertEqual(list(output.columns), full.products)
+            self.assertTrue((output['cloth'] == 0).all())
+            duals = pd.read_csv(f"{input_dir}/dual_of_initial_capital_stock.csv", index_col=0)
+            self.assertEqual(duals.shape, (5, 5))
+
+    def test_instrumentation(self):
+        planning = Planning('test_data', self.output_dir)
+        planning.import_example_data()
+        planning.setup_solver(vectorized=True)
+        planning.solve()
+        metrics = planning.instrumentation.to_dict()
+        self.assertEqual(set(metrics['phases']), {'import', 'setup', 'setup_variables', 'setup_constraints', 'solve'})
+        self.assertEqual(metrics['variables'], planning.solver.NumVariables())
+        self.assertEqual(metrics['status'], 0)
+
+        loop = Planning('test_data', self.output_dir)
+        loop.import_example_data()
+        loop.setup_solver()
+        self.assertEqual(loop.instrumentation.to_dict()['nonzeros'], metrics['nonzeros'])
+
+    def test_write_model(self):
+        planning = Planning('test_data', self.output_dir)
+        planning.import_example_data()
+        planning.setup_solver(vectorized=True)
+        planning.solve()
+        with tempfile.TemporaryDirectory() as model_dir:
+            planning.write_model(os.path.join(model_dir, 'plan.mps.gz'))
+            planning.write_model(os.path.join(model_dir, 'plan.lp'))
+            with gzip.open(os.path.join(model_dir, 'plan.mps.gz'), 'rt') as mps_file:
+                model = mbh.ModelBuilderHelper()
+                self.assertTrue(model.import_from_mps_string(mps_file.read()))
+            with open(os.path.join(model_dir, 'plan.lp')) as lp_file:
+                lp = lp_file.read()
+        self.assertEqual(model.num_variables(), planning.solver.NumVariables())
+        self.assertEqual(model.num_constraints(), planning.solver.NumConstraints())
+        solver = mbh.ModelSolverHelper('glop')
+        solver.solve(model)
+        self.assertAlmostEqual(solver.objective_value(), planning.solver.Objective().Value())
+        self.assertIn(' leontief_0: - 1.0 target_fulfillment_in_year_0 ', lp)
+        self.assertTrue(lp.endswith('End\n'))
+
+    def test_write_loop_model(self):
+        # every row of a family has the same name in a model built in the loop
+        planning = Planning('test_data', self.output_dir)
+        planning.import_example_data()
+        planning.setup_solver()
+        planning.solve()
+        with tempfile.TemporaryDirectory() as model_dir:
+            planning.write_model(os.path.join(model_dir, 'plan.mps'))
+            planning.write_model(os.path.join(model_dir, 'plan.lp'))
+            model = mbh.ModelBuilderHelper()
+            with open(os.path.join(model_dir, 'plan.mps')) as mps_file:
+                self.assertTrue(model.import_from_mps_string(mps_file.read()))
+            # the LP reader of OR-Tools takes another dialect, CBC reads CPLEX LP files
+            cbc = subprocess.run([pulp.PULP_CBC_CMD().path, os.path.join(model_dir, 'plan.lp'), 'solve'],
+                                 capture_output=True, text=True).stdout
+        self.assertEqual(model.num_constraints(), planning.solver.NumConstraints())
+        solver = mbh.ModelSolverHelper('glop')
+        solver.solve(model)
+        self.assertAlmostEqual(solver.objective_value(), planning.solver.Objective().Value())
+        self.assertAlmostEqual(float(re.search(r"Optimal objective (\S+)", cbc)[1]),
+                               planning.solver.Objective().Value(), places=6)
+
+    def test_write_empty_row(self):
+        solver = pywraplp.Solver.CreateSolver('GLOP')
+        x = solver.NumVar(0, 10, 'x')
+        solver.Add(x <= 4, 'capacity')
+        solver.Constraint(-1, solver.infinity(), 'empty')
+        solver.Maximize(x)
+        model = linear_solver_pb2.MPModelProto()
+        solver.ExportModelToProto(model)
+        with tempfile.TemporaryDirectory() as model_dir:
+            write_model(model, os.path.join(model_dir, 'empty.lp'))
+            with open(os.path.join(model_dir, 'empty.lp')) as lp_file:
+                lp = lp_file.read()
+            cbc = subprocess.run([pulp.PULP_CBC_CMD().path, os.path.join(model_dir, 'empty.lp'), 'solve'],
+                                 capture_output=True, text=True).stdout
+        self.assertIn(' empty: + 0.0 x\n >= -1.0\n', lp)
+        self.assertAlmostEqual(float(re.search(r"Optimal objective (\S+)", cbc)[1]), 4)
+
+    def test_solution_arrays(self):
+        loop = Planning('test_data', self.output_dir)
+        loop.import_example_data()
+        loop.setup_solver()
+        loop.solve()
+        arrays = loop.solution_arrays()
+        self.assertEqual(arrays['labor_for'][1, 2], loop.labor_for[1]['corn'].solution_value())
+        self.assertEqual(arrays['flow_for_of'][3, 0, 1], loop.flow_for_of[3]['iron']['coal'].solution_value())
+
+        planning = Planning('test_data', self.output_dir)
+        planning.import_example_data()
+        planning.setup_solver(vectorized=True, sparse=True)
+        planning.solve()
+        arrays = planning.solution_arrays()
+        self.assertEqual(arrays['flow_for_of'].shape, (5, 4, 4))
+        self.assertEqual(arrays['flow_for_of'][0, 0, 2], 0.0)  # no corn in iron
+
+        table = planning.results_table()
+        self.assertEqual((~table['family'].str.startswith('dual_')).sum(), planning.solver.NumVariables())
+        flows = table[table['family'] == 'flow_for_of'].set_index(['year', 'product', 'input'])['value']
+        self.assertEqual(flows[(2, 'bread', 'corn')], arrays['flow_for_of'][2, 3, 2])
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            planning.output_dir = output_dir
+            planning.export_results(file_format='npz')
+            with np.load(os.path.join(output_dir, 'results.npz')) as results:
+                np.testing.assert_array_equal(results['capital_stock_for_of'], arrays['capital_stock_for_of'])
+                self.assertEqual(list(results['products']), planning.products)
+            if importlib.util.find_spec('pyarrow'):
+                planning.export_results(file_format='parquet')
+                parquet = pd.read_parquet(os.path.join(output_dir, 'results.parquet'))
+                self.assertEqual(len(parquet), len(table))
+
+    def test_dual_values(self):
+        planning = Planning('test_data', self.output_dir)
+        planning.import_example_data()
+        planning.setup_solver(vectorized=True)
+        planning.solve()
+        objective = planning.solver.Objective().Value()
+        duals = planning.dual_arrays()
+        self.assertEqual(duals['initial_capital_stock'].shape, (4, 4))
+        self.assertGreater(duals['labor_supply'][2], 0)
+        self.assertTrue((planning.reduced_cost_arrays()['output_of'] <= 1e-9).all())
+
+        # the objective grows by the dual value per unit of extra labor
+        planning.update_labor_supply(2, planning.labor_supply[2] + 0.001)
+        planning.solve()
+        self.assertAlmostEqual((planning.solver.Objective().Value() - objective) / 0.001,
+                               duals['labor_supply'][2], places=6)
+
+        table = planning.results_table()
+        labor_duals = table[table['family'] == 'dual_labor_supply']['value']
+        self.assertEqual(len(labor_duals), planning.years)
+
+    def test_backends(self):
+        objectives = {}
+        for backend in ['glop', 'clp', 'pdlp', 'pulp_cbc', 'highs']:
+            planning = Planning('test_data', self.output_dir, backend=backend)
+            planning.import_example_data()
+            planning.setup_solver(vectorized=True)
+            planning.solve()
+            self.assertEqual(planning.result_status, 0, backend)
+            objectives[backend] = planning.solver.Objective().Value()
+            if backend == 'glop':
+                reference = planning
+            elif backend == 'highs':
+                with self.assertRaises(ValueError):
+                    planning.dual_arrays()
+                self.assertFalse(planning.results_table()['family'].str.startswith('dual_').any())
+            elif backend == 'pulp_cbc':
+                glop_duals = reference.dual_arrays()
+                np.testing.assert_allclose(planning.dual_arrays()['labor_supply'],
+                                           glop_duals['labor_supply'], atol=1e-6)
+        for backend, objective in objectives.items():
+            # pdlp stops at a relative tolerance of about 1e-8
+            self.assertAlmostEqual(objective / objectives['glop'], 1, places=5, msg=backend)
+
+    def test_pulp_linear_program(self):
+        problem = pulp.LpProblem('test', pulp.LpMaximize)
+        x = pulp.LpVariable('x', 0, 4)
+        y = pulp.LpVariable('y', 1)
+        z = pulp.LpVariable('z', upBound=3)
+        problem += 3 * x + 2 * y + z
+        problem += x + y + z <= 10, 'capacity'
+        problem += x - y >= -2, 'balance'
+        problem += y + 2 * z == 8, 'mix'
+        program = LinearProgram.from_pulp(problem)
+        np.testing.assert_array_equal(program.constraint_lower, [-np.inf, -2, 8])
+        np.testing.assert_array_equal(program.constraint_upper, [10, np.inf, 8])
+        np.testing.assert_array_equal(program.variable_lower, [0, 1, -np.inf])
+        np.testing.assert_array_equal(program.variable_upper, [4, np.inf, 3])
+
+        solver = pywraplp.Solver.CreateSolver('GLOP')
+        solver.LoadModelFromProto(program.to_proto())
+        self.assertEqual(solver.Solve(), pywraplp.Solver.OPTIMAL)
+        problem.solve(pulp.PULP_CBC_CMD(msg=False))
+        self.assertAlmostEqual(solver.Objective().Value(), pulp.value(problem.objective), places=6)
+
+    def test_solve_rolling(self):
+        monolithic = Planning('test_data', self.output_dir)
+        monolithic.import_example_data()
+        monolithic.setup_solver(vectorized=True, sparse=True)
+        monolithic.solve()
+        model = linear_solver_pb2.MPModelProto()
+        monolithic.solver.ExportModelToProto(model)
+        optimum = monolithic.solver.Objective().Value()
+
+        planning = Planning('test_data', self.output_dir)
+        planning.import_example_data()
+        planning.solve_rolling(3, 1)
+        self.assertEqual(planning.result_status, pywraplp.Solver.FEASIBLE)
+        self.assertEqual(planning.instrumentation.values['windows'], 2)
+        # the kept years form a plan that is feasible in the monolithic model
+        values = planning.solution_values()
+        accuracy = solution_accuracy(LinearProgram.from_proto(model), values)
+        self.assertLess(accuracy['primal_residual'], 1e-9)
+        self.assertAlmostEqual(accuracy['primal_objective'], planning.solution_response().objective_value)
+        self.assertLessEqual(accuracy['primal_objective'], optimum + 1e-9)
+        self.assertGreater(accuracy['primal_objective'], 0.95 * optimum)
+        self.assertEqual(planning.solution_arrays()['output_of'].shape, (planning.years, len(planning.products)))
+        with self.assertRaises(ValueError):
+            planning.dual_arrays()
+
+        # one window over the whole horizon is the monolithic model
+        planning = Planning('test_data', self.output_dir)
+        planning.import_example_data()
+        planning.solve_rolling(planning.years + 1, 1)
+        self.assertAlmostEqual(planning.solution_response().objective_value, optimum)
+        with self.assertRaises(ValueError):
+            planning.solve_rolling(3, 3)
+
+    def test_pdlp_options(self):
+        options = PdlpOptions.from_string('threads=2,optimality_tolerance=1e-8,polish=glop')
+        self.assertEqual((options.threads, options.optimality_tolerance, options.polish), (2, 1e-8, 'glop'))
+        with self.assertRaises(ValueError):
+            PdlpOptions.from_string('polish=barrier')
+
+        reference = Planning('test_data', self.output_dir)
+        reference.import_example_data()
+        reference.setup_solver(vectorized=True)
+        reference.solve()
+        for polish in [None, 'glop']:
+            with tempfile.TemporaryDirectory() as output_dir:
+                planning = Planning('test_data', output_dir, backend='pdlp', pdlp_options=PdlpOptions(polish=polish))
+                planning.import_example_data()
+                planning.setup_solver(vectorized=True)
+                planning.solve()
+                self.assertTrue(planning.has_solution())
+                self.assertLess(planning.accuracy['primal_residual'], 1e-6)
+                self.assertLess(planning.accuracy['relative_gap'], 1e-5)
+                planning.export_results()
+                accuracy = pd.read_csv(os.path.join(output_dir, 'accuracy.csv'), index_col='measure')['value']
+                self.assertAlmostEqual(accuracy['primal_objective'], planning.solver.Objective().Value())
+            if polish == 'glop':
+                # the crossover ends on the simplex optimum
+                self.assertLess(planning.accuracy['relative_gap'], 1e-12)
+                np.testing.assert_allclose(planning.dual_arrays()['labor_supply'],
+                                           reference.dual_arrays()['labor_supply'], atol=1e-9)
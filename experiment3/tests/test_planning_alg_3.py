@@ -1,19 +1,28 @@
 # -*- coding: utf-8 -*-
 #
+import os
+import tempfile
 import unittest
+import numpy as np
 import pandas as pd
+from planning_common.leontief import IterativeLeontief, leontief_inverse
 from planning_alg3.planning import Planning
 import pdb
 
 class TestPlanningAlg3(unittest.TestCase):
 
+    def setUp(self):
+        output_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(output_dir.cleanup)
+        self.output_dir = output_dir.name
+
     def test_import_example_data(self):
-        planning = Planning('test_data', 'out/test_run')
+        planning = Planning('test_data', self.output_dir)
         planning.import_data()
         self.assertEqual(planning.flows.shape, (6, 4))
 
     def test_harmony(self):
-        planning = Planning('test_data', 'out/test_run')
+        planning = Planning('test_data', self.output_dir)
         self.assertEqual(planning.harmony(5, 5), 0)
         self.assertEqual(planning.harmony(1, 1), 0)
         self.assertGreater(planning.harmony(1, 2), 0) # target overfulfillment
@@ -24,8 +33,179 @@ class TestPlanningAlg3(unittest.TestCase):
         self.assertLess(planning.harmony(0.1, 0.11), abs(planning.harmony(0.1, 0.09)))
 
     def test_derivative_harmony(self):
-        planning = Planning('test_data', 'out/test_run')
+        planning = Planning('test_data', self.output_dir)
         self.assertGreater(planning.derivative_harmony(5, 5), 0)
         self.assertLess(planning.derivative_harmony(5, 5), planning.derivative_harmony(1, 1)) # why?
         self.assertGreater(planning.derivative_harmony(1, 5), 0)
         self.assertLess(planning.derivative_harmony(1, 5), planning.derivative_harmony(5, 1))
+
+    def test_harmony_on_matrices(self):
+        planning = Planning('test_data', self.output_dir)
+        targets = np.array([[0.0, 1.0, 2.0], [10.0, 0.1, 5.0]])
+        netoutput = np.array([[3.0, 0.5, 2.0], [20.0, 0.0, 1.0]])
+        harmony = planning.harmony(targets, netoutput)
+        gradient = planning.harmony_gradient(targets, netoutput)
+        epsilon = 1e-7
+        for index in np.ndindex(targets.shape):
+            target, output = targets[index], netoutput[index]
+            self.assertAlmostEqual(harmony[index], planning.harmony(target, output))
+            finite_difference = (planning.harmony(target, output + epsilon) - planning.harmony(target, output)) / epsilon
+            self.assertAlmostEqual(gradient[index], finite_difference, places=5)
+
+    def test_harmonize_converges(self):
+        planning = Planning('test_data', self.output_dir)
+        planning.import_data()
+        planning.harmonize(step_size=0.1, tolerance=1e-9, max_iterations=1000,
+                           initial_weights=planning.random_weights(seed=0))
+        self.assertTrue(planning.converged)
+        self.assertLess(len(planning.history), 1000)
+        self.assertGreater(planning.history[-1]['mean_harmony'], planning.history[0]['mean_harmony'])
+        np.testing.assert_allclose(planning.labor_in_year, planning.labor_supply)
+
+    def test_harmonize_converges_on_generated_economy(self):
+        # 10 sectors whose inputs take less than their output, with targets far apart in size
+        rng = np.random.default_rng(0)
+        sectors, years = 10, 5
+        products = [f"sector_{i}" for i in range(sectors)]
+        technology = np.where(rng.random((sectors, sectors)) < 0.4, rng.random((sectors, sectors)), 0)
+        technology *= rng.uniform(0.3, 0.7, sectors) / np.maximum(technology.sum(axis=0), 1e-9)
+        output = rng.uniform(1, 100, sectors)
+        labor = rng.uniform(0.1, 1, sectors)
+        targets = np.outer(1 + 0.01 * np.arange(years), rng.uniform(0.5, 20, sectors))
+        gross_output = np.linalg.solve(np.eye(sectors) - technology, targets.T).T
+        flows = pd.DataFrame(np.vstack([technology * output, labor * output, output]), columns=products)
+        flows.insert(0, 'headings', products + ['labor', 'output'])
+        flows.to_csv(f"{self.output_dir}/flows.csv", index=False)
+        table = pd.DataFrame(targets, columns=products)
+        table.insert(0, 'year', range(1, years + 1))
+        table['labor'] = 1.2 * gross_output @ labor
+        table.to_csv(f"{self.output_dir}/targets.csv", index=False)
+
+        optima = []
+        for start in ['leontief', 'random']:
+            planning = Planning(self.output_dir, self.output_dir)
+            planning.import_data()
+            initial_weights = planning.leontief_weights() if start == 'leontief' else planning.random_weights(seed=0)
+            planning.harmonize(initial_weights=initial_weights)
+            self.assertTrue(planning.converged, start)
+            self.assertLess(len(planning.history), 100)
+            harmonies = [entry['mean_harmony'] for entry in planning.history]
+            self.assertTrue(all(later >= earlier for earlier, later in zip(harmonies, harmonies[1:])))
+            np.testing.assert_allclose(planning.labor_in_year, planning.labor_supply)
+            optima.append(planning.mean_harmony)
+        self.assertAlmostEqual(optima[0], optima[1], places=6)
+
+    def test_harmonize_stops_at_max_iterations(self):
+        planning = Planning('test_data', self.output_dir)
+        planning.import_data()
+        planning.harmonize(max_iterations=3)
+        self.assertFalse(planning.converged)
+        self.assertEqual([entry['iteration'] for entry in planning.history], [0, 1, 2])
+
+    def test_armijo_step(self):
+        planning = Planning('test_data', self.output_dir)
+        planning.import_data()
+        planning.harmonize(max_iterations=0, initial_weights=planning.random_weights(seed=0))
+        # a large share, so that the step has to be cut back to meet it
+        planning.ARMIJO_SHARE = 0.5
+        weights, gradient, harmony = planning.production_weights, planning.weight_gradient, planning.mean_harmony
+        curvature = planning.harmony_curvature()
+
+        def increase(step):
+            # the mean harmony gained by step and the share of the predicted gain it is
+            planning.production_weights = weights
+            planning.equalise_harmony(step, gradient, curvature)
+            predicted = np.mean(gradient * (planning.production_weights - weights))
+            planning.calc_outputs()
+            planning.calc_harmony()
+            return (planning.mean_harmony - harmony) / predicted
+
+        initial_step = 64.0
+        accepted_step = planning.adjust_production_weights(initial_step) / 2
+        self.assertLess(accepted_step, initial_step)
+        self.assertGreaterEqual(increase(accepted_step), planning.ARMIJO_SHARE)
+        self.assertLess(increase(2 * accepted_step), planning.ARMIJO_SHARE)
+
+    def test_seeded_runs_are_reproducible(self):
+        planning = Planning('test_data', self.output_dir)
+        planning.import_data()
+        planning.harmonize(initial_weights=planning.random_weights(seed=1))
+        first_history = [entry['mean_harmony'] for entry in planning.history]
+        planning.harmonize(initial_weights=planning.random_weights(seed=1))
+        self.assertEqual(first_history, [entry['mean_harmony'] for entry in planning.history])
+
+    def test_leontief_weights_meet_targets(self):
+        planning = Planning('test_data', self.output_dir)
+        planning.import_data()
+        planning.production_weights = planning.leontief_weights()
+        planning.calc_outputs()
+        np.testing.assert_allclose(planning.final_consumption_of, planning.product_targets, atol=1e-12)
+
+    def test_gross_output_and_labor_values(self):
+        planning = Planning('test_data', self.output_dir)
+        planning.import_data()
+        technology = planning.technology_matrix()
+        inverse = np.linalg.inv(np.eye(planning.num_products) - technology)
+        # a batch of demands is solved like each demand on its own
+        gross_output = planning.gross_output(planning.product_targets)
+        np.testing.assert_allclose(gross_output, planning.product_targets @ inverse.T, atol=1e-12)
+        np.testing.assert_allclose(planning.gross_output(planning.product_targets[0]), gross_output[0])
+        labor = planning.flows[-2] / planning.flows[-1]
+        np.testing.assert_allclose(planning.labor_values(), labor @ inverse, atol=1e-12)
+        # the labor of the gross output is the labor value of the final demand
+        self.assertAlmostEqual(labor @ gross_output[0], planning.labor_values() @ planning.product_targets[0])
+
+        self.assertIs(leontief_inverse(technology), leontief_inverse(technology.copy()))
+        with self.assertRaises(ValueError):
+            leontief_inverse(np.eye(2))
+
+    def test_iterative_leontief(self):
+        exact = Planning('test_data', self.output_dir)
+        exact.import_data()
+        for method in ['jacobi', 'gmres']:
+            planning = Planning('test_data', self.output_dir, leontief_method=method,
+                                leontief_options={'tolerance': 1e-12})
+            planning.import_data()
+            gross_output = planning.gross_output(planning.product_targets)
+            error = planning.instrumentation.values['leontief_error']
+            self.assertTrue(error['converged'])
+            self.assertLessEqual(error['relative_residual'], 1e-12)
+            np.testing.assert_allclose(gross_output, exact.gross_output(exact.product_targets), rtol=1e-9)
+            if not np.isnan(error['error_bound']):
+                self.assertLessEqual(np.abs(gross_output - exact.gross_output(exact.product_targets)).max(),
+                                     error['error_bound'] * (1 + 1e-6))
+            np.testing.assert_allclose(planning.labor_values(), exact.labor_values(), rtol=1e-9)
+
+        # a power series cut off early reports that it has not converged
+        solver = IterativeLeontief(exact.technology_matrix(), 'jacobi', tolerance=1e-12, max_iterations=1)
+        solver.gross_output(exact.product_targets[0])
+        self.assertEqual(solver.error['iterations'], 1)
+        self.assertFalse(solver.error['converged'])
+
+    def test_batched_scenarios_match_single_runs(self):
+        with tempfile.TemporaryDirectory() as scenario_dir:
+            targets = pd.read_csv('test_data/targets.csv')
+            scenario_files = []
+            for factor in [1.0, 1.5]:
+                scenario = targets.copy()
+                scenario.iloc[:, 1:] *= factor
+                scenario_files.append(f"{scenario_dir}/scaled_{factor}.csv")
+                scenario.to_csv(scenario_files[-1], index=False)
+            batched = Planning('test_data', scenario_dir)
+            batched.import_data()
+            batched.import_scenarios(scenario_files)
+            initial_weights = batched.leontief_weights()
+            batched.harmonize(tolerance=0, max_iterations=50, initial_weights=initial_weights)
+            self.assertEqual(batched.production_weights.shape, (2, 5, 4))
+            for index, scenario_file in enumerate(scenario_files):
+                single = Planning('test_data', scenario_dir)
+                single.import_data()
+                single.product_targets = batched.product_targets[index]
+                single.labor_supply = batched.labor_supply[index]
+                single.harmonize(tolerance=0, max_iterations=50,
+                                 initial_weights=initial_weights[index])
+                np.testing.assert_allclose(batched.final_consumption_of[index], single.final_consumption_of)
+                self.assertAlmostEqual(batched.mean_harmony[index], single.mean_harmony)
+            batched.export_results()
+            for scenario in batched.scenarios:
+                self.assertTrue(os.path.exists(f"{scenario_dir}/{scenario}/output_of.csv"))
@@ -1,35 +1,220 @@
+import sys
+
 import click
-from typing import Callable
+import numpy as np
+import pandas as pd
+from typing import Callable, Optional
+from ortools.linear_solver import linear_solver_pb2
 from ortools.linear_solver import pywraplp
 
-from planning_input import PlanningInput
+from planning_common.instrumentation import Instrumentation
+from planning_common.model_cache import ModelCache
+from planning_common.model_export import suffixed_path, write_model
+from planning_common.solver_backends import BACKENDS, create_solver, has_duals, solve_with_backend
+from planning_input import PlanningInput, nonzero_entries, row_entries
 
 
 PRIO_KEY = "prio"
+STATUS_NAMES = {
+    getattr(pywraplp.Solver, name): name.lower().replace("_", " ")
+    for name in ("OPTIMAL", "FEASIBLE", "INFEASIBLE", "UNBOUNDED", "ABNORMAL", "NOT_SOLVED")
+}
+INPUT_FILES = ["input_output.csv", "constraints.csv", "units.csv"]
 
 
 class Planner:
     ENV_ALLOWANCE = 100
 
-    def __init__(self, input_folder: str, debug: bool) -> None:
+    def __init__(
+        self,
+        input_folder: str,
+        debug: bool,
+        cache_dir: Optional[str] = None,
+        lexicographic_epsilon: Optional[float] = None,
+        model_file: Optional[str] = None,
+        sensitivity_file: Optional[str] = None,
+        backend: str = "glop",
+        presolve: bool = False,
+    ) -> None:
         self.debug = debug
-        self.input = PlanningInput(input_folder)
-        self.input.load_data()
-        self.solver = pywraplp.Solver(
-            "Planning", pywraplp.Solver.GLOP_LINEAR_PROGRAMMING
-        )
+        self.backend = backend
+        self.lexicographic_epsilon = lexicographic_epsilon
+        self.model_file = model_file
+        self.sensitivity_file = sensitivity_file
+        self.instrumentation = Instrumentation()
+        with self.instrumentation.phase("import"):
+            self.input = PlanningInput(input_folder)
+            self.input.load_data()
+            # the products neither objective needs are left out of the model and
+            # reported at zero
+            self.dropped_products = self.input.presolve() if presolve else []
+        self.instrumentation.record(dropped_products=len(self.dropped_products))
+        # parsing the input is cheap compared to building and solving, so only the
+        # models and their solutions are cached
+        self.cache = ModelCache(cache_dir) if cache_dir else None
+        self.cached = {}
+        if self.cache:
+            self.cache_key = ModelCache.input_key(
+                input_folder, INPUT_FILES, self.ENV_ALLOWANCE, lexicographic_epsilon, backend,
+                presolve
+            )
+            self.cached = self.cache.load(self.cache_key)
+        self.solver = create_solver(self.backend)
 
     def process(self) -> None:
+        """solves every objective on the same model, only the objective is swapped, so
+        each solve after the first starts from the previous optimal basis. With a
+        lexicographic_epsilon every objective is solved subject to the earlier ones
+        staying within that fraction of their optimum"""
         objectives = [self.set_min_labor_objective, self.set_max_production_objective]
 
-        for objective in objectives:
+        if "model" in self.cached:
+            with self.instrumentation.phase("load_model"):
+                self.load_cached_model(self.cached["model"])
+        else:
             self.add_variables()
-            self.add_objective(objective)
             self.add_constraints()
-            self.solve()
+            if self.cache:
+                self.cache.store(self.cache_key, model=self.model_proto())
+        self.record_model_size()
+
+        for stage, objective in enumerate(objectives):
+            if self.lexicographic_epsilon is not None and stage > 0:
+                self.bound_objective(self.lexicographic_epsilon)
+            self.add_objective(objective)
+            if self.model_file:
+                # one file per objective, e.g. plan_set_min_labor_objective.lp
+                self.write_model(suffixed_path(self.model_file, objective.__name__))
+            solution_key = f"{objective.__name__}.solution"
+            if solution_key in self.cached:
+                self.load_cached_solution(self.cached[solution_key])
+            else:
+                self.solve()
+                if self.cache and self.result_status == pywraplp.Solver.OPTIMAL:
+                    self.cache.store(
+                        self.cache_key, **{solution_key: self.solution_proto()}
+                    )
+            if self.result_status not in (pywraplp.Solver.OPTIMAL, pywraplp.Solver.FEASIBLE):
+                # the solution values of a failed solve are all zero, not a plan, a
+                # feasible pdlp iterate at a limit is, see solver_backends
+                raise ValueError(
+                    f"{objective.__name__}: the {self.backend} backend ended "
+                    f"{STATUS_NAMES.get(self.result_status, self.result_status)}, no plan"
+                )
             self.output_solution(debug=self.debug)
+            if self.sensitivity_file and self.result_status == pywraplp.Solver.OPTIMAL:
+                self.sensitivity().to_csv(
+                    suffixed_path(self.sensitivity_file, objective.__name__)
+                )
+
+    def model_proto(self) -> bytes:
+        model = linear_solver_pb2.MPModelProto()
+        self.solver.ExportModelToProto(model)
+        return model.SerializeToString()
+
+    def record_model_size(self) -> None:
+        model = linear_solver_pb2.MPModelProto.FromString(self.model_proto())
+        self.instrumentation.record(
+            variables=self.solver.NumVariables(),
+            constraints=self.solver.NumConstraints(),
+            nonzeros=sum(len(constraint.var_index) for constraint in model.constraint),
+        )
+
+    def solution_proto(self) -> bytes:
+        solution = linear_solver_pb2.MPSolutionResponse()
+        self.solver.FillSolutionResponseProto(solution)
+        return solution.SerializeToString()
+
+    def bound_objective(self, epsilon: float) -> None:
+        """turns the optimized objective into a constraint that keeps it within epsilon
+        of its optimum, e.g. labor <= optimum * (1 + epsilon) after minimizing labor"""
+        if self.result_status != pywraplp.Solver.OPTIMAL:
+            raise ValueError("only an optimal objective value can be kept as a bound")
+        objective = self.solver.Objective()
+        optimum = objective.Value()
+        slack = epsilon * abs(optimum)
+        if objective.minimization():
+            bound = self.solver.Constraint(
+                -self.solver.infinity(), optimum + slack, f"bound {self.objective_name}"
+            )
+        else:
+            bound = self.solver.Constraint(
+                optimum - slack, self.solver.infinity(), f"bound {self.objective_name}"
+            )
+        for variable in self.solver.variables():
+            if coefficient := objective.GetCoefficient(variable):
+                bound.SetCoefficient(variable, coefficient)
+
+    def scale_parameters(
+        self,
+        targets_scale: float = 1.0,
+        env_allowance: Optional[float] = None,
+        prio: Optional[dict[str, float]] = None,
+    ) -> None:
+        """scenario overrides: scales every minimum, replaces the environmental
+        allowance and the priorities of the given products"""
+        # the product views read these arrays, so they reflect the overrides too
+        self.input.minimum = self.input.minimum * targets_scale
+        if env_allowance is not None:
+            self.ENV_ALLOWANCE = env_allowance
+        for product_name, product_prio in (prio or {}).items():
+            self.input.prio[self.input.product_index[product_name]] = product_prio
+
+    def load_cached_model(self, model: bytes) -> None:
+        self.solver = create_solver(self.backend)
+        error = self.solver.LoadModelFromProtoKeepNames(
+            linear_solver_pb2.MPModelProto.FromString(model)
+        )
+        if error:
+            raise ValueError(error)
+        self.gross_production_of = {
+            product_name: self.solver.LookupVariable(
+                f"gross_production_of_{product_name}"
+            )
+            for product_name in self.input.product_names
+        }
+        self.net_production_of = {
+            product_name: self.solver.LookupVariable(
+                f"net_production_of_{product_name}"
+            )
+            for product_name in self.input.product_names
+        }
+        self.bind_production_lists()
+        self.total_labor = self.solver.LookupVariable("Total labor")
+        self.total_environmental_credit = self.solver.LookupVariable(
+            "Used environmental credit"
+        )
+        self.minimum_constraints = [
+            self.solver.LookupConstraint(f"minimum_{product_name}")
+            for product_name in self.input.product_names
+        ]
+        self.environmental_allowance = self.solver.LookupConstraint(
+            "environmental allowance"
+        )
+
+    def bind_production_lists(self) -> None:
+        # positional views matching the PlanningInput arrays
+        self.gross_production = [
+            self.gross_production_of[product_name]
+            for product_name in self.input.product_names
+        ]
+        self.net_production = [
+            self.net_production_of[product_name]
+            for product_name in self.input.product_names
+        ]
+
+    def load_cached_solution(self, solution: bytes) -> None:
+        # has to come after the last model change, e.g. setting the objective
+        self.solver.LoadSolutionFromProto(
+            linear_solver_pb2.MPSolutionResponse.FromString(solution)
+        )
+        self.result_status = pywraplp.Solver.OPTIMAL
 
     def add_variables(self) -> None:
+        with self.instrumentation.phase("setup_variables"):
+            self._add_variables()
+
+    def _add_variables(self) -> None:
         self.gross_production_of = {}
         for product_name in self.input.product_names:
             self.gross_production_of[product_name] = self.solver.NumVar(
@@ -42,6 +227,7 @@ class Planner:
                 0.0, self.solver.infinity(), f"net_production_of_{product_name}"
             )
 
+        self.bind_production_lists()
         self.total_labor = self.solver.NumVar(
             0.0, self.solver.infinity(), "Total labor"
         )
@@ -52,91 +238,152 @@ class Planner:
 
     def add_objective(self, build_objective: Callable) -> None:
         print("\n")
+        self.objective_name = build_objective.__name__
+        # the previous objective's coefficients must not leak into the new one
+        self.solver.Objective().Clear()
+        self.objective_scale = 1.0
         build_objective()
 
+    def objective_value(self) -> float:
+        """the objective value of the last solve in the units of the input"""
+        return self.solver.Objective().Value() / self.objective_scale
+
     def set_min_labor_objective(self) -> None:
         print("***** Minimum Labor Objective *****")
         objective = self.solver.Objective()
-        for product_name in self.input.product_names:
-            if (labor := self.input.product_map[product_name].required_labor) == 0:
-                continue
-            objective.SetCoefficient(self.gross_production_of[product_name], labor)
+        for j, labor in zip(*nonzero_entries(self.input.labor)):
+            objective.SetCoefficient(self.gross_production[j], labor)
 
         objective.SetMinimization()
 
     def set_max_production_objective(self) -> None:
         print("***** Maximal Production Objective *****")
         objective = self.solver.Objective()
-        for product_name in self.input.product_names:
-            product = self.input.product_map[product_name]
-            coeff = (product.prio * 0.1) * product.envimpact
-            objective.SetCoefficient(self.net_production_of[product_name], coeff)
+        coeffs = (self.input.prio * 0.1) * self.input.envimpact
+        # GLOP perturbs the costs by about 1e-9 and then rejects weights of 1e-6, as
+        # in input_uk, as imprecise, so they are scaled to a largest magnitude of 1.
+        # The plan is the same, objective_value and the sensitivity undo the scale
+        if coeffs.any():
+            self.objective_scale = 1 / np.abs(coeffs).max()
+        for j, coeff in enumerate(coeffs * self.objective_scale):
+            objective.SetCoefficient(self.net_production[j], coeff)
 
         objective.SetMaximization()
 
     def add_constraints(self) -> None:
-        # 0. inputs + net production == gross production
-        for product_name in self.input.product_names:
-            sum_inputs = sum(
-                self.gross_production_of[other_product_name]
-                * self.input.product_map[other_product_name]
-                .ingredients[product_name]
-                .amount
-                for other_product_name in self.input.product_names
-            )
-            self.solver.Add(
-                self.net_production_of[product_name]
-                == self.gross_production_of[product_name] - sum_inputs
-            )
+        """adds the rows straight from the PlanningInput arrays, one SetCoefficient per
+        nonzero instead of building a linear expression per product pair"""
+        with self.instrumentation.phase("setup_constraints"):
+            self._add_constraints()
+
+    def _add_constraints(self) -> None:
+        infinity = self.solver.infinity()
+
+        # 0. inputs + net production == gross production, i.e. (I - A) gross - net == 0
+        net_matrix = self.input.net_matrix()
+        for i in range(len(self.input.product_names)):
+            self.add_row(
+                0, 0, self.gross_production, *row_entries(net_matrix, i)
+            ).SetCoefficient(self.net_production[i], -1)
 
         # 1. sum gross production labor == total labor
-        sum_labor = sum(
-            self.gross_production_of[product_name]
-            * self.input.product_map[product_name].required_labor
-            for product_name in self.input.product_names
-        )
-        self.solver.Add(self.total_labor == sum_labor)
+        self.add_row(
+            0, 0, self.gross_production, *nonzero_entries(-self.input.labor)
+        ).SetCoefficient(self.total_labor, 1)
 
         # 3. sum gross production env impact == total envimpact
-        sum_envimpact = sum(
-            self.gross_production_of[product_name]
-            * self.input.product_map[product_name].envimpact
-            for product_name in self.input.product_names
-        )
-        self.solver.Add(self.total_environmental_credit == sum_envimpact)
+        self.add_row(
+            0, 0, self.gross_production, *nonzero_entries(-self.input.envimpact)
+        ).SetCoefficient(self.total_environmental_credit, 1)
 
         # 4. every product reaches it's minimum
-        for product_name in self.input.product_names:
-            self.solver.Add(
-                self.net_production_of[product_name]
-                >= self.input.product_map[product_name].minimum,
-                f"minimum_{product_name}",
+        self.minimum_constraints = []
+        for i, product_name in enumerate(self.input.product_names):
+            constraint = self.solver.Constraint(
+                self.input.minimum[i], infinity, f"minimum_{product_name}"
             )
+            constraint.SetCoefficient(self.net_production[i], 1)
+            self.minimum_constraints.append(constraint)
 
         # 5. gross production stays below env allowance
-        self.solver.Add(
-            self.total_environmental_credit <= self.ENV_ALLOWANCE,
-            "environmental allowance",
+        self.environmental_allowance = self.solver.Constraint(
+            -infinity, self.ENV_ALLOWANCE, "environmental allowance"
         )
+        self.environmental_allowance.SetCoefficient(self.total_environmental_credit, 1)
+
+    def add_row(
+        self,
+        lower_bound: float,
+        upper_bound: float,
+        variables: list[pywraplp.Variable],
+        indices: np.ndarray,
+        coeffs: np.ndarray,
+    ) -> pywraplp.Constraint:
+        constraint = self.solver.Constraint(lower_bound, upper_bound)
+        for j, coeff in zip(indices, coeffs):
+            constraint.SetCoefficient(variables[j], coeff)
+        return constraint
 
     def solve_with(self, build_objective: Callable) -> None:
-        print("\n")
-        build_objective()
+        self.add_objective(build_objective)
         self.solve()
         self.output_solution(debug=False)
 
     def solve(self) -> None:
-        self.result_status = self.solver.Solve()
+        with self.instrumentation.phase("solve"):
+            self.result_status = solve_with_backend(self.solver, self.backend)
+        self.instrumentation.record(
+            **{
+                self.objective_name: {
+                    "status": self.result_status,
+                    "iterations": self.solver.iterations(),
+                    "objective": self.objective_value(),
+                }
+            }
+        )
 
-    def print_model(self) -> None:
-        print("Model")
-        print("-----")
-        print(self.solver.ExportModelAsLpFormat(obfuscated=False))
-        print("-----")
+    def sensitivity(self) -> pd.DataFrame:
+        """dual values of the minimum rows and reduced costs of the production
+        variables per product, read from the last solve in one call. The last row
+        holds the dual value of the environmental allowance. A dual value is the change
+        of the objective per unit of right hand side, so the products with the largest
+        minimum duals are the ones that drive the objective"""
+        if not has_duals(self.backend):
+            raise ValueError(f"the {self.backend} backend reports no dual values")
+        solution = linear_solver_pb2.MPSolutionResponse()
+        self.solver.FillSolutionResponseProto(solution)
+        duals = np.array(solution.dual_value) / self.objective_scale
+        reduced_costs = np.array(solution.reduced_cost) / self.objective_scale
+        table = pd.DataFrame(
+            {
+                "dual": duals[[c.index() for c in self.minimum_constraints]],
+                "gross_production_reduced_cost": reduced_costs[
+                    [v.index() for v in self.gross_production]
+                ],
+                "net_production_reduced_cost": reduced_costs[
+                    [v.index() for v in self.net_production]
+                ],
+            },
+            index=pd.Index(self.input.product_names, name="product"),
+        )
+        table = table.reindex(
+            pd.Index([*self.input.product_names, *self.dropped_products], name="product"),
+            fill_value=0.0,
+        )
+        table.loc["environmental allowance", "dual"] = duals[
+            self.environmental_allowance.index()
+        ]
+        return table
+
+    def write_model(self, path: str) -> None:
+        """the full model in LP or MPS format by the extension of path, .gz compresses,
+        written row by row as it is too large to print for real economies"""
+        model = linear_solver_pb2.MPModelProto()
+        self.solver.ExportModelToProto(model)
+        write_model(model, path)
 
     def output_solution(self, debug: bool) -> None:
         if debug:
-            self.print_model()
             print(
                 f"Found optimal solution? {self.result_status == pywraplp.Solver.OPTIMAL}"
             )
@@ -144,29 +391,59 @@ class Planner:
             print("\n")
         print("Suggested Plan")
         print("--------------")
+        labor_unit = self.input.labour_resource.unit
         for product_name in self.input.product_names:
             product = self.input.product_map[product_name]
+            gross = self.gross_production_of[product_name].solution_value()
+            net = self.net_production_of[product_name].solution_value()
             print(
-                f"{product.name}: {self.gross_production_of[product_name].solution_value():.3f}{product.unit}, "
-                f"net output {self.net_production_of[product_name].solution_value():.3f}{product.unit}, "
+                f"{product.name}: {gross:.3f}{product.unit}, "
+                f"net output {net:.3f}{product.unit}, "
                 f"minimum {product.minimum:.3f}{product.unit}, "
-                f"envimpact: {self.gross_production_of[product_name].solution_value() * product.envimpact:.3f}, "
-                f"work: {self.gross_production_of[product_name].solution_value() * product.required_labor:.3f}{self.input.labour_resource.unit}, "
+                f"envimpact: {gross * product.envimpact:.3f}, "
+                f"work: {gross * product.required_labor:.3f}{labor_unit}, "
             )
+        for product_name in self.dropped_products:
+            print(f"{product_name}: 0, left out by presolve")
+        print(f"Total labor: {self.total_labor.solution_value():0.3f}{labor_unit}")
         print(
-            f"Total labor: {self.total_labor.solution_value():0.3f}{self.input.labour_resource.unit}"
-        )
-        print(
-            f"Used environmental credit: {self.total_environmental_credit.solution_value():0.3f}/{self.ENV_ALLOWANCE:0.3f}"
+            "Used environmental credit: "
+            f"{self.total_environmental_credit.solution_value():0.3f}/{self.ENV_ALLOWANCE:0.3f}"
         )
 
 
 @click.command()
 @click.argument('input_folder', default='./input_simple')
 @click.option('--debug/--nodebug', default=False, show_default=True, type=bool)
-def plan(input_folder: str, debug: bool):
-    planner = Planner(input_folder, debug)
-    planner.process()
+@click.option('--cache-dir', default=None,
+              help='reuse built models and solutions for unchanged input')
+@click.option('--lexicographic', default=None, type=float, metavar='EPSILON',
+              help='keep every earlier objective within EPSILON of its optimum')
+@click.option('--metrics', default=None,
+              help='write phase timings and model size as json to this file')
+@click.option('--model-file', default=None,
+              help='write the model of each objective, LP or MPS by extension, '
+                   '.gz compresses, e.g. plan.mps.gz')
+@click.option('--sensitivity', default=None,
+              help='write the dual values and reduced costs of each objective as csv, '
+                   'e.g. duals.csv')
+@click.option('--backend', default='glop', show_default=True, type=click.Choice(BACKENDS),
+              help='solver, see solver_backends')
+@click.option('--presolve/--no-presolve', default=False, show_default=True,
+              help='leave out products without minimum or objective weight '
+                   'that no other product needs')
+def plan(input_folder: str, debug: bool, cache_dir: Optional[str], lexicographic: Optional[float],
+         metrics: Optional[str], model_file: Optional[str], sensitivity: Optional[str],
+         backend: str, presolve: bool):
+    planner = Planner(input_folder, debug, cache_dir, lexicographic, model_file, sensitivity,
+                      backend, presolve)
+    try:
+        planner.process()
+    except ValueError as error:
+        sys.exit(str(error))
+    if metrics:
+        planner.instrumentation.write_json(metrics)
 
 if __name__ == '__main__':
-    plan()
+    # click fills in the arguments
+    plan()  # pylint: disable=no-value-for-parameter
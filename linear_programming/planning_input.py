@@ -1,12 +1,24 @@
 import os
 
-from dataclasses import dataclass
+from collections.abc import Mapping
+from dataclasses import MISSING, dataclass, fields
+from typing import Iterator
 import pandas as pd
 import numpy as np
+from scipy import sparse
+
+from planning_common.leontief import (
+    LeontiefInverse,
+    leontief_inverse,
+    leontief_solver,
+    required_products,
+)
 
 
 LABOR_KEY = "labor"
 OUTPUT_KEY = "output"
+# cells of input_output.csv read at a time
+CHUNK_CELLS = 1_000_000
 
 INPUT_DICT = dict[str, float]
 
@@ -26,7 +38,9 @@ class Product(Resource):
 
     @property
     def required_labor(self) -> float:
-        return self.ingredients[LABOR_KEY].amount
+        # only nonzero ingredients are listed
+        labor = self.ingredients.get(LABOR_KEY)
+        return labor.amount if labor else 0.0
 
 
 @dataclass
@@ -35,6 +49,62 @@ class Ingredient:
     amount: float
 
 
+PRODUCT_DEFAULTS = {
+    field.name: field.default for field in fields(Product) if field.default is not MISSING
+}
+
+
+def nonzero_entries(values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """indices and values of the nonzero entries of a dense vector"""
+    indices = np.flatnonzero(values)
+    return indices, values[indices]
+
+
+def row_entries(matrix: sparse.csr_matrix, i: int) -> tuple[np.ndarray, np.ndarray]:
+    """column indices and values stored in row i of a CSR matrix"""
+    start, end = matrix.indptr[i], matrix.indptr[i + 1]
+    return matrix.indices[start:end], matrix.data[start:end]
+
+
+class ProductMap(Mapping):
+    """Product views built on access from the arrays of a PlanningInput, so they
+    always reflect the current arrays and cost nothing until they are requested"""
+
+    def __init__(self, planning_input: "PlanningInput") -> None:
+        self.input = planning_input
+
+    def __getitem__(self, product_name: str) -> Product:
+        i = self.input.product_index[product_name]
+        column = self.input.ingredient_columns
+        start, end = column.indptr[i], column.indptr[i + 1]
+        ingredients = {}
+        for row, amount in zip(column.indices[start:end], column.data[start:end]):
+            key = self.input.ingredient_names[row]
+            ingredients[key] = Ingredient(resource=self.resource(key), amount=amount)
+        return Product(
+            name=product_name,
+            ingredients=ingredients,
+            unit=self.input.units[i],
+            minimum=self.input.minimum[i],
+            envimpact=self.input.envimpact[i],
+            prio=self.input.prio[i],
+        )
+
+    def resource(self, key: str) -> Resource:
+        # a plain Resource instead of the ingredient's own Product view, which would
+        # build its ingredients in turn
+        if key == LABOR_KEY:
+            return self.input.labour_resource
+        i = self.input.product_index.get(key)
+        return Resource(name=key, unit=self.input.units[i] if i is not None else "u")
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.input.product_names)
+
+    def __len__(self) -> int:
+        return len(self.input.product_names)
+
+
 class PlanningInput:
     def __init__(self, input_folder: str) -> None:
         self.input_folder = input_folder
@@ -43,42 +113,108 @@ class PlanningInput:
         return self.labour_resource if key == LABOR_KEY else self.product_map[key]
 
     def load_data(self) -> None:
+        """reads the tables column-wise into arrays in the order of product_names.
+        ingredients[r, j] is the amount of ingredient_names[r] that goes into one unit
+        of product j, stored as CSR so that memory scales with the nonzero cells"""
+        path = os.path.join(self.input_folder, "input_output.csv")
+        self.product_names = pd.read_csv(path, nrows=0).columns[1:]
+        self.product_index = {name: i for i, name in enumerate(self.product_names)}
+
+        # the table is read a block of rows at a time and only the nonzero cells are
+        # kept, so the dense table never is in memory as a whole
+        row_names, rows, columns, values = [], [], [], []
+        output = None
+        rows_per_chunk = max(1, CHUNK_CELLS // len(self.product_names))
+        for chunk in pd.read_csv(path, chunksize=rows_per_chunk):
+            amounts = chunk[self.product_names].to_numpy(dtype=float)
+            headings = list(chunk["headings"])
+            if OUTPUT_KEY in headings:
+                output_row = headings.index(OUTPUT_KEY)
+                output = amounts[output_row]
+                amounts = np.delete(amounts, output_row, axis=0)
+                del headings[output_row]
+            chunk_rows, chunk_columns = np.nonzero(amounts)
+            rows.append(chunk_rows + len(row_names))
+            columns.append(chunk_columns)
+            values.append(amounts[chunk_rows, chunk_columns])
+            row_names += headings
+        rows, columns, values = (np.concatenate(part) for part in (rows, columns, values))
+        if output is not None:
+            values = values / output[columns]
+        self.ingredient_names = row_names
+        self.ingredient_index = {name: r for r, name in enumerate(row_names)}
+        self.ingredients = sparse.csr_matrix(
+            (values, (rows, columns)), shape=(len(row_names), len(self.product_names))
+        )
+        # per product access for the Product views
+        self.ingredient_columns = self.ingredients.tocsc()
+
+        self.technology_matrix = self.ingredients[
+            [self.ingredient_index[name] for name in self.product_names]
+        ]
+        self.labor = self.ingredients[self.ingredient_index[LABOR_KEY]].toarray().ravel()
+
+        constraints = pd.read_csv(os.path.join(self.input_folder, "constraints.csv"))
+        constraints = constraints.set_index("headings")[self.product_names]
+        self.minimum = self.constraint_values(constraints, "minimum")
+        self.envimpact = self.constraint_values(constraints, "envimpact")
+        self.prio = self.constraint_values(constraints, "prio")
+
         units = pd.read_csv(os.path.join(self.input_folder, "units.csv")).fillna(value="u")
-        constraints = pd.read_csv(os.path.join(self.input_folder, "constraints.csv")).replace({np.nan: None})
-        input_output = pd.read_csv(os.path.join(self.input_folder, "input_output.csv"))
-        self.product_names = input_output.keys()[1:]
-        self.product_map: dict[str, Product] = {}
-        for product_name in self.product_names:
-            product_constraints = dict(
-                zip(constraints["headings"].values, constraints[product_name])
-            )
-            product_constraints = {k:v for k,v in product_constraints.items() if v is not None}
-
-            unit = units[product_name][0]
-            self.product_map[product_name] = Product(
-                name=product_name,
-                ingredients={},
-                unit=unit,
-                **product_constraints,
-            )
+        self.units = units[self.product_names].iloc[0].to_numpy(dtype=str)
 
         self.labour_resource = Resource(name="labor", unit="kh")
-
-        for product_name in self.product_names:
-            input_dict = self._normalize(dict(
-                zip(input_output["headings"].values, input_output[product_name])
-            ))
-
-            ingredients = {
-                key: Ingredient(resource=self.get_resource(key), amount=value)
-                for key, value in input_dict.items()
-            }
-            self.product_map[product_name].ingredients = ingredients
-
-    def _normalize(self, input_dict: INPUT_DICT) -> INPUT_DICT:
-        if OUTPUT_KEY in input_dict:
-            output = input_dict[OUTPUT_KEY]
-            return {key: value / output for key, value in input_dict.items() if key != OUTPUT_KEY}
-        else:
-            return input_dict
-
+        self.product_map = ProductMap(self)
+
+    def constraint_values(self, constraints: pd.DataFrame, key: str) -> np.ndarray:
+        """row key of constraints.csv, the Product default for missing cells of keys
+        that have one"""
+        values = (
+            constraints.loc[key].to_numpy(dtype=float)
+            if key in constraints.index
+            else np.full(len(self.product_names), np.nan)
+        )
+        if key in PRODUCT_DEFAULTS:
+            values = np.where(np.isnan(values), PRODUCT_DEFAULTS[key], values)
+        elif np.isnan(values).any():
+            missing = list(self.product_names[np.isnan(values)])
+            raise ValueError(f"no {key} for {missing}")
+        return values
+
+    def presolve(self) -> list[str]:
+        """drops the products that neither have a minimum nor count in the production
+        objective (prio * envimpact) and are no input, directly or indirectly, of one
+        that does, as they stay at zero in both objectives. The ingredient rows are
+        kept, the dropped products are no ingredient of the kept ones. Returns the names
+        of the dropped products"""
+        demanded = (self.minimum > 0) | (self.prio * self.envimpact != 0)
+        required = required_products(self.technology_matrix, demanded)
+        kept = np.flatnonzero(required)
+        dropped = list(self.product_names[~required])
+        self.product_names = self.product_names[kept]
+        self.product_index = {name: i for i, name in enumerate(self.product_names)}
+        self.ingredients = self.ingredients[:, kept]
+        self.ingredient_columns = self.ingredients.tocsc()
+        self.technology_matrix = self.technology_matrix[kept][:, kept]
+        for key in ["labor", "minimum", "envimpact", "prio", "units"]:
+            setattr(self, key, getattr(self, key)[kept])
+        return dropped
+
+    def net_matrix(self) -> sparse.csr_matrix:
+        """I - technology_matrix, net production is net_matrix @ gross production"""
+        identity = sparse.identity(len(self.product_names), format="csr")
+        return (identity - self.technology_matrix).tocsr()
+
+    def leontief_inverse(self) -> LeontiefInverse:
+        """(I - technology_matrix)^-1 as the LU factorization cached per process"""
+        return leontief_inverse(self.technology_matrix)
+
+    def gross_output(self, final_demand: np.ndarray, method: str = "lu", **options) -> np.ndarray:
+        """gross production that leaves final_demand for consumption, for one vector in the
+        order of product_names or a batch of them along the last axis, method jacobi or
+        gmres with tolerance and max_iterations solves without factorizing"""
+        return leontief_solver(self.technology_matrix, method, **options).gross_output(final_demand)
+
+    def labor_values(self, method: str = "lu", **options) -> np.ndarray:
+        """direct and indirect labor per unit of net output of each product"""
+        return leontief_solver(self.technology_matrix, method, **options).labor_values(self.labor)
@@ -1,32 +1,120 @@
+import sys
+
 import click
+import numpy as np
+import pandas as pd
 import pulp as pl
-from typing import Callable
+from ortools.linear_solver import pywraplp
+from typing import Callable, Optional
 
-from planning_input import PlanningInput
+from planning_common.instrumentation import Instrumentation
+from planning_common.model_export import suffixed_path, write_model
+from planning_common.solver_backends import (
+    BACKENDS,
+    LinearProgram,
+    create_solver,
+    has_duals,
+    pulp_cbc_command,
+    solve_with_backend,
+)
+from planning_input import PlanningInput, nonzero_entries, row_entries
 
 
 PRIO_KEY = "prio"
+# PuLP's status and solution status of a solver status, a feasible solution at a
+# limit is not solved but has a solution, as PuLP reports a CBC run stopped on time
+STATUS = {
+    pywraplp.Solver.OPTIMAL: (pl.LpStatusOptimal, pl.LpSolutionOptimal),
+    pywraplp.Solver.FEASIBLE: (pl.LpStatusNotSolved, pl.LpSolutionIntegerFeasible),
+    pywraplp.Solver.INFEASIBLE: (pl.LpStatusInfeasible, pl.LpSolutionInfeasible),
+    pywraplp.Solver.UNBOUNDED: (pl.LpStatusUnbounded, pl.LpSolutionUnbounded),
+}
+SOLUTION_FOUND = (pl.LpSolutionOptimal, pl.LpSolutionIntegerFeasible)
 
 
 class Planner:
     ENV_ALLOWANCE = 100
 
-    def __init__(self, input_folder: str, debug: bool) -> None:
+    def __init__(
+        self,
+        input_folder: str,
+        debug: bool,
+        lexicographic_epsilon: Optional[float] = None,
+        model_file: Optional[str] = None,
+        sensitivity_file: Optional[str] = None,
+        backend: str = "pulp_cbc",
+        presolve: bool = False,
+    ) -> None:
         self.debug = debug
-        self.input = PlanningInput(input_folder)
-        self.input.load_data()
+        self.backend = backend
+        self.lexicographic_epsilon = lexicographic_epsilon
+        self.model_file = model_file
+        self.sensitivity_file = sensitivity_file
+        self.instrumentation = Instrumentation()
+        with self.instrumentation.phase("import"):
+            self.input = PlanningInput(input_folder)
+            self.input.load_data()
+            # the products neither objective needs are left out of the model and
+            # reported at zero, see ortools_plan
+            self.dropped_products = self.input.presolve() if presolve else []
+        self.instrumentation.record(dropped_products=len(self.dropped_products))
+        # the model of an OR-Tools backend is loaded into the solver on the first solve
+        # and updated after, pulp_cbc solves the PuLP model itself
+        self.solver = None
+        self.columns = {}
 
     def process(self) -> None:
         objectives = [self.set_min_labor_objective, self.set_max_production_objective]
 
-        for objective in objectives:
-            self.add_variables()
+        # the problem is built once, every objective only replaces the previous one
+        self.model = pl.LpProblem("Planning")
+        self.solver = None
+        self.add_variables()
+        self.add_constraints()
+        self.instrumentation.record(
+            variables=self.model.numVariables(),
+            constraints=self.model.numConstraints(),
+            nonzeros=sum(len(constraint) for constraint in self.model.constraints.values()),
+        )
+        for stage, objective in enumerate(objectives):
+            if self.lexicographic_epsilon is not None and stage > 0:
+                self.bound_objective(self.lexicographic_epsilon)
             self.add_objective(objective)
-            self.add_constraints()
+            if self.model_file:
+                # one file per objective, see ortools_plan
+                self.write_model(suffixed_path(self.model_file, objective.__name__))
             self.solve()
+            if self.model.sol_status not in SOLUTION_FOUND:
+                # the variables of a failed solve hold no plan, see ortools_plan
+                raise ValueError(
+                    f"{objective.__name__}: the {self.backend} backend ended "
+                    f"{pl.LpStatus[self.model.status].lower()}, no plan"
+                )
             self.output_solution(debug=self.debug)
+            if (self.sensitivity_file and self.model.status == pl.LpStatusOptimal
+                    and has_duals(self.backend)):
+                self.sensitivity().to_csv(
+                    suffixed_path(self.sensitivity_file, objective.__name__)
+                )
+
+    def bound_objective(self, epsilon: float) -> None:
+        """keeps the optimized objective within epsilon of its optimum, see ortools_plan"""
+        if self.model.status != pl.LpStatusOptimal:
+            raise ValueError("only an optimal objective value can be kept as a bound")
+        objective = self.model.objective
+        optimum = pl.value(objective)
+        slack = epsilon * abs(optimum)
+        if self.model.sense == pl.LpMinimize:
+            bound = objective <= optimum + slack
+        else:
+            bound = objective >= optimum - slack
+        self.model += bound, f"bound {self.objective_name}"
 
-    def add_variables(self):
+    def add_variables(self) -> None:
+        with self.instrumentation.phase("setup_variables"):
+            self._add_variables()
+
+    def _add_variables(self) -> None:
         self.gross_production_of = pl.LpVariable.dicts(
             "gross production of",
             (product_name for product_name in self.input.product_names),
@@ -41,6 +129,16 @@ class Planner:
             cat="Continuous",
         )
 
+        # positional views matching the PlanningInput arrays
+        self.gross_production = [
+            self.gross_production_of[product_name]
+            for product_name in self.input.product_names
+        ]
+        self.net_production = [
+            self.net_production_of[product_name]
+            for product_name in self.input.product_names
+        ]
+
         self.total_labor = pl.LpVariable("total labor", lowBound=0, cat="Continuous")
 
         self.total_environmental_credit = pl.LpVariable(
@@ -49,127 +147,232 @@ class Planner:
 
     def add_objective(self, build_objective: Callable) -> None:
         print("\n")
+        self.objective_name = build_objective.__name__
+        self.objective_scale = 1.0
         build_objective()
 
+    def objective_value(self) -> float:
+        """the objective value of the last solve in the units of the input"""
+        return pl.value(self.model.objective) / self.objective_scale
+
     def set_min_labor_objective(self) -> None:
         print("***** Minimum Labor Objective *****")
-        self.model = pl.LpProblem("Planning", pl.LpMinimize)
-
-        self.model += (
-            pl.lpSum(
-                [
-                    labor * self.gross_production_of[product_name]
-                    for product_name in self.input.product_names
-                    if (labor := self.input.product_map[product_name].required_labor)
-                    > 0
-                ]
-            ),
-            "minimize labor",
-        )
+        self.model.sense = pl.LpMinimize
+        self.model.setObjective(self.expression(*nonzero_entries(self.input.labor)))
+        self.model.objective.name = "minimize labor"
 
     def set_max_production_objective(self) -> None:
         print("***** Maximal Production Objective *****")
-        self.model = pl.LpProblem("Planning", pl.LpMaximize)
+        self.model.sense = pl.LpMaximize
+        coeffs = (self.input.prio * 0.1) * self.input.envimpact
+        # scaled to a largest magnitude of 1, see ortools_plan
+        if coeffs.any():
+            self.objective_scale = 1 / np.abs(coeffs).max()
+        self.model.setObjective(
+            self.expression(
+                *nonzero_entries(coeffs * self.objective_scale),
+                self.net_production,
+            )
+        )
+        self.model.objective.name = "maximize productivity"
 
-        self.model += (
-            pl.lpSum(
-                [
-                    ((product := self.input.product_map[product_name]).prio * 0.1)
-                    * product.envimpact
-                    * self.net_production_of[product_name]
-                    for product_name in self.input.product_names
-                ]
-            ),
-            "maximize productivity",
+    def expression(
+        self,
+        indices: np.ndarray,
+        coeffs: np.ndarray,
+        variables: Optional[list[pl.LpVariable]] = None,
+    ) -> pl.LpAffineExpression:
+        """linear expression over the given entries, of gross production by default"""
+        variables = self.gross_production if variables is None else variables
+        return pl.LpAffineExpression(
+            [(variables[j], coeff) for j, coeff in zip(indices, coeffs)]
         )
 
     def add_constraints(self) -> None:
-        # 0. inputs + net production == gross production
-        for product_name in self.input.product_names:
-            sum_inputs = pl.lpSum(
-                self.gross_production_of[other_product_name]
-                * self.input.product_map[other_product_name]
-                .ingredients[product_name]
-                .amount
-                for other_product_name in self.input.product_names
-            )
+        """adds the rows straight from the PlanningInput arrays, see ortools_plan"""
+        with self.instrumentation.phase("setup_constraints"):
+            self._add_constraints()
+
+    def _add_constraints(self) -> None:
+        # 0. inputs + net production == gross production, i.e. (I - A) gross == net
+        net_matrix = self.input.net_matrix()
+        for i, product_name in enumerate(self.input.product_names):
             self.model += (
-                self.net_production_of[product_name]
-                == self.gross_production_of[product_name] - sum_inputs,
+                self.expression(*row_entries(net_matrix, i)) == self.net_production[i],
                 f"net production {product_name}",
             )
 
         # 1. sum gross production labor == total labor
-        sum_labor = pl.lpSum(
-            self.gross_production_of[product_name]
-            * self.input.product_map[product_name].required_labor
-            for product_name in self.input.product_names
+        self.model += (
+            self.total_labor == self.expression(*nonzero_entries(self.input.labor)),
+            "sum labor",
         )
-        self.model += self.total_labor == sum_labor, "sum labor"
 
         # 3. sum gross production env impact == total envimpact
-        sum_envimpact = sum(
-            self.gross_production_of[product_name]
-            * self.input.product_map[product_name].envimpact
-            for product_name in self.input.product_names
-        )
         self.model += (
-            self.total_environmental_credit == sum_envimpact,
+            self.total_environmental_credit
+            == self.expression(*nonzero_entries(self.input.envimpact)),
             "sum enviromental impact",
         )
 
         # 4. every product reaches it's minimum
-        for product_name in self.input.product_names:
-            self.model += (
-                self.net_production_of[product_name]
-                >= self.input.product_map[product_name].minimum,
-                f"minimum {product_name}",
-            )
+        self.minimum_constraints = []
+        for i, product_name in enumerate(self.input.product_names):
+            constraint = self.net_production[i] >= self.input.minimum[i]
+            self.model.addConstraint(constraint, f"minimum {product_name}")
+            self.minimum_constraints.append(constraint)
 
         # 5. gross production stays below env allowance
-        self.model += (
-            self.total_environmental_credit <= self.ENV_ALLOWANCE,
-            "environmental allowance",
+        self.environmental_allowance = (
+            self.total_environmental_credit <= self.ENV_ALLOWANCE
         )
+        self.model.addConstraint(self.environmental_allowance, "environmental allowance")
 
     def solve(self) -> None:
-        self.model.solve()
+        """solves the PuLP model, with pulp_cbc by PuLP itself and with the OR-Tools
+        backends in a Solver that is kept across objectives, see update_solver. The
+        dual values and reduced costs are only kept for an optimal solution"""
+        with self.instrumentation.phase("solve"):
+            if self.backend == "pulp_cbc":
+                self.model.solve(pulp_cbc_command())
+                iterations = None
+            else:
+                self.solve_in_solver()
+                iterations = self.solver.iterations()
+        self.instrumentation.record(
+            **{
+                self.objective_name: {
+                    "status": pl.LpStatus[self.model.status],
+                    "solution": pl.LpSolution[self.model.sol_status],
+                    "iterations": iterations,
+                    "objective": self.objective_value(),
+                }
+            }
+        )
+
+    def solve_in_solver(self) -> None:
+        """solves the model in the Solver of the backend and writes the solution back
+        into the PuLP model"""
+        self.update_solver()
+        status = solve_with_backend(self.solver, self.backend, instrumentation=self.instrumentation)
+        self.model.assignStatus(
+            *STATUS.get(status, (pl.LpStatusUndefined, pl.LpSolutionNoSolutionFound)))
+        duals = status == pywraplp.Solver.OPTIMAL and has_duals(self.backend)
+        if self.model.sol_status in SOLUTION_FOUND:
+            for variable in self.model.variables():
+                column = self.columns[variable.name]
+                variable.varValue = column.solution_value()
+                variable.dj = column.reduced_cost() if duals else None
+            for constraint, row in zip(self.model.constraints.values(), self.solver.constraints()):
+                constraint.pi = row.dual_value() if duals else None
 
-    def print_model(self) -> None:
-        print("Model")
-        print("-----")
-        print(self.model)
-        print("-----")
+    def update_solver(self) -> None:
+        """loads the PuLP model into the solver of an OR-Tools backend on the first solve.
+        Later solves keep that solver and only swap the objective and add the rows added
+        since, e.g. by bound_objective, so that each solve after the first starts from the
+        previous basis as in ortools_plan. New variables load the whole model again"""
+        if self.solver is None or len(self.model.variables()) != self.solver.NumVariables():
+            self.solver = create_solver(self.backend)
+            self.solver.LoadModelFromProto(LinearProgram.from_pulp(self.model).to_proto())
+            self.columns = {
+                variable.name: column
+                for variable, column in zip(self.model.variables(), self.solver.variables())
+            }
+            return
+        for name, constraint in list(self.model.constraints.items())[self.solver.NumConstraints():]:
+            rhs = -constraint.constant
+            row = self.solver.Constraint(
+                rhs if constraint.sense != pl.LpConstraintLE else -self.solver.infinity(),
+                rhs if constraint.sense != pl.LpConstraintGE else self.solver.infinity(),
+                name,
+            )
+            for variable, coefficient in constraint.items():
+                row.SetCoefficient(self.columns[variable.name], coefficient)
+        objective = self.solver.Objective()
+        objective.Clear()
+        for variable, coefficient in (self.model.objective or {}).items():
+            objective.SetCoefficient(self.columns[variable.name], coefficient)
+        objective.SetOptimizationDirection(self.model.sense == pl.LpMaximize)
+
+    def sensitivity(self) -> pd.DataFrame:
+        """dual values and reduced costs as reported by the solver, see ortools_plan"""
+        table = pd.DataFrame(
+            {
+                "dual": [c.pi for c in self.minimum_constraints],
+                "gross_production_reduced_cost": [v.dj for v in self.gross_production],
+                "net_production_reduced_cost": [v.dj for v in self.net_production],
+            },
+            index=pd.Index(self.input.product_names, name="product"),
+        )
+        # the products left out by presolve are at zero, see ortools_plan
+        table = table.reindex(
+            pd.Index([*self.input.product_names, *self.dropped_products], name="product"),
+            fill_value=0.0,
+        )
+        table.loc["environmental allowance", "dual"] = self.environmental_allowance.pi
+        return table / self.objective_scale
+
+    def write_model(self, path: str) -> None:
+        """the full model in LP or MPS format by the extension of path, .gz compresses,
+        written row by row like the model of ortools_plan"""
+        write_model(LinearProgram.from_pulp(self.model).to_proto(), path)
 
     def output_solution(self, debug: bool) -> None:
         if debug:
-            self.print_model()
             print(f"Status: {pl.LpStatus[self.model.status]}")
             print("\n")
         print("Suggested Plan")
         print("--------------")
+        labor_unit = self.input.labour_resource.unit
         for product_name in self.input.product_names:
             product = self.input.product_map[product_name]
+            gross = self.gross_production_of[product_name].varValue
+            net = self.net_production_of[product_name].varValue
             print(
-                f"{product.name}: {self.gross_production_of[product_name].varValue:.3f}{product.unit}, "
-                f"net output {self.net_production_of[product_name].varValue:.3f}{product.unit}, "
+                f"{product.name}: {gross:.3f}{product.unit}, "
+                f"net output {net:.3f}{product.unit}, "
                 f"minimum {product.minimum:.3f}{product.unit}, "
-                f"envimpact: {self.gross_production_of[product_name].varValue * product.envimpact:.3f}, "
-                f"work: {self.gross_production_of[product_name].varValue * product.required_labor:.3f}{self.input.labour_resource.unit}, "
+                f"envimpact: {gross * product.envimpact:.3f}, "
+                f"work: {gross * product.required_labor:.3f}{labor_unit}, "
             )
+        for product_name in self.dropped_products:
+            print(f"{product_name}: 0, left out by presolve")
+        print(f"Total labor: {self.total_labor.varValue:0.3f}{labor_unit}")
         print(
-            f"Total labor: {self.total_labor.varValue:0.3f}{self.input.labour_resource.unit}"
-        )
-        print(
-            f"Used environmental credit: {self.total_environmental_credit.varValue:0.3f}/{self.ENV_ALLOWANCE:0.3f}"
+            "Used environmental credit: "
+            f"{self.total_environmental_credit.varValue:0.3f}/{self.ENV_ALLOWANCE:0.3f}"
         )
 
 @click.command()
 @click.argument('input_folder', default='./input_simple')
 @click.option('--debug/--nodebug', default=False, show_default=True, type=bool)
-def plan(input_folder: str, debug: bool):
-    planner = Planner(input_folder, debug)
-    planner.process()
+@click.option('--lexicographic', default=None, type=float, metavar='EPSILON',
+              help='keep every earlier objective within EPSILON of its optimum')
+@click.option('--metrics', default=None,
+              help='write phase timings and model size as json to this file')
+@click.option('--model-file', default=None,
+              help='write the model of each objective, LP or MPS by extension, '
+                   '.gz compresses, e.g. plan.mps.gz')
+@click.option('--sensitivity', default=None,
+              help='write the dual values and reduced costs of each objective as csv, '
+                   'e.g. duals.csv')
+@click.option('--backend', default='pulp_cbc', show_default=True, type=click.Choice(BACKENDS),
+              help='solver, see solver_backends')
+@click.option('--presolve/--no-presolve', default=False, show_default=True,
+              help='leave out products without minimum or objective weight '
+                   'that no other product needs')
+def plan(input_folder: str, debug: bool, lexicographic: Optional[float],
+         metrics: Optional[str], model_file: Optional[str], sensitivity: Optional[str],
+         backend: str, presolve: bool):
+    planner = Planner(input_folder, debug, lexicographic, model_file, sensitivity, backend,
+                      presolve)
+    try:
+        planner.process()
+    except ValueError as error:
+        sys.exit(str(error))
+    if metrics:
+        planner.instrumentation.write_json(metrics)
 
 if __name__ == '__main__':
-    plan()
+    # click fills in the arguments
+    plan()  # pylint: disable=no-value-for-parameter
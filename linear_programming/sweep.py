@@ -0,0 +1,65 @@
+"""Solves the minimum labor and the maximum production objective of one input folder
+for every scenario of a sweep spec, see planning_common.sweep, and writes one row
+per scenario:
+    python sweep.py input_uk sweep.json --output sweep.csv
+A scenario overrides the arguments of Planner.scale_parameters, the scale of the
+minimums, the environmental allowance and the priorities of single products. Both
+objectives are solved on one model, the second from the basis of the first, and the
+row holds the status of each and, for an optimal solve, its objective, total labor
+and used environmental credit."""
+
+import contextlib
+import io
+import json
+import time
+from typing import Any, Optional
+
+import click
+from ortools.linear_solver import pywraplp
+
+from planning_common.sweep import run_sweep, scenarios_from_spec
+from ortools_plan import Planner
+
+
+def solve_scenario(input_folder: str, overrides: dict[str, Any]) -> dict[str, Any]:
+    start = time.perf_counter()
+    row = {key: json.dumps(value) for key, value in overrides.items()}
+    # the planner prints its plans, which would interleave between the workers
+    with contextlib.redirect_stdout(io.StringIO()):
+        planner = Planner(input_folder, debug=False)
+        planner.scale_parameters(**overrides)
+        objectives = {
+            "min_labor": planner.set_min_labor_objective,
+            "max_production": planner.set_max_production_objective,
+        }
+        planner.add_variables()
+        planner.add_constraints()
+        for name, objective in objectives.items():
+            planner.add_objective(objective)
+            planner.solve()
+            row[f"{name}_status"] = planner.result_status
+            if planner.result_status == pywraplp.Solver.OPTIMAL:
+                row[f"{name}_objective"] = planner.objective_value()
+                row[f"{name}_total_labor"] = planner.total_labor.solution_value()
+                row[f"{name}_environmental_credit"] = (
+                    planner.total_environmental_credit.solution_value()
+                )
+    row["wall_time"] = time.perf_counter() - start
+    return row
+
+
+@click.command()
+@click.argument("input_folder", default="./input_simple")
+@click.argument("spec_file", type=click.File())
+@click.option("--output", default="sweep.csv", show_default=True, help="consolidated results table")
+@click.option(
+    "--workers", default=None, type=int, help="processes, defaults to the number of cores"
+)
+def sweep(input_folder: str, spec_file, output: str, workers: Optional[int]):
+    scenarios = scenarios_from_spec(json.load(spec_file))
+    run_sweep(solve_scenario, input_folder, scenarios, output, workers)
+
+
+if __name__ == "__main__":
+    # click fills in the arguments
+    sweep()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+#
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from click.testing import CliRunner
+from ortools.linear_solver import linear_solver_pb2
+from ortools.linear_solver import pywraplp
+# the modules under test are scripts of the linear_programming folder, which the tests
+# also find when they run from elsewhere, e.g. the top of the repository
+LINEAR_PROGRAMMING_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, LINEAR_PROGRAMMING_DIR)
+INPUT_SIMPLE = os.path.join(LINEAR_PROGRAMMING_DIR, 'input_simple')
+import ortools_plan
+import pulp_plan
+import sweep
+from planning_common.solver_backends import LinearProgram
+
+# the objectives of the original planners on input_simple. Their production
+# objective kept the labor coefficients of the first objective, this is the
+# production objective of their plan
+BASELINE = {
+    'set_min_labor_objective': 1.2086331313131313,
+    'set_max_production_objective': 61.755707345575956,
+}
+PLANNERS = [
+    (ortools_plan, 'glop'),
+    (pulp_plan, 'glop'),
+    (pulp_plan, 'pulp_cbc'),
+]
+
+
+def run_planner(module, backend, input_folder=INPUT_SIMPLE, **options):
+    with contextlib.redirect_stdout(io.StringIO()):
+        planner = module.Planner(input_folder, False, backend=backend, **options)
+        planner.process()
+    return planner
+
+
+def objectives(planner):
+    return {name: planner.instrumentation.values[name]['objective'] for name in BASELINE}
+
+
+def input_with_unused_product(input_folder):
+    """input_simple with toys, which have no minimum and no weight in the production
+    objective and are no input of another product"""
+    shutil.copytree(INPUT_SIMPLE, input_folder, dirs_exist_ok=True)
+    for name in ['input_output.csv', 'constraints.csv', 'units.csv']:
+        table = pd.read_csv(os.path.join(input_folder, name))
+        table['toys'] = {'input_output.csv': 0.0, 'constraints.csv': 0.0, 'units.csv': 'u'}[name]
+        if name == 'input_output.csv':
+            table.loc[table['headings'] == 'wheat', 'toys'] = 0.2
+            table.loc[table['headings'] == 'labor', 'toys'] = 0.3
+            # the row sits before labor like the other products
+            labor = table[table['headings'] == 'labor']
+            toys = pd.DataFrame([{'headings': 'toys', **{column: 0.0 for column in table.columns[1:]}}])
+            table = pd.concat([table[table['headings'] != 'labor'], toys, labor], ignore_index=True)
+        table.to_csv(os.path.join(input_folder, name), index=False)
+
+
+class TestPlanners(unittest.TestCase):
+
+    def test_objectives_match_baseline(self):
+        for module, backend in PLANNERS:
+            for presolve in [False, True]:
+                with self.subTest(planner=module.__name__, backend=backend, presolve=presolve):
+                    planner = run_planner(module, backend, presolve=presolve)
+                    self.assertEqual(planner.dropped_products, [])
+                    for name, value in objectives(planner).items():
+                        self.assertAlmostEqual(value, BASELINE[name], delta=1e-7 * BASELINE[name])
+
+    def test_presolve_keeps_the_objectives(self):
+        with tempfile.TemporaryDirectory() as input_folder:
+            input_with_unused_product(input_folder)
+            for module, backend in PLANNERS:
+                for presolve in [False, True]:
+                    with self.subTest(planner=module.__name__, backend=backend, presolve=presolve):
+                        planner = run_planner(module, backend, input_folder, presolve=presolve)
+                        self.assertEqual(planner.dropped_products, ['toys'] if presolve else [])
+                        self.assertEqual('toys' in planner.input.product_names, not presolve)
+                        for name, value in objectives(planner).items():
+                            self.assertAlmostEqual(value, BASELINE[name], delta=1e-7 * BASELINE[name])
+
+    def test_sensitivity_covers_the_dropped_products(self):
+        with tempfile.TemporaryDirectory() as input_folder:
+            input_with_unused_product(input_folder)
+            tables = []
+            for module, backend in PLANNERS[:2]:
+                with self.subTest(planner=module.__name__):
+                    planner = run_planner(module, backend, input_folder, presolve=True)
+                    table = planner.sensitivity()
+                    self.assertEqual(list(table.index),
+                                     ['wheat', 'bread', 'pizza', 'beer', 'childcare', 'toys',
+                                      'environmental allowance'])
+                    self.assertTrue((table.loc['toys'] == 0).all())
+                    tables.append(table)
+            pd.testing.assert_frame_equal(tables[0], tables[1], atol=1e-9)
+
+    def test_lexicographic_bound(self):
+        epsilon = 0.01
+        productions = []
+        for module, backend in PLANNERS:
+            with self.subTest(planner=module.__name__, backend=backend):
+                planner = run_planner(module, backend, lexicographic_epsilon=epsilon)
+                values = objectives(planner)
+                self.assertAlmostEqual(values['set_min_labor_objective'], BASELINE['set_min_labor_objective'])
+                # the production objective is bought with at most 1% more labor
+                total_labor = (planner.total_labor.solution_value() if module is ortools_plan
+                               else planner.total_labor.varValue)
+                self.assertLessEqual(total_labor, BASELINE['set_min_labor_objective'] * (1 + epsilon) + 1e-7)
+                self.assertLess(values['set_max_production_objective'], BASELINE['set_max_production_objective'])
+                productions.append(values['set_max_production_objective'])
+        np.testing.assert_allclose(productions, productions[0], rtol=1e-6)
+
+    def test_pulp_solver_is_kept_across_objectives(self):
+        planner = run_planner(pulp_plan, 'glop', lexicographic_epsilon=0.01)
+        # both objectives and the bound on the first are in the one solver
+        self.assertEqual(planner.solver.NumConstraints(), len(planner.model.constraints))
+        self.assertEqual(planner.solver.NumConstraints(), planner.instrumentation.values['constraints'] + 1)
+
+    def test_pulp_cbc_solves_the_pulp_model(self):
+        planner = run_planner(pulp_plan, 'pulp_cbc', lexicographic_epsilon=0.01)
+        # CBC gets the one PuLP model, no Solver holds a copy
+        self.assertIsNone(planner.solver)
+        self.assertIn('bound_set_min_labor_objective', list(planner.model.constraints))
+        self.assertIsNotNone(planner.environmental_allowance.pi)
+        self.assertIsNone(planner.instrumentation.values['set_max_production_objective']['iterations'])
+
+    def test_rows_are_built_from_the_input_arrays(self):
+        planner = run_planner(ortools_plan, 'glop')
+        model = linear_solver_pb2.MPModelProto()
+        planner.solver.ExportModelToProto(model)
+        matrix = LinearProgram.from_proto(model).constraint_matrix.toarray()
+        num_products = len(planner.input.product_names)
+        gross = [variable.index() for variable in planner.gross_production]
+        net = [variable.index() for variable in planner.net_production]
+        # (I - A) gross - net == 0, then the labor and environmental impact totals
+        np.testing.assert_allclose(matrix[:num_products][:, gross], planner.input.net_matrix().toarray())
+        np.testing.assert_allclose(matrix[:num_products][:, net], -np.identity(num_products))
+        np.testing.assert_allclose(matrix[num_products, gross], -planner.input.labor)
+        np.testing.assert_allclose(matrix[num_products + 1, gross], -planner.input.envimpact)
+        self.assertEqual(planner.instrumentation.values['nonzeros'], np.count_nonzero(matrix))
+
+        pulp_planner = run_planner(pulp_plan, 'glop')
+        self.assertEqual(pulp_planner.instrumentation.values['nonzeros'], np.count_nonzero(matrix))
+
+    def test_write_model(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            for module, backend in PLANNERS[:2]:
+                with self.subTest(planner=module.__name__):
+                    model_file = os.path.join(output_dir, f"{module.__name__}.lp")
+                    run_planner(module, backend, model_file=model_file)
+                    with open(os.path.join(output_dir, f"{module.__name__}_set_min_labor_objective.lp"),
+                              encoding='utf-8') as lp_file:
+                        lp = lp_file.read()
+                    self.assertIn('Minimize', lp)
+                    self.assertNotIn('-0.0\n', lp)
+
+
+class TestSweep(unittest.TestCase):
+
+    def test_scenarios_from_spec(self):
+        spec = {'grid': {'targets_scale': [0.9, 1.0, 1.1], 'env_allowance': [50, 100]}}
+        scenarios = sweep.scenarios_from_spec(spec)
+        self.assertEqual(len(scenarios), 6)
+        self.assertEqual(scenarios[0], {'targets_scale': 0.9, 'env_allowance': 50})
+        self.assertEqual(sweep.scenarios_from_spec({'scenarios': [{'targets_scale': 2}]}), [{'targets_scale': 2}])
+
+    def test_solve_scenario(self):
+        row = sweep.solve_scenario(INPUT_SIMPLE, {})
+        self.assertEqual(row['min_labor_status'], pywraplp.Solver.OPTIMAL)
+        self.assertAlmostEqual(row['min_labor_objective'], BASELINE['set_min_labor_objective'])
+        self.assertAlmostEqual(row['max_production_objective'], BASELINE['set_max_production_objective'])
+        # the labor of the cheapest plan grows with the minimums it has to meet
+        doubled = sweep.solve_scenario(INPUT_SIMPLE, {'targets_scale': 2})
+        self.assertAlmostEqual(doubled['min_labor_objective'], 2 * BASELINE['set_min_labor_objective'])
+        self.assertEqual(doubled['targets_scale'], '2')
+
+    def test_sweep_writes_one_row_per_scenario(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            spec_file = os.path.join(output_dir, 'sweep.json')
+            with open(spec_file, 'w', encoding='utf-8') as spec:
+                json.dump({'grid': {'env_allowance': [50, 100], 'prio': [{'bread': 1}]}}, spec)
+            output = os.path.join(output_dir, 'results', 'sweep.csv')
+            result = CliRunner().invoke(
+                sweep.sweep, [INPUT_SIMPLE, spec_file, '--output', output, '--workers', '1'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            table = pd.read_csv(output, index_col='scenario')
+            self.assertEqual(list(table['env_allowance']), [50, 100])
+            self.assertTrue((table['max_production_environmental_credit'] <= table['env_allowance'] + 1e-9).all())
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import pandas as pd
+# the modules under test are scripts of the linear_programming folder, which the tests
+# also find when they run from elsewhere, e.g. the top of the repository
+LINEAR_PROGRAMMING_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, LINEAR_PROGRAMMING_DIR)
+INPUT_SIMPLE = os.path.join(LINEAR_PROGRAMMING_DIR, 'input_simple')
+import planning_input as planning_input_module
+from planning_input import PRODUCT_DEFAULTS, PlanningInput
+
+
+def load(input_folder):
+    planning_input = PlanningInput(input_folder)
+    planning_input.load_data()
+    return planning_input
+
+
+class TestPlanningInput(unittest.TestCase):
+
+    def setUp(self):
+        input_folder = tempfile.TemporaryDirectory()
+        self.addCleanup(input_folder.cleanup)
+        self.input_folder = input_folder.name
+        shutil.copytree(INPUT_SIMPLE, self.input_folder, dirs_exist_ok=True)
+
+    def edit(self, name, edit):
+        path = os.path.join(self.input_folder, name)
+        table = pd.read_csv(path)
+        edit(table)
+        table.to_csv(path, index=False)
+
+    def test_load_data(self):
+        planning_input = load(INPUT_SIMPLE)
+        table = pd.read_csv(os.path.join(INPUT_SIMPLE, 'input_output.csv')).set_index('headings')
+        self.assertEqual(list(planning_input.product_names), ['wheat', 'bread', 'pizza', 'beer', 'childcare'])
+        self.assertEqual(planning_input.ingredient_names, list(table.index))
+        np.testing.assert_array_equal(planning_input.ingredients.toarray(), table.to_numpy())
+        np.testing.assert_array_equal(planning_input.technology_matrix.toarray(),
+                                      table.loc[planning_input.product_names].to_numpy())
+        np.testing.assert_array_equal(planning_input.labor, table.loc['labor'].to_numpy())
+        # only the nonzero cells are stored
+        self.assertEqual(planning_input.ingredients.nnz, np.count_nonzero(table.to_numpy()))
+        np.testing.assert_array_equal(planning_input.minimum, [0.001, 0.06, 0.002, 0.2, 1.2])
+        self.assertEqual(list(planning_input.units), ['t', 't', 't', 'kl', 'kh'])
+
+    def test_product_views(self):
+        planning_input = load(INPUT_SIMPLE)
+        bread = planning_input.product_map['bread']
+        self.assertEqual({key: ingredient.amount for key, ingredient in bread.ingredients.items()},
+                         {'wheat': 0.9, 'labor': 0.05})
+        self.assertEqual(bread.required_labor, 0.05)
+        self.assertEqual((bread.unit, bread.minimum, bread.prio, bread.envimpact), ('t', 0.06, 10, 1))
+        self.assertEqual(len(planning_input.product_map), 5)
+        # the views read the arrays, so they follow later changes
+        planning_input.prio = np.array([5, 3, 2, 1, 9])
+        self.assertEqual(planning_input.product_map['bread'].prio, 3)
+
+    def test_output_row_scales_to_one_unit(self):
+        def add_output_row(table):
+            table.loc[len(table)] = ['output', 1, 2, 1, 1, 1]
+        self.edit('input_output.csv', add_output_row)
+        planning_input = load(self.input_folder)
+        self.assertNotIn('output', planning_input.ingredient_names)
+        self.assertAlmostEqual(planning_input.product_map['bread'].ingredients['wheat'].amount, 0.45)
+        self.assertAlmostEqual(planning_input.labor[1], 0.025)
+        self.assertAlmostEqual(planning_input.labor[0], 0.01)
+
+    def test_chunked_read(self):
+        def add_output_row(table):
+            table.loc[len(table)] = ['output', 1, 2, 1, 1, 1]
+        self.edit('input_output.csv', add_output_row)
+        whole = load(self.input_folder)
+        # two rows per chunk, the output row is in the last one
+        with mock.patch.object(planning_input_module, 'CHUNK_CELLS', 10):
+            chunked = load(self.input_folder)
+        self.assertEqual(chunked.ingredient_names, whole.ingredient_names)
+        np.testing.assert_array_equal(chunked.ingredients.toarray(), whole.ingredients.toarray())
+        np.testing.assert_array_equal(chunked.labor, whole.labor)
+
+    def test_constraint_defaults(self):
+        self.edit('constraints.csv', lambda table: table.drop(table.index[table['headings'] == 'prio'], inplace=True))
+        planning_input = load(self.input_folder)
+        np.testing.assert_array_equal(planning_input.prio, PRODUCT_DEFAULTS['prio'])
+
+        def clear_minimum(table):
+            table.loc[table['headings'] == 'minimum', 'beer'] = np.nan
+        self.edit('constraints.csv', clear_minimum)
+        with self.assertRaisesRegex(ValueError, r"no minimum for \['beer'\]"):
+            load(self.input_folder)
+
+    def test_presolve(self):
+        planning_input = load(INPUT_SIMPLE)
+        # beer is no input of any other product
+        planning_input.minimum = np.array([0.001, 0.06, 0.002, 0, 1.2])
+        planning_input.prio = np.array([5, 10, 2, 0, 9])
+        self.assertEqual(planning_input.presolve(), ['beer'])
+        self.assertEqual(list(planning_input.product_names), ['wheat', 'bread', 'pizza', 'childcare'])
+        self.assertEqual(planning_input.ingredients.shape, (6, 4))
+        self.assertEqual(planning_input.technology_matrix.shape, (4, 4))
+        np.testing.assert_array_equal(planning_input.labor, [0.01, 0.05, 0.1, 1.0])
+        self.assertEqual(planning_input.product_map['childcare'].ingredients['bread'].amount, 0.01)
+
+    def test_labor_values(self):
+        planning_input = load(INPUT_SIMPLE)
+        # the labor of the minimums, which is the optimum of the min labor objective
+        self.assertAlmostEqual(planning_input.labor_values() @ planning_input.minimum, 1.2086331313131313)
+        gross_output = planning_input.gross_output(planning_input.minimum)
+        np.testing.assert_allclose(planning_input.net_matrix() @ gross_output, planning_input.minimum)
@@ -0,0 +1,4 @@
+"""Modules shared by the planners in experiment3 and linear_programming.
+
+pip install -r requirements.txt installs this package in editable mode, so the
+planners import it from any folder."""
@@ -0,0 +1,76 @@
+"""Per-phase timing and model size records of a planner run.
+
+Every phase records its wall time and by how much it raised the resident memory
+high-water mark of the process, max_rss_growth_bytes, which stays zero for a phase
+that remains below the peak of an earlier one. The operating system keeps only
+that one mark for the whole process, to_dict adds it as max_rss_bytes. The peak of
+each phase itself needs trace_memory=True, which records the peak of the memory
+traced by tracemalloc (Python objects and numpy buffers) during the phase. Tracing
+slows allocation-heavy code down, so it is off by default. Model sizes, solver
+iterations and status are added with record. Everything ends up in to_dict and is
+written as JSON or logged at INFO level to the 'instrumentation' logger."""
+
+import contextlib
+import json
+import logging
+import resource
+import time
+import tracemalloc
+
+logger = logging.getLogger('instrumentation')
+
+
+def max_rss_bytes():
+    """the resident memory high-water mark of the process so far"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Instrumentation:
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.phases = {}
+        self.values = {}
+        self.__peaks = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """measures the enclosed code, phases may be nested and repeated, repeated
+        phases add up their wall time"""
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            if self.__peaks:
+                self.__peaks[-1] = max(self.__peaks[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self.__peaks.append(0)
+        start = time.perf_counter()
+        start_rss = max_rss_bytes()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - start
+            rss_growth = max_rss_bytes() - start_rss
+            measured = self.phases.setdefault(
+                name, {'wall_time': 0.0, 'calls': 0, 'max_rss_growth_bytes': 0})
+            measured['wall_time'] += wall_time
+            measured['calls'] += 1
+            measured['max_rss_growth_bytes'] += rss_growth
+            if self.trace_memory:
+                peak = max(self.__peaks.pop(), tracemalloc.get_traced_memory()[1])
+                if self.__peaks:
+                    self.__peaks[-1] = max(self.__peaks[-1], peak)
+                tracemalloc.reset_peak()
+                measured['peak_traced_bytes'] = max(measured.get('peak_traced_bytes', 0), peak)
+            logger.info("%s: %.3fs, max rss +%.1f MB", name, wall_time, rss_growth / 2**20)
+
+    def record(self, **values):
+        """e.g. variable, constraint and nonzero counts, iterations or the solver status"""
+        self.values.update(values)
+        logger.info(", ".join(f"{key}: {value}" for key, value in values.items()))
+
+    def to_dict(self):
+        return {'phases': self.phases, 'max_rss_bytes': max_rss_bytes(), **self.values}
+
+    def write_json(self, path):
+        with open(path, 'w') as json_file:
+            json.dump(self.to_dict(), json_file, indent=2)
@@ -0,0 +1,257 @@
+"""Gross output and labor values from one sparse LU factorization of I - A, or from
+matrix-vector products with A alone for tables too large to factorize.
+
+A[i, j] is the amount of product i used up per unit of gross output of product j.
+The gross output x that leaves the final demand d after the inputs are taken out is
+the solution of (I - A) x = d, the labor values are lambda = l (I - A)^-1 for the
+direct labor l per unit of output, i.e. the solution of (I - A)^T lambda = l. Both
+are two triangular solves with the LU factors, so a batch of demands or labor rows
+costs a fraction of the factorization, which is done once per technology matrix:
+leontief_inverse keeps the last CACHE_SIZE factorizations of the process keyed by a
+hash of the matrix data, so planners holding the same A share one. The fill-in of the
+factors can grow far beyond nnz(A) for large tables, IterativeLeontief only holds A and
+a few vectors per demand and stops at a given residual, leontief_solver picks either.
+
+Neither is meaningful for an economy that is not productive, where some products use
+up more of themselves, directly or through other products, than they make: the
+spectral radius of A is 1 or more (the Hawkins-Simon condition fails) and (I - A)^-1,
+where it exists, has negative entries. productivity_blocks finds the groups of
+products responsible from the strongly connected components of A, required_products
+finds the products a demand needs at all by following A backwards from it."""
+
+import hashlib
+import math
+from collections import OrderedDict
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import breadth_first_order, connected_components
+from scipy.sparse.linalg import LinearOperator, eigs, gmres, splu
+
+CACHE_SIZE = 8
+_factorizations = OrderedDict()
+METHODS = ('lu', 'jacobi', 'gmres')
+GMRES_RESTART = 30
+DENSE_EIGENVALUES = 500
+
+
+def matrix_key(matrix):
+    """content hash of a sparse or dense matrix, equal for equal matrices in any format"""
+    matrix = sparse.csr_matrix(matrix, dtype=float)
+    matrix.sum_duplicates()
+    matrix.eliminate_zeros()
+    digest = hashlib.sha256(repr(matrix.shape).encode())
+    for array in (matrix.indptr, matrix.indices, matrix.data):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def spectral_radius(technology_matrix):
+    """the largest absolute eigenvalue of A, the economy is productive if it is below 1"""
+    return max((radius for _, radius in productivity_blocks(technology_matrix)), default=0.0)
+
+
+def productivity_blocks(technology_matrix):
+    """(product indices, spectral radius) of every group of products that use each other
+    directly or indirectly, the strongly connected components of A. The spectral radius
+    of A is the largest of theirs, a block at 1 or above cannot produce a net output"""
+    matrix = sparse.csr_matrix(technology_matrix, dtype=float)
+    count, labels = connected_components(matrix, directed=True, connection='strong')
+    sizes = np.bincount(labels, minlength=count)
+    # a product that uses no other product of its block is a block of its own, its
+    # spectral radius is its own input per unit of output
+    diagonal = matrix.diagonal()
+    blocks = [([i], float(abs(diagonal[i]))) for i in np.flatnonzero(sizes[labels] == 1)]
+    for label in np.flatnonzero(sizes > 1):
+        indices = np.flatnonzero(labels == label)
+        block = matrix[indices][:, indices]
+        if len(indices) <= DENSE_EIGENVALUES:
+            radius = np.abs(np.linalg.eigvals(block.toarray())).max()
+        else:
+            radius = np.abs(eigs(block, k=1, which='LM', return_eigenvectors=False)).max()
+        blocks.append((list(indices), float(radius)))
+    return blocks
+
+
+def required_products(input_matrix, demanded):
+    """mask of the products that the demanded ones need directly or through the inputs
+    of other products, input_matrix[q, p] is nonzero where p uses q, e.g. A or a
+    capital coefficient matrix, demanded a mask or index array of products"""
+    size = input_matrix.shape[0]
+    demanded = np.asarray(demanded)
+    if demanded.dtype == bool:
+        demanded = np.flatnonzero(demanded)
+    # edges from every product to its inputs and from an extra node to every demanded
+    # product, the products reached from that node are the required ones
+    uses = sparse.csr_matrix(input_matrix)
+    uses.eliminate_zeros()
+    uses = uses.T.tocoo()
+    graph = sparse.csr_matrix(
+        (np.ones(uses.nnz + len(demanded)),
+         (np.concatenate([uses.row, np.full(len(demanded), size)]),
+          np.concatenate([uses.col, demanded]))),
+        shape=(size + 1, size + 1))
+    required = np.zeros(size + 1, dtype=bool)
+    required[breadth_first_order(graph, size, directed=True, return_predecessors=False)] = True
+    return required[:size]
+
+
+def leontief_solver(technology_matrix, method='lu', **options):
+    """the cached LeontiefInverse for method lu, an IterativeLeontief with options
+    (tolerance, max_iterations) for jacobi and gmres"""
+    if method not in METHODS:
+        raise ValueError(f"unknown method {method}, choose one of {', '.join(METHODS)}")
+    if method == 'lu':
+        return leontief_inverse(technology_matrix)
+    return IterativeLeontief(technology_matrix, method, **options)
+
+
+def leontief_inverse(technology_matrix):
+    """the cached LeontiefInverse of technology_matrix"""
+    key = matrix_key(technology_matrix)
+    inverse = _factorizations.get(key)
+    if inverse is None:
+        inverse = LeontiefInverse(technology_matrix, key)
+        _factorizations[key] = inverse
+        if len(_factorizations) > CACHE_SIZE:
+            _factorizations.popitem(last=False)
+    _factorizations.move_to_end(key)
+    return inverse
+
+
+class LeontiefInverse:
+    """(I - A)^-1 applied through the LU factors of I - A, which stay sparse where the
+    inverse itself is dense"""
+
+    def __init__(self, technology_matrix, key=None):
+        technology_matrix = sparse.csc_matrix(technology_matrix, dtype=float)
+        self.size = technology_matrix.shape[0]
+        if technology_matrix.shape != (self.size, self.size):
+            raise ValueError(
+                f"the technology matrix has to be square, not {technology_matrix.shape}")
+        self.key = key or matrix_key(technology_matrix)
+        try:
+            self.lu = splu(sparse.identity(self.size, format='csc') - technology_matrix)
+        except RuntimeError as error:
+            raise ValueError(
+                f"I - A is singular, the economy cannot produce some products: {error}") from error
+
+    def gross_output(self, final_demand):
+        """x with (I - A) x = d for one demand vector or a batch of them along the last
+        axis, e.g. a year x product array"""
+        return self.__solve(final_demand, 'N')
+
+    def labor_values(self, labor):
+        """lambda = l (I - A)^-1, the direct and indirect labor per unit of final product,
+        for one row of direct labor per unit of output or a batch of them"""
+        return self.__solve(labor, 'T')
+
+    def __solve(self, values, trans):
+        values = np.asarray(values, dtype=float)
+        if values.shape[-1] != self.size:
+            raise ValueError(
+                f"expected {self.size} products along the last axis, got {values.shape}")
+        columns = values.reshape(-1, self.size).T
+        return self.lu.solve(np.ascontiguousarray(columns), trans=trans).T.reshape(values.shape)
+
+
+class IterativeLeontief:
+    """(I - A)^-1 applied with products of A and a vector only, memory is nnz(A) plus a
+    few vectors per demand, GMRES_RESTART of them for gmres.
+    - jacobi iterates x = D^-1 (A' x + d) with D the diagonal and A' the off-diagonal
+      part of I - A, for a zero diagonal the power series d + A d + A^2 d + ..., which
+      converges for every productive economy, slowly if it is close to unproductive
+    - gmres, a Krylov method that needs far fewer products in that case
+    Both stop once the relative residual |d - (I - A) x|_2 / |d|_2 is within tolerance or
+    after max_iterations products. error holds the estimates of the last solve: the
+    largest relative residual, and, where a norm of A is below 1, a bound on the
+    largest absolute error of any x, residual / (1 - |A|)"""
+
+    def __init__(self, technology_matrix, method='gmres', tolerance=1e-10, max_iterations=1000):
+        if method not in ('jacobi', 'gmres'):
+            raise ValueError(f"unknown iterative method {method}, choose jacobi or gmres")
+        self.matrix = sparse.csr_matrix(technology_matrix, dtype=float)
+        self.size = self.matrix.shape[0]
+        if self.matrix.shape != (self.size, self.size):
+            raise ValueError(f"the technology matrix has to be square, not {self.matrix.shape}")
+        self.method = method
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.error = None
+
+    def gross_output(self, final_demand):
+        """x with (I - A) x = d for one demand vector or a batch along the last axis"""
+        return self.__solve(final_demand, self.matrix)
+
+    def labor_values(self, labor):
+        """lambda = l (I - A)^-1 for one row of direct labor per unit of output or a batch"""
+        return self.__solve(labor, self.matrix.T.tocsr())
+
+    def __solve(self, values, matrix):
+        values = np.asarray(values, dtype=float)
+        if values.shape[-1] != self.size:
+            raise ValueError(
+                f"expected {self.size} products along the last axis, got {values.shape}")
+        rhs = values.reshape(-1, self.size).T
+        if self.method == 'jacobi':
+            solution, iterations = self.__jacobi(matrix, rhs)
+        else:
+            solution, iterations = self.__gmres(matrix, rhs)
+
+        residual = rhs - solution + matrix @ solution
+        relative_residual = float(self.__relative_norms(residual, rhs).max(initial=0.0))
+        # |x - x_k| <= |(I - A)^-1| |r| <= |r| / (1 - |A|) in the 1 and max norms, and the
+        # max norm of a vector is at most its 1 norm
+        bounds = [np.abs(residual).sum(axis=0).max(initial=0.0) / (1 - norm) if p == 1
+                  else np.abs(residual).max(initial=0.0) / (1 - norm)
+                  for p, norm in self.__norms(matrix).items() if norm < 1]
+        self.error = {
+            'method': self.method,
+            'iterations': iterations,
+            'relative_residual': relative_residual,
+            'error_bound': float(min(bounds)) if bounds else math.nan,
+            'converged': relative_residual <= self.tolerance,
+        }
+        return solution.T.reshape(values.shape)
+
+    @staticmethod
+    def __norms(matrix):
+        absolute = abs(matrix)
+        return {1: np.asarray(absolute.sum(axis=0)).max(initial=0.0),
+                math.inf: np.asarray(absolute.sum(axis=1)).max(initial=0.0)}
+
+    @staticmethod
+    def __relative_norms(residual, rhs):
+        # per column in the 2 norm like gmres, zero demands are measured absolutely
+        scale = np.linalg.norm(rhs, axis=0)
+        return np.linalg.norm(residual, axis=0) / np.where(scale > 0, scale, 1.0)
+
+    def __jacobi(self, matrix, rhs):
+        diagonal = 1 - matrix.diagonal()
+        if (diagonal == 0).any():
+            raise ValueError("a product that uses up all of its own output cannot be produced")
+        off_diagonal = matrix - sparse.diags(matrix.diagonal())
+        solution = rhs / diagonal[:, np.newaxis]
+        for iteration in range(1, self.max_iterations + 1):
+            # one product per iteration serves the residual check and the next iterate
+            product = off_diagonal @ solution
+            residual = rhs + product - diagonal[:, np.newaxis] * solution
+            if self.__relative_norms(residual, rhs).max(initial=0.0) <= self.tolerance:
+                return solution, iteration
+            solution = (rhs + product) / diagonal[:, np.newaxis]
+        return solution, self.max_iterations
+
+    def __gmres(self, matrix, rhs):
+        operator = LinearOperator(matrix.shape, matvec=lambda x: x - matrix @ x, dtype=float)
+        solution = np.zeros_like(rhs)
+        iterations = 0
+
+        def count(_):
+            nonlocal iterations
+            iterations += 1
+        for k in range(rhs.shape[1]):
+            solution[:, k] = gmres(operator, rhs[:, k], rtol=self.tolerance, atol=0.0,
+                                   restart=GMRES_RESTART,
+                                   maxiter=math.ceil(self.max_iterations / GMRES_RESTART),
+                                   callback=count, callback_type='pr_norm')[0]
+        return solution, iterations
@@ -0,0 +1,78 @@
+"""On-disk cache for built models and their solutions.
+
+Entries are keyed by a hash of the input files, so repeated runs on unchanged input
+can skip parsing, building and solving. Every entry is a directory of binary blobs
+(e.g. serialized protobufs) and the least recently used entries are evicted once the
+cache grows beyond max_bytes. The entry just stored is never evicted, even if it is
+larger than max_bytes on its own, it goes with the next store."""
+
+import hashlib
+import os
+import shutil
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+class ModelCache:
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def input_key(input_dir, file_names, *options):
+        """content hash of the input files plus any options that change the built model"""
+        digest = hashlib.sha256()
+        for file_name in file_names:
+            digest.update(file_name.encode())
+            with open(os.path.join(input_dir, file_name), 'rb') as input_file:
+                for chunk in iter(lambda: input_file.read(1 << 20), b''):
+                    digest.update(chunk)
+        for option in options:
+            digest.update(repr(option).encode())
+        return digest.hexdigest()
+
+    def load(self, key):
+        """all blobs stored for key by name, empty if there are none"""
+        entry_dir = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(entry_dir):
+            return {}
+        blobs = {}
+        for name in os.listdir(entry_dir):
+            with open(os.path.join(entry_dir, name), 'rb') as blob_file:
+                blobs[name] = blob_file.read()
+        # mark as recently used for eviction
+        os.utime(entry_dir)
+        return blobs
+
+    def store(self, key, **blobs):
+        entry_dir = os.path.join(self.cache_dir, key)
+        os.makedirs(entry_dir, exist_ok=True)
+        for name, blob in blobs.items():
+            path = os.path.join(entry_dir, name)
+            # write and rename so that an interrupted run never leaves a truncated blob
+            with open(f"{path}.tmp", 'wb') as blob_file:
+                blob_file.write(blob)
+            os.replace(f"{path}.tmp", path)
+        os.utime(entry_dir)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """removes the least recently used entries but keep until the cache fits max_bytes"""
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            if key == keep:
+                continue
+            entry_dir = os.path.join(self.cache_dir, key)
+            entries.append((os.path.getmtime(entry_dir), self.__entry_size(key), entry_dir))
+        total_size = sum(size for _, size, _ in entries) + self.__entry_size(keep)
+        for _, size, entry_dir in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir)
+            total_size -= size
+
+    def __entry_size(self, key):
+        if key is None:
+            return 0
+        entry_dir = os.path.join(self.cache_dir, key)
+        return sum(os.path.getsize(os.path.join(entry_dir, name)) for name in os.listdir(entry_dir))
@@ -0,0 +1,228 @@
+"""Writes an MPModelProto to an LP or MPS file row by row.
+
+The solver's ExportModelAsLpFormat and ExportModelAsMpsFormat build the whole text as
+one string, which takes hundreds of MB for a real economy. Here only one row (or one
+column for MPS) is formatted at a time and handed to the file, so memory stays at
+the size of the model itself. Paths ending in .gz are gzip-compressed on the fly and
+the format follows the extension, e.g. plan.mps.gz or plan.lp.
+
+Names are made valid identifiers for both formats: characters other than letters,
+digits and _.!#$%&()/,;?@{}|~ are replaced by _ and the index is appended to changed
+and repeated names to keep them unique, e.g. to every row after the first of a family
+built with one name per row, unnamed variables and constraints become _x<i> and _c<i>.
+Names are cut to MAX_NAME_LENGTH characters, the limit of CPLEX LP files.
+LP files have no ranged rows, so a row bounded on both sides is written as two rows
+<name>_lhs and <name>_rhs, rows without bounds are left out. A row without
+coefficients gets the term 0 <first variable>, as many LP readers reject a row that
+starts with its sense, in a model without variables it is left out."""
+
+import gzip
+import itertools
+import math
+import os
+import re
+
+import numpy as np
+from scipy import sparse
+
+TERMS_PER_LINE = 8
+MAX_NAME_LENGTH = 255
+INVALID_NAME_CHARACTERS = re.compile(r"[^A-Za-z0-9_.!#$%&()/,;?@{}|~]")
+
+
+def model_format(path):
+    """'mps' for *.mps and *.mps.gz, 'lp' otherwise"""
+    root, extension = os.path.splitext(path)
+    if extension == '.gz':
+        extension = os.path.splitext(root)[1]
+    return 'mps' if extension.lower() == '.mps' else 'lp'
+
+
+def suffixed_path(path, suffix):
+    """inserts suffix before the extensions, e.g. plan.lp.gz -> plan_<suffix>.lp.gz"""
+    root, extension = os.path.splitext(path)
+    if extension == '.gz':
+        root, inner = os.path.splitext(root)
+        extension = inner + extension
+    return f"{root}_{suffix}{extension}"
+
+
+def open_text(path):
+    if path.endswith('.gz'):
+        # the default level 9 takes three times as long for a few percent smaller files
+        return gzip.open(path, 'wt', compresslevel=6)
+    return open(path, 'w')
+
+
+def write_model(model, path, file_format=None):
+    """file_format is 'lp' or 'mps', by default taken from the extension of path"""
+    with open_text(path) as model_file:
+        if (file_format or model_format(path)) == 'mps':
+            write_mps(model, model_file)
+        else:
+            write_lp(model, model_file)
+
+
+def identifiers(elements, prefix):
+    names = []
+    used = set()
+    for i, element in enumerate(elements):
+        if not element.name:
+            name = f"_{prefix}{i}"
+        else:
+            name = INVALID_NAME_CHARACTERS.sub('_', element.name)
+            if (name != element.name or name[0].isdigit() or len(name) > MAX_NAME_LENGTH
+                    or name in used):
+                suffix = f"#{i}"
+                name = name[:MAX_NAME_LENGTH - len(suffix)] + suffix
+        names.append(name)
+        used.add(name)
+    return names
+
+
+def number(value):
+    return repr(float(value))
+
+
+def write_terms(out, terms):
+    """terms are (coefficient, name) pairs, TERMS_PER_LINE of them per line"""
+    for chunk in iter(lambda: list(itertools.islice(terms, TERMS_PER_LINE)), []):
+        out.write(' '.join(f"{'-' if c < 0 else '+'} {number(abs(c))} {name}" for c, name in chunk))
+        out.write('\n ')
+
+
+def write_lp(model, out):
+    variable_names = identifiers(model.variable, 'x')
+    out.write(f"\\ {model.name or 'model'}\n")
+    out.write("Maximize\n" if model.maximize else "Minimize\n")
+    out.write(" obj: ")
+    objective = ((variable.objective_coefficient, name)
+                 for variable, name in zip(model.variable, variable_names)
+                 if variable.objective_coefficient)
+    write_terms(out, objective)
+    if model.objective_offset:
+        offset = model.objective_offset
+        out.write(f"{'-' if offset < 0 else '+'} {number(abs(offset))}")
+    out.write("\nSubject To\n")
+
+    for constraint, name in zip(model.constraint, identifiers(model.constraint, 'c')):
+        lower, upper = constraint.lower_bound, constraint.upper_bound
+        if not constraint.var_index and not variable_names:
+            continue
+        if lower == upper:
+            rows = [(name, '=', lower)]
+        elif math.isinf(lower) and math.isinf(upper):
+            continue
+        elif math.isinf(upper):
+            rows = [(name, '>=', lower)]
+        elif math.isinf(lower):
+            rows = [(name, '<=', upper)]
+        else:
+            rows = [(f"{name}_lhs", '>=', lower), (f"{name}_rhs", '<=', upper)]
+        for row_name, sense, rhs in rows:
+            out.write(f" {row_name}: ")
+            if constraint.var_index:
+                write_terms(out, ((c, variable_names[i])
+                                  for i, c in zip(constraint.var_index, constraint.coefficient)))
+            else:
+                write_terms(out, iter([(0.0, variable_names[0])]))
+            out.write(f"{sense} {number(rhs)}\n")
+
+    out.write("Bounds\n")
+    for variable, name in zip(model.variable, variable_names):
+        lower, upper = variable.lower_bound, variable.upper_bound
+        if lower == upper:
+            out.write(f" {name} = {number(lower)}\n")
+        elif math.isinf(lower) and math.isinf(upper):
+            out.write(f" {name} free\n")
+        elif lower != 0 or not math.isinf(upper):
+            out.write(f" {number(lower)} <= {name} <= {number(upper)}\n")
+    integers = [name for variable, name in zip(model.variable, variable_names)
+                if variable.is_integer]
+    if integers:
+        out.write("Generals\n")
+        for name in integers:
+            out.write(f" {name}\n")
+    out.write("End\n")
+
+
+def write_mps(model, out):
+    """free MPS, the COLUMNS section is written from a column-wise copy of the
+    coefficients, which are the only arrays the size of the nonzeros held here"""
+    variable_names = identifiers(model.variable, 'x')
+    constraint_names = identifiers(model.constraint, 'c')
+    out.write(f"NAME {INVALID_NAME_CHARACTERS.sub('_', model.name) or 'model'}\n")
+    if model.maximize:
+        out.write("OBJSENSE\n    MAX\n")
+
+    out.write("ROWS\n N obj\n")
+    rhs, ranges = [], []
+    for constraint, name in zip(model.constraint, constraint_names):
+        lower, upper = constraint.lower_bound, constraint.upper_bound
+        if lower == upper:
+            row_type = 'E'
+            rhs.append((name, lower))
+        elif math.isinf(lower) and math.isinf(upper):
+            row_type = 'N'
+        elif math.isinf(upper):
+            row_type = 'G'
+            rhs.append((name, lower))
+        elif math.isinf(lower):
+            row_type = 'L'
+            rhs.append((name, upper))
+        else:
+            row_type = 'G'
+            rhs.append((name, lower))
+            ranges.append((name, upper - lower))
+        out.write(f" {row_type} {name}\n")
+
+    counts = [len(constraint.var_index) for constraint in model.constraint]
+    nonzeros = sum(counts)
+    columns = sparse.csc_matrix((
+        np.fromiter(itertools.chain.from_iterable(c.coefficient for c in model.constraint),
+                    float, nonzeros),
+        (np.repeat(np.arange(len(counts)), counts),
+         np.fromiter(itertools.chain.from_iterable(c.var_index for c in model.constraint),
+                     int, nonzeros)),
+    ), shape=(len(counts), len(model.variable)))
+
+    out.write("COLUMNS\n")
+    integer = False
+    for j, (variable, name) in enumerate(zip(model.variable, variable_names)):
+        if variable.is_integer != integer:
+            integer = variable.is_integer
+            out.write(f" MARKER 'MARKER' {'INTORG' if integer else 'INTEND'}\n")
+        if variable.objective_coefficient:
+            out.write(f" {name} obj {number(variable.objective_coefficient)}\n")
+        start, end = columns.indptr[j], columns.indptr[j + 1]
+        for i, value in zip(columns.indices[start:end], columns.data[start:end]):
+            out.write(f" {name} {constraint_names[i]} {number(value)}\n")
+    if integer:
+        out.write(" MARKER 'MARKER' INTEND\n")
+
+    out.write("RHS\n")
+    if model.objective_offset:
+        out.write(f" RHS obj {number(-model.objective_offset)}\n")
+    for name, value in rhs:
+        if value:
+            out.write(f" RHS {name} {number(value)}\n")
+    if ranges:
+        out.write("RANGES\n")
+        for name, value in ranges:
+            out.write(f" RANGE {name} {number(value)}\n")
+
+    out.write("BOUNDS\n")
+    for variable, name in zip(model.variable, variable_names):
+        lower, upper = variable.lower_bound, variable.upper_bound
+        if lower == upper:
+            out.write(f" FX BND {name} {number(lower)}\n")
+        elif math.isinf(lower) and math.isinf(upper):
+            out.write(f" FR BND {name}\n")
+        else:
+            if math.isinf(lower):
+                out.write(f" MI BND {name}\n")
+            elif lower != 0 or upper < 0:
+                out.write(f" LO BND {name} {number(lower)}\n")
+            if not math.isinf(upper):
+                out.write(f" UP BND {name} {number(upper)}\n")
+    out.write("ENDATA\n")
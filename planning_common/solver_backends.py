@@ -0,0 +1,532 @@
+"""Solver backends behind one interface.
+
+The planners hold their model in a pywraplp Solver, which already wraps several
+OR-Tools solvers, so for those the backend is just the type of that solver and
+replanning, warm starts and the solution accessors keep working:
+
+- glop: primal/dual simplex, the default, re-solves start from the previous basis
+- clp: COIN-OR simplex, if OR-Tools was built with it
+
+Other solvers get the model as a LinearProgram, plain arrays with a CSR constraint
+matrix, or as the exported model, and hand back an MPSolutionResponse, which the
+planner loads into its Solver, so values, duals and reduced costs are read the same
+way for every backend:
+
+- pdlp: first-order method, multithreaded, for models too large for the simplex.
+  It is solved from a model request, as pywraplp drops the solution and the solve log
+  when PDLP stops at a limit, see PdlpOptions for its threads, tolerances, time limit
+  and polishing
+- highs: HiGHS through OR-Tools' model builder, if OR-Tools was built with it
+  (pywraplp silently falls back to PDLP for it). The model builder returns row
+  activities in place of its dual values, so only its primal solution is used
+- pulp_cbc: CBC through PuLP's command line interface
+
+pulp_plan keeps its model in PuLP. With pulp_cbc PuLP solves it with CBC directly,
+with the other backends it is loaded into a Solver through LinearProgram.from_pulp and
+solved the same way
+"""
+
+import time
+from dataclasses import dataclass, fields
+from typing import Optional
+
+import numpy as np
+from ortools.linear_solver import linear_solver_pb2
+from ortools.linear_solver import pywraplp
+from ortools.linear_solver.python import model_builder_helper as mbh
+from ortools.pdlp import solve_log_pb2
+from scipy import sparse
+
+ORTOOLS_BACKENDS = {'glop': 'GLOP', 'clp': 'CLP'}
+EXTERNAL_BACKENDS = ('pdlp', 'highs', 'pulp_cbc')
+BACKENDS = tuple(ORTOOLS_BACKENDS) + EXTERNAL_BACKENDS
+PRIMAL_ONLY_BACKENDS = ('highs',)
+POLISH_METHODS = ('feasibility', 'glop')
+POLISH_ROUNDS = 5
+# of a time limit, kept for the glop polish
+POLISH_TIME_SHARE = 0.2
+
+
+@dataclass
+class LinearProgram:
+    """min or max objective @ x subject to constraint_lower <= constraint_matrix @ x <=
+    constraint_upper and variable_lower <= x <= variable_upper, infinite bounds are
+    np.inf"""
+    variable_lower: np.ndarray
+    variable_upper: np.ndarray
+    objective: np.ndarray
+    constraint_lower: np.ndarray
+    constraint_upper: np.ndarray
+    constraint_matrix: sparse.csr_matrix
+    maximize: bool = False
+    variable_names: Optional[list] = None
+    constraint_names: Optional[list] = None
+
+    @classmethod
+    def from_proto(cls, model):
+        counts = [len(constraint.var_index) for constraint in model.constraint]
+        indptr = np.concatenate([[0], np.cumsum(counts)])
+        indices = np.fromiter((j for c in model.constraint for j in c.var_index), int, indptr[-1])
+        coefficients = np.fromiter(
+            (a for c in model.constraint for a in c.coefficient), float, indptr[-1])
+        return cls(
+            variable_lower=np.array([v.lower_bound for v in model.variable]),
+            variable_upper=np.array([v.upper_bound for v in model.variable]),
+            objective=np.array([v.objective_coefficient for v in model.variable]),
+            constraint_lower=np.array([c.lower_bound for c in model.constraint]),
+            constraint_upper=np.array([c.upper_bound for c in model.constraint]),
+            constraint_matrix=sparse.csr_matrix(
+                (coefficients, indices, indptr), shape=(len(counts), len(model.variable))),
+            maximize=model.maximize,
+            variable_names=([v.name for v in model.variable]
+                            if any(v.name for v in model.variable) else None),
+            constraint_names=([c.name for c in model.constraint]
+                              if any(c.name for c in model.constraint) else None),
+        )
+
+    @classmethod
+    def from_pulp(cls, problem):
+        """the columns are problem.variables(), the rows problem.constraints in order"""
+        import pulp
+
+        variables = problem.variables()
+        column = {variable.name: j for j, variable in enumerate(variables)}
+        rows, columns, coefficients, rhs = [], [], [], []
+        for i, constraint in enumerate(problem.constraints.values()):
+            for variable, coefficient in constraint.items():
+                rows.append(i)
+                columns.append(column[variable.name])
+                coefficients.append(coefficient)
+            rhs.append(-constraint.constant)
+        senses = np.array([constraint.sense for constraint in problem.constraints.values()])
+        # + 0.0 turns the -0.0 of negated zero constants into 0.0
+        rhs = np.array(rhs, dtype=float) + 0.0
+        objective = np.zeros(len(variables))
+        for variable, coefficient in (problem.objective or {}).items():
+            objective[column[variable.name]] = coefficient
+        return cls(
+            variable_lower=np.array(
+                [-np.inf if v.lowBound is None else v.lowBound for v in variables], dtype=float),
+            variable_upper=np.array(
+                [np.inf if v.upBound is None else v.upBound for v in variables], dtype=float),
+            objective=objective,
+            constraint_lower=np.where(senses == pulp.LpConstraintLE, -np.inf, rhs),
+            constraint_upper=np.where(senses == pulp.LpConstraintGE, np.inf, rhs),
+            constraint_matrix=sparse.csr_matrix(
+                (coefficients, (rows, columns)), shape=(len(rhs), len(variables))),
+            maximize=problem.sense == pulp.LpMaximize,
+            variable_names=[variable.name for variable in variables],
+            constraint_names=list(problem.constraints),
+        )
+
+    def to_proto(self):
+        return mbh.to_mpmodel_proto(self.model_builder())
+
+    def model_builder(self):
+        model = mbh.ModelBuilderHelper()
+        model.fill_model_from_sparse_data(
+            self.variable_lower, self.variable_upper, self.objective,
+            self.constraint_lower, self.constraint_upper, self.constraint_matrix)
+        model.set_maximize(self.maximize)
+        for i, name in enumerate(self.variable_names or []):
+            model.set_var_name(i, name)
+        for i, name in enumerate(self.constraint_names or []):
+            model.set_constraint_name(i, name)
+        return model
+
+
+class ConstraintMatrix:
+    """collects constraint rows as sparse triplets so that whole constraint families
+    can be added with numpy instead of one SetCoefficient call per coefficient, the
+    constraint_matrix and bounds of a LinearProgram"""
+
+    def __init__(self):
+        self.rows = []
+        self.cols = []
+        self.coeffs = []
+        self.lower_bounds = []
+        self.upper_bounds = []
+        self.names = []
+        self.num_rows = 0
+
+    def add_rows(self, name, lower, upper, *terms):
+        """adds len(first term) rows; every term is a (variable indices, coefficients) pair
+        where the indices have shape (rows,) or (rows, terms per row); terms with a
+        negative variable index are skipped"""
+        num_rows = len(terms[0][0])
+        row_ids = np.arange(self.num_rows, self.num_rows + num_rows)
+        for variables, coeffs in terms:
+            variables = np.asarray(variables)
+            row_shape = (num_rows,) + (1,) * (variables.ndim - 1)
+            rows = np.broadcast_to(row_ids.reshape(row_shape), variables.shape).ravel()
+            coeffs = np.broadcast_to(coeffs, variables.shape).astype(float).ravel()
+            variables = variables.ravel()
+            # negative indices mark variables the model does not have, e.g. in sparse mode
+            created = variables >= 0
+            self.rows.append(rows[created])
+            self.cols.append(variables[created])
+            self.coeffs.append(coeffs[created])
+        self.lower_bounds.append(np.broadcast_to(lower, num_rows).astype(float))
+        self.upper_bounds.append(np.broadcast_to(upper, num_rows).astype(float))
+        self.names.extend(f"{name}_{i}" for i in range(num_rows))
+        self.num_rows += num_rows
+        return row_ids
+
+    def to_csr(self, num_cols):
+        return sparse.csr_matrix(
+            (np.concatenate(self.coeffs), (np.concatenate(self.rows), np.concatenate(self.cols))),
+            shape=(self.num_rows, num_cols))
+
+
+@dataclass
+class PdlpOptions:
+    """settings of the pdlp backend. PDLP stops once the primal and dual residuals are
+    within feasibility_tolerance and the objective gap within optimality_tolerance,
+    both relative to the size of the bounds and objective, or after time_limit
+    seconds, in which case its last iterate is kept if it is feasible within the
+    tolerance. polish is None or one of
+    - feasibility: PDLP's feasibility polishing, which also makes the iterate at the
+      time limit primal feasible
+    - glop: a crossover, GLOP re-solves the model with the variables PDLP left at a
+      bound fixed there and the rows it left slack dropped, usually a small fraction
+      of the model, and ends on an exact vertex. It gets POLISH_TIME_SHARE of the
+      time limit"""
+    threads: int = 1
+    feasibility_tolerance: float = 1e-6
+    optimality_tolerance: float = 1e-6
+    time_limit: Optional[float] = None
+    polish: Optional[str] = None
+
+    def __post_init__(self):
+        if self.polish not in (None,) + POLISH_METHODS:
+            raise ValueError(
+                f"unknown polish {self.polish}, choose one of {', '.join(POLISH_METHODS)}")
+
+    @classmethod
+    def from_string(cls, text):
+        """e.g. threads=8,time_limit=600,polish=glop, as given on the command line"""
+        types = {field.name: field.type for field in fields(cls)}
+        options = {}
+        for item in filter(None, text.split(',')):
+            name, _, value = item.partition('=')
+            if name not in types:
+                raise ValueError(f"unknown PDLP option {name}, choose from {', '.join(types)}")
+            options[name] = (int(value) if name == 'threads' else
+                             value if name == 'polish' else float(value))
+        return cls(**options)
+
+    def parameters(self):
+        """PrimalDualHybridGradientParams in text format"""
+        feasibility, optimality = self.feasibility_tolerance, self.optimality_tolerance
+        parameters = (
+            f"num_threads: {self.threads} "
+            "termination_criteria { detailed_optimality_criteria { "
+            f"eps_optimal_primal_residual_absolute: {feasibility} "
+            f"eps_optimal_primal_residual_relative: {feasibility} "
+            f"eps_optimal_dual_residual_absolute: {feasibility} "
+            f"eps_optimal_dual_residual_relative: {feasibility} "
+            f"eps_optimal_objective_gap_absolute: {optimality} "
+            f"eps_optimal_objective_gap_relative: {optimality} "
+            "} }")
+        if self.polish == 'feasibility':
+            parameters += (" use_feasibility_polishing: true"
+                           " apply_feasibility_polishing_after_limits_reached: true"
+                           " handle_some_primal_gradients_on_finite_bounds_as_residuals: false")
+        return parameters
+
+
+def solution_accuracy(program, variable_values, dual_values=None):
+    """how far a solution is from optimal: the largest bound violation of the
+    constraints and variables (primal_residual) and of the sign conditions on the duals
+    and reduced costs (dual_residual), relative to 1 + the largest finite bound and
+    objective coefficient, and the relative gap between the primal and dual objective.
+    Without dual values only the primal side is measured"""
+    x = np.asarray(variable_values, dtype=float)
+    activity = program.constraint_matrix @ x
+    primal_violation = max(
+        _violation(activity, program.constraint_lower, program.constraint_upper),
+        _violation(x, program.variable_lower, program.variable_upper))
+    bounds = np.concatenate([program.constraint_lower, program.constraint_upper])
+    accuracy = {
+        'primal_objective': float(program.objective @ x),
+        'primal_residual': primal_violation / (1 + _finite_norm(bounds)),
+    }
+    if dual_values is None:
+        return accuracy
+
+    # in the minimization form duals of >= rows and reduced costs of variables at their
+    # lower bound are nonnegative, the dual objective prices the bounds they belong to
+    sign = -1 if program.maximize else 1
+    y = sign * np.asarray(dual_values, dtype=float)
+    reduced_costs = sign * program.objective - program.constraint_matrix.T @ y
+    dual_violation = max(
+        _sign_violation(y, program.constraint_lower, program.constraint_upper),
+        _sign_violation(reduced_costs, program.variable_lower, program.variable_upper))
+    dual_objective = sign * (
+        _bound_prices(y, program.constraint_lower, program.constraint_upper) +
+        _bound_prices(reduced_costs, program.variable_lower, program.variable_upper))
+    accuracy.update(
+        dual_objective=dual_objective,
+        dual_residual=dual_violation / (1 + _finite_norm(program.objective)),
+        relative_gap=abs(accuracy['primal_objective'] - dual_objective) /
+                     (1 + abs(accuracy['primal_objective']) + abs(dual_objective)),
+    )
+    return accuracy
+
+
+def _finite_norm(values):
+    finite = values[np.isfinite(values)]
+    return float(np.abs(finite).max()) if len(finite) else 0.0
+
+
+def _violation(values, lower, upper):
+    if not len(values):
+        return 0.0
+    return float(np.maximum(np.maximum(lower - values, values - upper), 0).max())
+
+
+def _sign_violation(prices, lower, upper):
+    # a price may only push towards a finite bound
+    if not len(prices):
+        return 0.0
+    return float(np.maximum(np.where(np.isinf(lower), np.maximum(prices, 0), 0),
+                            np.where(np.isinf(upper), np.maximum(-prices, 0), 0)).max())
+
+
+def _bound_prices(prices, lower, upper):
+    bound = np.where(prices > 0, lower, upper)
+    return float(prices[np.isfinite(bound)] @ bound[np.isfinite(bound)])
+
+
+def has_duals(backend):
+    return backend not in PRIMAL_ONLY_BACKENDS
+
+
+def create_solver(backend='glop'):
+    """the pywraplp Solver that holds the model, of the backend's type for OR-Tools
+    backends and GLOP for external ones, which only use it to hold their solution"""
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown backend {backend}, choose one of {', '.join(BACKENDS)}")
+    solver = pywraplp.Solver.CreateSolver(ORTOOLS_BACKENDS.get(backend, 'GLOP'))
+    if solver is None:
+        raise ValueError(f"OR-Tools was built without {backend}, "
+                         f"available: {', '.join(available_backends())}")
+    return solver
+
+
+def available_backends():
+    available = [backend for backend, solver_id in ORTOOLS_BACKENDS.items()
+                 if pywraplp.Solver.CreateSolver(solver_id) is not None]
+    available.extend(backend for backend in ('pdlp', 'highs')
+                     if mbh.ModelSolverHelper(backend).solver_is_supported())
+    try:
+        import pulp
+        if pulp.PULP_CBC_CMD().available():
+            available.append('pulp_cbc')
+    except ImportError:
+        pass
+    return available
+
+
+def pulp_cbc_command():
+    """PuLP's CBC command line solver of the pulp_cbc backend"""
+    import pulp
+
+    return pulp.PULP_CBC_CMD(msg=False)
+
+
+def solve_external(program, backend):
+    """solves program with an external backend and returns an MPSolutionResponse"""
+    if backend == 'highs':
+        return _solve_highs(program)
+    if backend == 'pulp_cbc':
+        return _solve_pulp_cbc(program)
+    raise ValueError(f"{backend} is not an external backend")
+
+
+def solve_with_backend(solver, backend, pdlp_options=None, instrumentation=None):
+    """solves the model held by solver with backend and returns the result status,
+    pdlp also records its termination reason and iterations with instrumentation"""
+    if backend in ORTOOLS_BACKENDS:
+        return solver.Solve()
+    if backend == 'pdlp':
+        return _solve_pdlp(solver, pdlp_options or PdlpOptions(), instrumentation)
+    model = linear_solver_pb2.MPModelProto()
+    solver.ExportModelToProto(model)
+    response = solve_external(LinearProgram.from_proto(model), backend)
+    if response.status == linear_solver_pb2.MPSOLVER_OPTIMAL:
+        solver.LoadSolutionFromProto(response)
+    return response.status
+
+
+def _solve_pdlp(solver, options, instrumentation):
+    start = time.perf_counter()
+    request = linear_solver_pb2.MPModelRequest(
+        solver_type=linear_solver_pb2.MPModelRequest.PDLP_LINEAR_PROGRAMMING,
+        solver_specific_parameters=options.parameters())
+    solver.ExportModelToProto(request.model)
+    if options.time_limit:
+        request.solver_time_limit_seconds = options.time_limit * (
+            1 - POLISH_TIME_SHARE if options.polish == 'glop' else 1)
+    helper = mbh.ModelSolverHelper('pdlp')
+    if not helper.solver_is_supported():
+        raise ValueError("OR-Tools was built without PDLP")
+    response = linear_solver_pb2.MPSolutionResponse.FromString(
+        helper.solve_serialized_request(request.SerializeToString()))
+    log = solve_log_pb2.SolveLog.FromString(response.solver_specific_info)
+    if instrumentation:
+        termination = solve_log_pb2.TerminationReason.Name(log.termination_reason)
+        instrumentation.record(
+            pdlp_termination=termination.removeprefix('TERMINATION_REASON_').lower(),
+            pdlp_iterations=log.iteration_count)
+    if not response.variable_value:
+        return response.status
+
+    program = LinearProgram.from_proto(request.model)
+    if options.polish == 'glop':
+        time_limit = options.time_limit and options.time_limit - (time.perf_counter() - start)
+        if time_limit is None or time_limit > 0:
+            polished = _crossover(program, response, options, time_limit)
+            if instrumentation:
+                instrumentation.record(polished=polished is not None)
+            response = polished or response
+    if response.status != linear_solver_pb2.MPSOLVER_OPTIMAL:
+        # the last iterate at a limit is a usable plan if it keeps to the constraints
+        accuracy = solution_accuracy(program, response.variable_value)
+        if accuracy['primal_residual'] > options.feasibility_tolerance:
+            return response.status
+        response.status = linear_solver_pb2.MPSOLVER_FEASIBLE
+        response.objective_value = accuracy['primal_objective']
+    solver.LoadSolutionFromProto(response)
+    return response.status
+
+
+def _crossover(program, response, options, time_limit):
+    """re-solves program with GLOP, with the variables PDLP put at a bound their reduced
+    cost pushes them to fixed there and the rows PDLP left slack with a zero dual left
+    out. Dropped rows the new solution violates and fixed variables whose reduced cost
+    changes sign are given back and GLOP solves again, at most POLISH_ROUNDS times.
+    Returns the OPTIMAL response of the full program, or None"""
+    tolerance = options.feasibility_tolerance
+    matrix = program.constraint_matrix
+    lower, upper = program.variable_lower, program.variable_upper
+    row_lower, row_upper = program.constraint_lower, program.constraint_upper
+    sign = -1 if program.maximize else 1
+    dual_tolerance = tolerance * (1 + _finite_norm(program.objective))
+
+    def near(values, bounds):
+        with np.errstate(invalid='ignore'):
+            return np.isfinite(bounds) & (
+                np.abs(values - bounds) <= tolerance * (1 + np.abs(bounds)))
+
+    x = np.array(response.variable_value)
+    y = np.array(response.dual_value)
+    reduced_costs = sign * (program.objective - matrix.T @ y)
+    at_lower, at_upper = near(x, lower), near(x, upper)
+    fixed = ((at_lower & (reduced_costs > dual_tolerance)) |
+             (at_upper & (reduced_costs < -dual_tolerance)))
+    fixed_values = np.where(at_lower, lower, upper)
+    activity = matrix @ x
+    dropped = (~near(activity, row_lower) & ~near(activity, row_upper) &
+               (np.abs(y) <= dual_tolerance))
+    deadline = time_limit and time.perf_counter() + time_limit
+
+    for _ in range(POLISH_ROUNDS):
+        kept = ~fixed
+        rows = matrix[~dropped]
+        shift = rows[:, fixed] @ fixed_values[fixed]
+        reduced = LinearProgram(
+            lower[kept], upper[kept], program.objective[kept], row_lower[~dropped] - shift,
+            row_upper[~dropped] - shift, rows[:, kept].tocsr(), program.maximize)
+        glop = pywraplp.Solver.CreateSolver('GLOP')
+        glop.LoadModelFromProto(reduced.to_proto())
+        if deadline:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return None
+            glop.SetTimeLimit(int(remaining * 1000))
+        if glop.Solve() != pywraplp.Solver.OPTIMAL:
+            return None
+        solution = linear_solver_pb2.MPSolutionResponse()
+        glop.FillSolutionResponseProto(solution)
+        x = fixed_values.copy()
+        x[kept] = solution.variable_value
+        y = np.zeros(len(row_lower))
+        y[~dropped] = solution.dual_value
+        reduced_costs = program.objective - matrix.T @ y
+
+        activity = matrix @ x
+        violated = dropped & ((activity < row_lower - tolerance * (1 + np.abs(row_lower))) |
+                              (activity > row_upper + tolerance * (1 + np.abs(row_upper))))
+        wrong_sign = fixed & np.where(fixed_values == lower, sign * reduced_costs < -dual_tolerance,
+                                      sign * reduced_costs > dual_tolerance)
+        if not violated.any() and not wrong_sign.any():
+            polished = linear_solver_pb2.MPSolutionResponse(
+                status=linear_solver_pb2.MPSOLVER_OPTIMAL,
+                objective_value=float(program.objective @ x))
+            polished.variable_value.extend(x)
+            polished.dual_value.extend(y)
+            polished.reduced_cost.extend(reduced_costs)
+            return polished
+        dropped &= ~violated
+        fixed &= ~wrong_sign
+    return None
+
+
+def _solve_highs(program):
+    solver = mbh.ModelSolverHelper('highs')
+    if not solver.solver_is_supported():
+        raise ValueError("OR-Tools was built without HiGHS")
+    solver.solve(program.model_builder())
+    response = solver.response()
+    del response.dual_value[:]
+    del response.reduced_cost[:]
+    return response
+
+
+def _solve_pulp_cbc(program):
+    """CBC for the planners that keep their model in a Solver, which have no PuLP model
+    of their own, pulp_plan solves its model with pulp_cbc_command directly"""
+    import pulp
+
+    def bound(value):
+        return None if np.isinf(value) else float(value)
+
+    problem = pulp.LpProblem('Planning', pulp.LpMaximize if program.maximize else pulp.LpMinimize)
+    # generic names, the model names need not be valid PuLP names
+    variables = [pulp.LpVariable(f"x{j}", bound(lower), bound(upper))
+                 for j, (lower, upper)
+                 in enumerate(zip(program.variable_lower, program.variable_upper))]
+    problem.setObjective(pulp.LpAffineExpression(
+        [(variables[j], program.objective[j]) for j in np.flatnonzero(program.objective)]))
+    matrix = program.constraint_matrix
+    rows = []
+    for i, (lower, upper) in enumerate(zip(program.constraint_lower, program.constraint_upper)):
+        start, end = matrix.indptr[i], matrix.indptr[i + 1]
+        expression = pulp.LpAffineExpression(
+            [(variables[j], a) for j, a in zip(matrix.indices[start:end], matrix.data[start:end])])
+        # PuLP has no ranged rows, a row bounded on both sides becomes two
+        if lower == upper:
+            constraints = [expression == lower]
+        else:
+            constraints = ([expression >= lower] if not np.isinf(lower) else []) + \
+                          ([expression <= upper] if not np.isinf(upper) else [])
+        for k, constraint in enumerate(constraints):
+            problem.addConstraint(constraint, f"c{i}_{k}")
+        rows.append(constraints)
+    problem.solve(pulp_cbc_command())
+
+    response = linear_solver_pb2.MPSolutionResponse()
+    response.status = {
+        pulp.LpStatusOptimal: linear_solver_pb2.MPSOLVER_OPTIMAL,
+        pulp.LpStatusInfeasible: linear_solver_pb2.MPSOLVER_INFEASIBLE,
+        pulp.LpStatusUnbounded: linear_solver_pb2.MPSOLVER_UNBOUNDED,
+        pulp.LpStatusNotSolved: linear_solver_pb2.MPSOLVER_NOT_SOLVED,
+    }.get(problem.status, linear_solver_pb2.MPSOLVER_ABNORMAL)
+    if problem.status == pulp.LpStatusOptimal:
+        response.objective_value = pulp.value(problem.objective) or 0.0
+        response.variable_value.extend(v.varValue or 0.0 for v in variables)
+        response.reduced_cost.extend(v.dj or 0.0 for v in variables)
+        # the dual of a split row is the one of its binding half
+        response.dual_value.extend(sum(c.pi or 0.0 for c in constraints) for constraints in rows)
+    return response
@@ -0,0 +1,36 @@
+"""Scenario sweeps: every scenario of a spec solved in its own worker process and
+collected into one results table.
+
+A spec is either a grid whose lists are combined in every possible way
+    {"grid": {"targets_scale": [0.9, 1.0, 1.1], "labor_scale": [1.0, 1.2]}}
+or an explicit list of scenarios
+    {"scenarios": [{"targets_scale": 1.1}, {"targets_scale": 2}]}
+where each scenario maps the parameters of a planner to their override."""
+
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+
+def scenarios_from_spec(spec):
+    """the parameter overrides of every scenario, all combinations of a 'grid' of
+    values per parameter or the listed 'scenarios'"""
+    if 'grid' in spec:
+        keys = list(spec['grid'])
+        return [dict(zip(keys, values)) for values in itertools.product(*spec['grid'].values())]
+    return spec['scenarios']
+
+
+def run_sweep(solve_scenario, input_dir, scenarios, results_file, max_workers=None):
+    """solves every scenario with solve_scenario(input_dir, overrides), which returns
+    the scenario's row, in a pool of max_workers processes, one per core by default.
+    solve_scenario has to be a module level function for the pool to pickle it.
+    Writes the rows to results_file in the order of scenarios and returns them"""
+    with ProcessPoolExecutor(max_workers) as executor:
+        rows = list(executor.map(solve_scenario, itertools.repeat(input_dir), scenarios))
+    table = pd.DataFrame(rows).rename_axis('scenario')
+    os.makedirs(os.path.dirname(results_file) or '.', exist_ok=True)
+    table.to_csv(results_file)
+    return table